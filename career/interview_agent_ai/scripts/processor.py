@@ -3,11 +3,16 @@ from lollms.config import TypedConfig, BaseConfig, ConfigTemplate
 from lollms.personality import APScript, AIPersonality
 from lollms.types import MSG_TYPE
 from safe_store.generic_data_loader import GenericDataLoader
-from safe_store.document_decomposer import DocumentDecomposer
 import subprocess
 from pathlib import Path
+import site
 from typing import Callable
 
+
+# Modules shared by the personalities of the zoo live in its shared folder
+site.addsitedir(str(Path(__file__).resolve().parents[3]/"shared"))
+import text_chunking
+
 # Helper functions
 class Processor(APScript):
     """
@@ -102,7 +107,7 @@ class Processor(APScript):
         subject_path = Path(self.personality_config.subject_text)
         subject_text = GenericDataLoader.read_file(subject_path)
         self.step_start(f"summerizing position subject {subject_path.stem}")
-        subject_chunks = DocumentDecomposer.decompose_document(subject_text,self.personality.config.ctx_size//2,0, self.personality.model.tokenize, self.personality.model.detokenize, True)
+        subject_chunks = text_chunking.chunk_texts(subject_text, self.personality.config.ctx_size//2, self.personality.model.tokenize, self.personality.model.detokenize)
         output += f"- Found `{len(subject_chunks)}` chunks in position description\n"
         
         subject_summary = self.summerize(subject_chunks,"Summerize this position description and do not add any comments after the summary.\nThe objective is to identify the skills required for this position. Only extract the information from the provided chunk.\nDo not invent anything outside the provided text.","position description chunk")
@@ -134,7 +139,7 @@ class Processor(APScript):
         self.step_end(f"Reading data {cv_path.stem}")
 
         self.step_start(f"chunking documents {cv_path.stem}")
-        cv_chunks = DocumentDecomposer.decompose_document(cv_data,self.personality.config.ctx_size//2,0, self.personality.model.tokenize, self.personality.model.detokenize, True)
+        cv_chunks = text_chunking.chunk_texts(cv_data, self.personality.config.ctx_size//2, self.personality.model.tokenize, self.personality.model.detokenize)
         output += f"- Found `{len(cv_chunks)}` chunks in cv\n"
         self.full(output)
         self.step_end(f"chunking documents {cv_path.stem}")
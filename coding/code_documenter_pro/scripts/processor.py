@@ -15,7 +15,109 @@ import numpy as np
 import json
 import subprocess
 import ast
+import os
+import re
+import hashlib
+import site
 
+# Version of the binary vector store layout (meta file + float32 matrix + chunks sidecar)
+STORE_VERSION = 1
+
+# Modules shared by the personalities of the zoo live in its shared folder
+site.addsitedir(str(Path(__file__).resolve().parents[3]/"shared"))
+import text_chunking
+from embedding_tools import ProjectionCache, normalize_rows, top_k_indices
+
+class TfidfIndex:
+    """
+    Incremental TF-IDF index.
+
+    Texts are hashed into a fixed feature space, so every document shares the same vocabulary,
+    and stored as raw term counts in a CSR matrix. Document frequencies are derived from the
+    stored counts, so the IDF weights always cover the whole database without any refit and
+    adding texts only costs their own hashing.
+    """
+    def __init__(self, n_features=2**20):
+        from sklearn.feature_extraction.text import HashingVectorizer
+        self.n_features = n_features
+        self.hasher = HashingVectorizer(n_features=n_features, alternate_sign=False, norm=None)
+        self.counts = None
+        self.idf = None
+        self.norms = None
+        # (rows, counts) blocks added since the last consolidation
+        self._pending = []
+
+    def __len__(self):
+        self.consolidate()
+        return 0 if self.counts is None else self.counts.shape[0]
+
+    def transform(self, texts):
+        counts = self.hasher.transform(texts).tocsr()
+        counts.sum_duplicates()
+        return counts
+
+    def add(self, rows, texts):
+        """Stores the term counts of texts at the given rows, replacing previous versions of those rows"""
+        if len(texts)>0:
+            self._pending.append((np.asarray(rows, dtype=np.int64), self.transform(texts)))
+
+    def consolidate(self):
+        import scipy.sparse as sp
+        if len(self._pending)==0:
+            return
+        blocks = self._pending
+        if self.counts is not None:
+            blocks = [(np.arange(self.counts.shape[0]), self.counts)] + blocks
+        rows = np.concatenate([r for r, _ in blocks])
+        counts = sp.vstack([c for _, c in blocks]+[sp.csr_matrix((1, self.n_features))]).tocsr()
+        # Keep the last version of each row, rows that were never filled point to the empty row
+        latest = np.full(rows.max()+1, -1, dtype=np.int64)
+        np.maximum.at(latest, rows, np.arange(len(rows)))
+        latest[latest<0] = counts.shape[0]-1
+        self.counts = counts[latest]
+        self._pending = []
+        self._update_weights()
+
+    def _update_weights(self):
+        nb_docs = self.counts.shape[0]
+        df = np.bincount(self.counts.indices, minlength=self.n_features)
+        # Same smoothed idf as sklearn's TfidfVectorizer
+        self.idf = (np.log((1+nb_docs)/(1+df))+1).astype(np.float32)
+        self.norms = np.sqrt(self.counts.multiply(self.counts) @ (self.idf**2))
+        self.norms[self.norms==0] = 1
+
+    def weighted_matrix(self):
+        """Returns the l2 normalized tf-idf rows (sparse)"""
+        import scipy.sparse as sp
+        self.consolidate()
+        return sp.diags(1/self.norms) @ self.counts.multiply(self.idf).tocsr()
+
+    def scores(self, query_counts):
+        """Cosine similarities between the (nb_queries, n_features) query counts and every stored row"""
+        self.consolidate()
+        if self.counts is None:
+            return np.zeros((query_counts.shape[0], 0), dtype=np.float32)
+        squared_idf = self.idf**2
+        scores = (query_counts.multiply(squared_idf).tocsr() @ self.counts.T).toarray()
+        query_norms = np.sqrt(query_counts.multiply(query_counts) @ squared_idf)
+        query_norms[query_norms==0] = 1
+        return scores / query_norms[:, np.newaxis] / self.norms[np.newaxis, :]
+
+    def save(self, path):
+        """Writes the counts to a temporary file moved over path once complete"""
+        import scipy.sparse as sp
+        self.consolidate()
+        if self.counts is not None:
+            tmp_path = Path(str(path)+".tmp")
+            with open(tmp_path, "wb") as f:
+                sp.save_npz(f, self.counts)
+            os.replace(tmp_path, path)
+
+    def load(self, path):
+        import scipy.sparse as sp
+        self.counts = sp.load_npz(path).tocsr()
+        self._pending = []
+        self._update_weights()
 
 class TextVectorizer:
     def __init__(self, processor):
@@ -25,12 +127,30 @@ class TextVectorizer:
         self.model = self.personality.model
         self.personality_config = self.processor.personality_config
         self.lollms_paths = self.personality.lollms_paths
-        self.embeddings = {}
+        # Embeddings are kept as L2-normalized float32 rows of a single growable
+        # matrix. chunk_ids[i] is the id of the row i and _rows maps ids back to rows.
+        self.chunk_ids = []
+        self._rows = {}
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
         self.texts = {}
         self.ready = False
-        self.vectorizer = None
         
         self.database_file = Path(self.lollms_paths.personal_data_path/self.personality_config["database_path"])
+        # Binary store: the embedding matrix is a raw float32 file that is memory mapped at load time,
+        # texts are appended to a jsonl sidecar and the meta file holds the number of valid rows
+        self.store_meta_file = self.database_file.with_suffix(".meta.json")
+        self.store_matrix_file = self.database_file.with_suffix(".f32")
+        self.store_chunks_file = self.database_file.with_suffix(".chunks.jsonl")
+        self.store_tfidf_file = self.database_file.with_suffix(".tfidf.npz")
+        self._projections = {}
+        # (basis, reduced rows, weighted tf-idf matrix, query map), see tfidf_reduction
+        self._tfidf_reduction = None
+        self._saved_rows = 0
+        self._dirty_rows = set()
+        self._needs_rewrite = False
+        self.infos={
+            "vectorization_method":self.personality_config.vectorization_method
+        }
 
         self.visualize_data_at_startup=self.personality_config["visualize_data_at_startup"]
         self.visualize_data_at_add_file=self.personality_config["visualize_data_at_add_file"]
@@ -53,11 +173,19 @@ class TextVectorizer:
                 self.infos={
                     "vectorization_method":"ftidf_vectorizer"
                 }
-        # Load previous state from the JSON file
+        self.tfidf_index = TfidfIndex() if self.personality_config.vectorization_method=="ftidf_vectorizer" else None
+        # Load previous state from the binary store, or import it from a legacy JSON database
         if self.personality_config.save_db:
-            if Path(self.database_file).exists():
-                ASCIIColors.success(f"Database file found : {self.database_file}")
-                self.load_from_json()
+            if self.store_meta_file.exists():
+                ASCIIColors.success(f"Database found : {self.store_meta_file}")
+                self.load()
+                if self.visualize_data_at_startup:
+                    self.show_document()
+                self.ready = True
+            elif Path(self.database_file).exists():
+                ASCIIColors.success(f"JSON database file found : {self.database_file}. Converting it to the binary format")
+                self.import_from_json()
+                self.save()
                 if self.visualize_data_at_startup:
                     self.show_document()
                 self.ready = True
@@ -67,6 +195,59 @@ class TextVectorizer:
 
 
                 
+    def tfidf_basis(self):
+        return "tfidf:"+hashlib.sha256("\n".join(self.chunk_ids).encode("utf-8")).hexdigest()
+
+    def tfidf_reduction(self):
+        """
+        Hashed tf-idf rows are too wide to be projected directly, they are reduced to at most 50
+        dimensions first. Returns (basis, normalized reduced rows, weighted matrix, query map),
+        computed once per database content: a weighted query row q is reduced to
+        (q @ weighted.T) @ query_map.
+        """
+        basis = self.tfidf_basis()
+        if self._tfidf_reduction is None or self._tfidf_reduction[0]!=basis:
+            weighted = self.tfidf_index.weighted_matrix()
+            # At least the 2 components the plots need, and no more than the rows or the features
+            n_components = min(max(2, min(50, len(self)-1)), len(self), weighted.shape[1])
+            if len(self)<=4096:
+                # Far fewer rows than hashed features: the reduced rows U*S come from the small gram matrix
+                eigenvalues, eigenvectors = np.linalg.eigh((weighted @ weighted.T).toarray())
+                top = np.argsort(eigenvalues)[::-1][:n_components]
+                squared_values = np.maximum(eigenvalues[top], 0)
+                reduced = eigenvectors[:, top]*np.sqrt(squared_values)
+            else:
+                from sklearn.decomposition import TruncatedSVD
+                svd = TruncatedSVD(n_components=n_components)
+                reduced = svd.fit_transform(weighted)
+                squared_values = svd.singular_values_**2
+            # weighted = U*S*Vt so the query coordinates q @ V are (q @ weighted.T) @ U/S = (q @ weighted.T) @ reduced/S^2
+            query_map = reduced/np.maximum(squared_values, 1e-12)
+            self._tfidf_reduction = (basis, normalize_rows(reduced), weighted, query_map)
+        return self._tfidf_reduction
+
+    def reduced_query(self, query_text):
+        """Normalized embedding of the query in the space of the projected rows"""
+        if self.tfidf_index is not None:
+            _, _, weighted, query_map = self.tfidf_reduction()
+            query_rows = self.embed_query(query_text).multiply(self.tfidf_index.idf).tocsr()
+            return normalize_rows((query_rows @ weighted.T).toarray() @ query_map)
+        return normalize_rows(self.embed_query(query_text))
+
+    def projection_2d(self, method="PCA"):
+        """2-D points of the chunks (in chunk_ids order) from the projection cache, see ProjectionCache"""
+        if method not in self._projections:
+            self._projections[method] = ProjectionCache(self.database_file.with_suffix(f".{method.lower()}.npz") if self.personality_config.save_db else None)
+        projection = self._projections[method]
+        if self.tfidf_index is not None:
+            # The SVD reduction is refitted on every change, so only an exact hit can be reused
+            basis = self.tfidf_basis()
+            points = projection.lookup(method, basis, self.chunk_ids)
+            if points is None:
+                points = projection.project(method, basis, self.chunk_ids, self.tfidf_reduction()[1])
+            return points
+        return projection.project(method, "model_embedding", self.chunk_ids, self.embedding_matrix)
+
     def show_document(self, query_text=None):
         import textwrap
         import seaborn as sns
@@ -76,8 +257,6 @@ class TextVectorizer:
 
         
         from sklearn.manifold import TSNE
-        from sklearn.decomposition import PCA
-        import torch
 
         if self.personality_config.data_visualization_method=="PCA":
             use_pca =  True
@@ -88,39 +267,23 @@ class TextVectorizer:
             print("Showing pca representation :")
         else:
             print("Showing t-sne representation :")
-        texts = list(self.texts.values())
-        embeddings = self.embeddings
-        emb = list(embeddings.values())
-        if len(emb)>=2:
-            # Normalize embeddings
-            emb = np.vstack(emb)
-            norms = np.linalg.norm(emb, axis=1)
-            normalized_embeddings = emb / norms[:, np.newaxis]
-
-            # Embed the query text
-            if query_text is not None:
-                query_embedding = self.embed_query(query_text)
-                query_embedding = query_embedding.detach().squeeze().numpy()
-                query_normalized_embedding = query_embedding / np.linalg.norm(query_embedding)
-
-                # Combine the query embedding with the document embeddings
-                combined_embeddings = np.vstack((normalized_embeddings, query_normalized_embedding))
-            else:
-                # Combine the query embedding with the document embeddings
-                combined_embeddings = normalized_embeddings
-
-            if use_pca:
-                # Use PCA for dimensionality reduction
-                pca = PCA(n_components=2)
-                embeddings_2d = pca.fit_transform(combined_embeddings)
+        texts = [self.texts[chunk_id] for chunk_id in self.chunk_ids]
+        if len(self)>=2:
+            if query_text is None or use_pca:
+                # Cached projection, a query is projected on the stored PCA components
+                embeddings_2d = self.projection_2d("PCA" if use_pca else "TSNE")
+                if query_text is not None:
+                    query_2d = self._projections["PCA"].project_query(self.reduced_query(query_text)[0])
+                    embeddings_2d = np.vstack([embeddings_2d, query_2d])
             else:
-                # Use t-SNE for dimensionality reduction
+                # t-SNE has no transform for new points, it is refitted with the query
+                normalized_embeddings = self.tfidf_reduction()[1] if self.tfidf_index is not None else self.embedding_matrix
+                combined_embeddings = np.vstack((normalized_embeddings, self.reduced_query(query_text)))
                 # Adjust the perplexity value
                 perplexity = min(30, combined_embeddings.shape[0] - 1)
                 tsne = TSNE(n_components=2, perplexity=perplexity)
                 embeddings_2d = tsne.fit_transform(combined_embeddings)
 
-
             # Create a scatter plot using Seaborn
             if query_text is not None:
                 sns.scatterplot(x=embeddings_2d[:-1, 0], y=embeddings_2d[:-1, 1])  # Plot document embeddings
@@ -188,69 +351,37 @@ class TextVectorizer:
         
     def index_document(self, document_id, text, chunk_size, overlap_size, force_vectorize=False):
 
-        if document_id in self.embeddings and not force_vectorize:
+        if f"{document_id}_chunk_1" in self._rows and not force_vectorize:
             print(f"Document {document_id} already exists. Skipping vectorization.")
             return
 
-        # Split tokens into sentences
-        sentences = text.split('. ')
-        def remove_empty_sentences(sentences):
-            return [sentence for sentence in sentences if sentence.strip() != '']
-        sentences = remove_empty_sentences(sentences)
-        # Generate chunks with overlap and sentence boundaries
-        chunks = []
-        current_chunk = []
-        for i in range(len(sentences)):
-            sentence = sentences[i]
-            sentence_tokens = self.model.tokenize(sentence)
-                   
-
-            # ASCIIColors.yellow(len(sentence_tokens))
-            if len(current_chunk) + len(sentence_tokens) <= chunk_size:
-                current_chunk.extend(sentence_tokens)
-            else:
-                if current_chunk:
-                    chunks.append(current_chunk)
-
-                while len(sentence_tokens)>chunk_size:
-                    current_chunk = sentence_tokens[0:chunk_size]
-                    sentence_tokens = sentence_tokens[chunk_size:]
-                    chunks.append(current_chunk)
-                current_chunk = sentence_tokens
-                
+        # Generate chunks with sentence boundaries
+        chunks = text_chunking.chunk_texts(text, chunk_size, self.model.tokenize, self.model.detokenize)
 
-        if current_chunk:
-            chunks.append(current_chunk)
+        # Store chunk ID, original text and embedding
+        chunk_ids = []
+        for i, chunk in enumerate(chunks):
+            chunk_id = f"{document_id}_chunk_{i + 1}"
+            self.texts[chunk_id] = chunk
+            chunk_ids.append(chunk_id)
 
-        if self.personality_config.vectorization_method=="ftidf_vectorizer":
-            from sklearn.feature_extraction.text import TfidfVectorizer
-            self.vectorizer = TfidfVectorizer()
-            #if self.personality.config.debug:
-            #    ASCIIColors.yellow(','.join([len(chunk) for chunk in chunks]))
-            data=[]
-            for chunk in chunks:
+        if self.tfidf_index is not None:
+            # One batched transform for the whole document, previous documents are left untouched
+            rows = self._register_chunks(chunk_ids)
+            self.tfidf_index.add(rows, [self.texts[chunk_id] for chunk_id in chunk_ids])
+        else:
+            embedded_ids, vectors = [], []
+            for chunk_id in chunk_ids:
                 try:
-                    data.append(self.model.detokenize(chunk) ) 
+                    vectors.append(self.model.embed(self.texts[chunk_id]))
+                    embedded_ids.append(chunk_id)
                 except Exception as ex:
                     print("oups")
-            self.vectorizer.fit(data)
-
-        self.embeddings = {}
-        # Generate embeddings for each chunk
-        for i, chunk in enumerate(chunks):
-            # Store chunk ID, embedding, and original text
-            chunk_id = f"{document_id}_chunk_{i + 1}"
-            try:
-                self.texts[chunk_id] = self.model.detokenize(chunk[:chunk_size])
-                if self.personality_config.vectorization_method=="ftidf_vectorizer":
-                    self.embeddings[chunk_id] = self.vectorizer.transform([self.texts[chunk_id]]).toarray()
-                else:
-                    self.embeddings[chunk_id] = self.model.embed(self.texts[chunk_id])
-            except Exception as ex:
-                print("oups")
+            if len(embedded_ids)>0:
+                self.add_embeddings(embedded_ids, vectors)
 
         if self.personality_config.save_db:
-            self.save_to_json()
+            self.save()
             
         self.ready = True
         if self.visualize_data_at_add_file:
@@ -259,24 +390,78 @@ class TextVectorizer:
 
     def embed_query(self, query_text):
         # Generate query embedding
-        if self.personality_config.vectorization_method=="ftidf_vectorizer":
-            query_embedding = self.vectorizer.transform([query_text]).toarray()
+        if self.tfidf_index is not None:
+            query_embedding = self.tfidf_index.transform([query_text])
         else:
             query_embedding = self.model.embed(query_text)
 
         return query_embedding
 
-    def recover_text(self, query_embedding, top_k=1):
-        from sklearn.metrics.pairwise import cosine_similarity
-        similarities = {}
-        for chunk_id, chunk_embedding in self.embeddings.items():
-            similarity = cosine_similarity(query_embedding, chunk_embedding)
-            similarities[chunk_id] = similarity
+    def __len__(self):
+        return len(self.chunk_ids)
+
+    @property
+    def embedding_matrix(self):
+        """The (nb_chunks, dim) matrix of normalized embeddings, row i belonging to chunk_ids[i]"""
+        return self._matrix[:len(self.chunk_ids)]
+
+    @property
+    def embeddings(self):
+        return {chunk_id: row for chunk_id, row in zip(self.chunk_ids, self.embedding_matrix)}
+
+    def reset_embeddings(self):
+        self.chunk_ids = []
+        self._rows = {}
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
+        self._dirty_rows = set()
+        self._needs_rewrite = True
+        if self.tfidf_index is not None:
+            self.tfidf_index = TfidfIndex()
+
+    def _register_chunks(self, chunk_ids):
+        """Returns the rows of the chunks, allocating new rows for unknown ids"""
+        rows = []
+        for chunk_id in chunk_ids:
+            row = self._rows.get(chunk_id)
+            if row is None:
+                row = len(self.chunk_ids)
+                self.chunk_ids.append(chunk_id)
+                self._rows[chunk_id] = row
+            elif row<self._saved_rows:
+                self._dirty_rows.add(row)
+            rows.append(row)
+        return rows
+
+    def add_embeddings(self, chunk_ids, vectors):
+        """
+        Adds (or replaces) the embeddings of a list of chunks.
 
-        # Sort the similarities and retrieve the top-k most similar embeddings
-        sorted_similarities = sorted(similarities.items(), key=lambda x: x[1], reverse=True)[:top_k]
+        The matrix grows by doubling its capacity so appending n rows costs O(n) amortized.
+        """
+        vectors = normalize_rows(np.vstack([np.asarray(v, dtype=np.float32).reshape(1, -1) for v in vectors]))
+        if len(self.chunk_ids)==0:
+            self._matrix = np.zeros((max(16, len(chunk_ids)), vectors.shape[1]), dtype=np.float32)
+        elif self._matrix.shape[1]!=vectors.shape[1]:
+            raise ValueError(f"Embedding size mismatch: the database uses {self._matrix.shape[1]} dimensions, got {vectors.shape[1]}")
+        rows = self._register_chunks(chunk_ids)
+        if len(self.chunk_ids)>self._matrix.shape[0]:
+            grown = np.zeros((max(2*self._matrix.shape[0], len(self.chunk_ids)), self._matrix.shape[1]), dtype=np.float32)
+            grown[:self._matrix.shape[0]] = self._matrix
+            self._matrix = grown
+        self._matrix[rows] = vectors
+
+    def recover_text(self, query_embedding, top_k=1):
+        if len(self)==0:
+            return [], []
+        if self.tfidf_index is not None:
+            scores = self.tfidf_index.scores(query_embedding)[0]
+        else:
+            query = normalize_rows(query_embedding)[0]
+            scores = self.embedding_matrix @ query
+        indices = top_k_indices(scores, top_k)
 
         # Retrieve the original text associated with the most similar embeddings
+        sorted_similarities = [(self.chunk_ids[i], float(scores[i])) for i in indices]
         texts = [self.texts[chunk_id] for chunk_id, _ in sorted_similarities]
 
         if self.visualize_data_at_generate:
@@ -284,39 +469,157 @@ class TextVectorizer:
 
         return texts, sorted_similarities
 
-    def save_to_json(self):
+    def recover_texts(self, query_embeddings, top_k=1):
+        """
+        Batch version of recover_text: answers all the queries with a single matrix product.
+
+        Returns a list of (texts, sorted_similarities) tuples, one per query.
+        """
+        if len(self)==0:
+            return [([], []) for _ in query_embeddings]
+        if self.tfidf_index is not None:
+            import scipy.sparse as sp
+            scores = self.tfidf_index.scores(sp.vstack(query_embeddings).tocsr())
+        else:
+            queries = normalize_rows(np.vstack([np.asarray(q, dtype=np.float32).reshape(1, -1) for q in query_embeddings]))
+            scores = queries @ self.embedding_matrix.T
+        results = []
+        for query_scores, indices in zip(scores, top_k_indices(scores, top_k)):
+            sorted_similarities = [(self.chunk_ids[i], float(query_scores[i])) for i in indices]
+            results.append(([self.texts[chunk_id] for chunk_id, _ in sorted_similarities], sorted_similarities))
+        return results
+
+    def save(self):
+        """
+        Writes the database to the binary store.
+
+        Only the rows added since the last save are appended to the matrix and chunks files,
+        modified rows are patched in place. The meta file is replaced last so that a crash in
+        the middle of a save leaves the previous state readable.
+        """
+        nb_rows = len(self)
+        dim = self._matrix.shape[1] if nb_rows>0 else 0
+        self.database_file.parent.mkdir(parents=True, exist_ok=True)
+        if self._needs_rewrite or not self.store_meta_file.exists():
+            # Written aside then moved: the matrix may be a map of the current file
+            tmp_matrix_file = Path(str(self.store_matrix_file)+".tmp")
+            with open(tmp_matrix_file, "wb") as f:
+                f.write(self.embedding_matrix.tobytes())
+            os.replace(tmp_matrix_file, self.store_matrix_file)
+            with open(self.store_chunks_file, "w", encoding="utf-8") as f:
+                for row, chunk_id in enumerate(self.chunk_ids):
+                    f.write(json.dumps({"row":row, "id":chunk_id, "text":self.texts.get(chunk_id, "")})+"\n")
+        else:
+            # A memory mapped matrix (copy on write) stays mapped: the saved rows are never moved,
+            # dirty rows are written with the values the map already holds in private pages
+            with open(self.store_matrix_file, "r+b") as f:
+                if os.fstat(f.fileno()).st_size>self._saved_rows*dim*4:
+                    # Drop anything an interrupted save may have left after the last valid row
+                    f.truncate(self._saved_rows*dim*4)
+                for row in sorted(self._dirty_rows) if dim>0 else []:
+                    f.seek(row*dim*4)
+                    f.write(self._matrix[row].tobytes())
+                f.seek(0, os.SEEK_END)
+                f.write(self.embedding_matrix[self._saved_rows:].tobytes())
+            with open(self.store_chunks_file, "a", encoding="utf-8") as f:
+                for row in sorted(self._dirty_rows)+list(range(self._saved_rows, nb_rows)):
+                    chunk_id = self.chunk_ids[row]
+                    f.write(json.dumps({"row":row, "id":chunk_id, "text":self.texts.get(chunk_id, "")})+"\n")
+        meta = {
+            "version": STORE_VERSION,
+            "count": nb_rows,
+            "dim": dim,
+            "infos": self.infos
+        }
+        if self.tfidf_index is not None:
+            # Lets load detect a tf-idf file that doesn't belong to this meta file
+            meta["tfidf_rows"] = len(self.tfidf_index)
+        tmp_meta_file = self.store_meta_file.with_suffix(".tmp")
+        with open(tmp_meta_file, "w") as f:
+            json.dump(meta, f)
+        if self.tfidf_index is not None:
+            self.tfidf_index.save(self.store_tfidf_file)
+        os.replace(tmp_meta_file, self.store_meta_file)
+        self._saved_rows = nb_rows
+        self._dirty_rows = set()
+        self._needs_rewrite = False
+
+    def load(self):
+        """
+        Opens the binary store. The embedding matrix is memory mapped (copy on write) so
+        only the pages touched by the searches are actually read from disk.
+        """
+        ASCIIColors.info("Loading vectorized documents")
+        with open(self.store_meta_file, "r") as f:
+            meta = json.load(f)
+        if meta.get("version")!=STORE_VERSION:
+            raise ValueError(f"Unsupported database version {meta.get('version')} (expected {STORE_VERSION})")
+        nb_rows, dim = meta["count"], meta["dim"]
+        ids = [None]*nb_rows
+        texts = {}
+        with open(self.store_chunks_file, "r", encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                # Later entries override earlier ones, rows past count come from an interrupted save
+                if entry["row"]<nb_rows:
+                    ids[entry["row"]] = entry["id"]
+                    texts[entry["id"]] = entry["text"]
+        self.reset_embeddings()
+        if nb_rows>0:
+            if dim>0:
+                self._matrix = np.memmap(self.store_matrix_file, dtype=np.float32, mode="c", shape=(nb_rows, dim))
+            self.chunk_ids = ids
+            self._rows = {chunk_id:row for row, chunk_id in enumerate(ids)}
+        self.texts = texts
+        self.infos = meta["infos"]
+        self._saved_rows = nb_rows
+        self._needs_rewrite = False
+        self.ready = True
+        if self.tfidf_index is not None and nb_rows>0:
+            try:
+                self.tfidf_index.load(self.store_tfidf_file)
+                consistent = len(self.tfidf_index)==nb_rows==meta.get("tfidf_rows", nb_rows)
+            except Exception as ex:
+                ASCIIColors.warning(f"Couldn't load the tf-idf index: {ex}")
+                consistent = False
+            if not consistent:
+                # Interrupted save: the term counts are rebuilt from the chunk texts
+                ASCIIColors.warning("The tf-idf index doesn't match the database, rebuilding it")
+                self.tfidf_index = TfidfIndex()
+                self.tfidf_index.add(list(range(nb_rows)), [self.texts.get(chunk_id, "") for chunk_id in self.chunk_ids])
+                self._needs_rewrite = True
+
+    def export_to_json(self, path=None):
+        """Exports the database to the legacy JSON format"""
         state = {
-            "embeddings": {str(k): v.tolist()  if type(v)!=list else v for k, v in self.embeddings.items() },
+            "embeddings": {str(k): v.tolist() for k, v in self.embeddings.items() },
             "texts": self.texts,
             "infos": self.infos
         }
-        with open(self.database_file, "w") as f:
+        with open(path if path is not None else self.database_file, "w") as f:
             json.dump(state, f)
 
-    def load_from_json(self):
-
+    def import_from_json(self, path=None):
+        """Imports a database saved in the legacy JSON format"""
         ASCIIColors.info("Loading vectorized documents")
-        with open(self.database_file, "r") as f:
+        with open(path if path is not None else self.database_file, "r") as f:
             state = json.load(f)
-            self.embeddings = {k: v for k, v in state["embeddings"].items()}
+            self.reset_embeddings()
             self.texts = state["texts"]
             self.infos= state["infos"]
             self.ready = True
-        if self.personality_config.vectorization_method=="ftidf_vectorizer":
-            from sklearn.feature_extraction.text import TfidfVectorizer
-            data = list(self.texts.values())
-            if len(data)>0:
-                self.vectorizer = TfidfVectorizer()
-                self.vectorizer.fit(data)
-                self.embeddings={}
-                for k,v in self.texts.items():
-                    self.embeddings[k]= self.vectorizer.transform([v]).toarray()
+        if self.tfidf_index is not None:
+            # Stored tf-idf vectors belong to per document vocabularies, rebuild them in one batch
+            chunk_ids = list(self.texts.keys())
+            self.tfidf_index.add(self._register_chunks(chunk_ids), [self.texts[chunk_id] for chunk_id in chunk_ids])
+        elif len(state["embeddings"])>0:
+            self.add_embeddings(list(state["embeddings"].keys()), list(state["embeddings"].values()))
+
     def clear_database(self):
-        self.vectorizer=None
-        self.embeddings = {}
+        self.reset_embeddings()
         self.texts={}
         if self.personality_config.save_db:
-            self.save_to_json()
+            self.save()
 
 
 
@@ -436,7 +739,8 @@ class Processor(APScript):
                                         "help":self.help,
                                         "show_database": self.show_database,
                                         "set_database": self.set_database,
-                                        "clear_database": self.clear_database
+                                        "clear_database": self.clear_database,
+                                        "export_database": self.export_database
                                     },
                                     "default": self.chat_with_doc
                                 },                           
@@ -485,6 +789,15 @@ class Processor(APScript):
     def clear_database(self,prompt, full_context):
         self.vector_store.clear_database()
 
+    def export_database(self, prompt, full_context):
+        """Writes the database in the legacy JSON format, next to the binary store"""
+        if self.vector_store is None or len(self.vector_store)==0:
+            self.full("The database is empty, there is nothing to export", callback=self.callback)
+            return
+        export_path = self.vector_store.database_file.with_suffix(".export.json")
+        self.vector_store.export_to_json(export_path)
+        self.full(f"Database exported to {export_path}", callback=self.callback)
+
     def chat_with_doc(self, prompt, full_context):
         self.step_start("Recovering data")
         ASCIIColors.blue("Recovering data")
@@ -595,7 +908,7 @@ Be precise and give details in your answer.
             self.vector_store = TextVectorizer(
                                         self
                                     )        
-        if len(self.vector_store.embeddings)>0:
+        if len(self.vector_store)>0:
             self.ready = True
 
         ASCIIColors.info("-> Vectorizing the database"+ASCIIColors.color_orange)
@@ -659,14 +972,7 @@ Be precise and give details in your answer.
                                         self
                                     )    
 
-        if self.vector_store and self.personality_config.vectorization_method=="ftidf_vectorizer":
-            from sklearn.feature_extraction.text import TfidfVectorizer
-            data = list(self.vector_store.texts.values())
-            if len(data)>0:
-                self.vectorizer = TfidfVectorizer()
-                self.vectorizer.fit(data)
-
-        if len(self.vector_store.embeddings)>0:
+        if len(self.vector_store)>0:
             self.ready = True
 
     def run_workflow(self, prompt:str, previous_discussion_text:str="", callback: Callable[[str, MSG_TYPE, dict, list], bool]=None, context_details:dict=None):
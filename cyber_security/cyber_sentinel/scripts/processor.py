@@ -5,13 +5,18 @@ from lollms.types import MSG_TYPE
 from typing import Callable
 
 from safe_store.generic_data_loader import GenericDataLoader
-from safe_store.document_decomposer import DocumentDecomposer
 import subprocess
 from pathlib import Path
+import site
 import json
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
+
+# Modules shared by the personalities of the zoo live in its shared folder
+site.addsitedir(str(Path(__file__).resolve().parents[3]/"shared"))
+import text_chunking
+
 # Helper functions
 class Processor(APScript, FileSystemEventHandler):
     """
@@ -89,14 +94,12 @@ class Processor(APScript, FileSystemEventHandler):
     def process_file(self, file):
                 self.step_start(f"Processing {file.name}")
                 data = GenericDataLoader.read_file(file)
-                dd = DocumentDecomposer()
-                chunks = dd.decompose_document(
+                chunks = text_chunking.chunk_texts(
                                             data,
                                             self.personality_config.chunk_size,
-                                            self.personality_config.chunk_overlap,
                                             self.personality.model.tokenize,
                                             self.personality.model.detokenize,
-                                            return_detokenized=True
+                                            overlap=self.personality_config.chunk_overlap
                                     )
                 n_chunks = len(chunks)
                 for i, chunk in enumerate(chunks):
@@ -0,0 +1,281 @@
+"""
+Headless benchmark harness for chat_with_docs.
+
+Drives Processor.build_db, chat_with_doc and process_batch against a deterministic stand-in
+model (regex tokenizer, hashed bag of words embeddings, echo generation), each with a
+configurable per call latency, over synthetic corpora of increasing size. Every corpus size
+runs in its own process so the reported peak RSS belongs to that size only.
+
+Reported per size: ingest docs/s and chunks/s, interactive query latency p50/p99, batch
+questions/min and peak RSS. --save writes the results as json, --baseline compares with a
+previous json file and exits with status 1 when a metric regressed by more than --tolerance.
+
+Usage:
+    python benchmarks/harness.py --sizes 10 100 1000 --queries 50
+    python benchmarks/harness.py --save baseline.json
+    python benchmarks/harness.py --baseline baseline.json --tolerance 0.2
+"""
+import argparse
+import importlib.util
+import json
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+
+def load_processor_module():
+    processor_path = Path(__file__).resolve().parent.parent / "scripts" / "processor.py"
+    spec = importlib.util.spec_from_file_location("processor", str(processor_path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def busy_wait(seconds):
+    if seconds>0:
+        end = time.perf_counter()+seconds
+        while time.perf_counter()<end:
+            pass
+
+
+class FakeModel:
+    """Deterministic stand-in for a model binding"""
+    def __init__(self, tokenize_latency_us=20, embed_latency_ms=1, token_latency_ms=0.5, answer_tokens=64, dim=384):
+        self.tokenize_latency = tokenize_latency_us/1e6
+        self.embed_latency = embed_latency_ms/1e3
+        self.token_latency = token_latency_ms/1e3
+        self.answer_tokens = answer_tokens
+        self.dim = dim
+        self.vocabulary = {}
+        self.words = []
+        self.calls = {"tokenize":0, "detokenize":0, "embed":0, "generate":0}
+
+    def tokenize(self, text):
+        self.calls["tokenize"] += 1
+        busy_wait(self.tokenize_latency)
+        tokens = []
+        for word in re.findall(r"\s*\S+", text):
+            if word not in self.vocabulary:
+                self.vocabulary[word] = len(self.words)
+                self.words.append(word)
+            tokens.append(self.vocabulary[word])
+        return tokens
+
+    def detokenize(self, tokens):
+        self.calls["detokenize"] += 1
+        busy_wait(self.tokenize_latency)
+        return "".join(self.words[t] for t in tokens)
+
+    def embed(self, text):
+        self.calls["embed"] += 1
+        busy_wait(self.embed_latency)
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            vector[zlib.crc32(word.encode("utf-8"))%self.dim] += 1
+        return vector.tolist()
+
+    def generate(self, prompt, n_predict=128, callback=None, **kwargs):
+        """Echoes the last words of the prompt, one token latency per generated word"""
+        self.calls["generate"] += 1
+        words = re.findall(r"\w+", prompt)[-min(n_predict, self.answer_tokens):]
+        busy_wait(self.token_latency*len(words))
+        return " ".join(words)
+
+
+class FakeConfig(dict):
+    """dict with attribute access, like the lollms configuration objects"""
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+
+class FakePersonality:
+    """The attributes of AIPersonality used by APScript and the chat_with_docs processor"""
+    def __init__(self, model, root:Path, ctx_size=4096):
+        self.model = model
+        self.name = "chat_with_docs"
+        self.personality_folder_name = "chat_with_docs"
+        self.personality_package_path = Path(__file__).resolve().parent.parent
+        self.help = ""
+        self.config = FakeConfig(ctx_size=ctx_size, debug=False, model_name="fake_model")
+        self.lollms_paths = types.SimpleNamespace(
+            personal_databases_path=root/"databases",
+            personal_uploads_path=root/"uploads",
+            personal_configuration_path=root/"configs",
+            personal_data_path=root/"data",
+        )
+        self.installation_option = None
+        self.app = None
+
+    def fast_gen(self, prompt, max_generation_size=None, placeholders={}, sacrifice=["previous_discussion"], debug=False, callback=None, show_progress=False):
+        return self.model.generate(prompt, max_generation_size or 128)
+
+
+def build_corpus(folder:Path, nb_docs, words_per_doc, nb_topics=50, seed=0):
+    """Documents are sentences drawn from a few topics, so queries have relevant chunks"""
+    rng = random.Random(seed)
+    vocabulary = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 9))) for _ in range(20000)]
+    topics = [rng.sample(vocabulary, 200) for _ in range(nb_topics)]
+    folder.mkdir(parents=True, exist_ok=True)
+    files = []
+    for d in range(nb_docs):
+        doc_topics = rng.sample(topics, 3)
+        sentences = []
+        nb_words = 0
+        while nb_words<words_per_doc:
+            sentence = [rng.choice(rng.choice(doc_topics)) for _ in range(rng.randint(6, 20))]
+            sentences.append(" ".join(sentence).capitalize()+".")
+            nb_words += len(sentence)
+        path = folder/f"doc_{d:05d}.txt"
+        path.write_text(" ".join(sentences), encoding="utf-8")
+        files.append(path)
+    questions = [" ".join(rng.sample(rng.choice(topics), 6))+"?" for _ in range(256)]
+    return files, questions
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak/(1024*1024) if sys.platform=="darwin" else peak/1024
+
+
+def percentile_ms(latencies, q):
+    return float(np.percentile(latencies, q)*1000) if len(latencies)>0 else 0.0
+
+
+def run_size(args, nb_docs):
+    processor_module = load_processor_module()
+    with tempfile.TemporaryDirectory() as root:
+        root = Path(root)
+        files, questions = build_corpus(root/"corpus", nb_docs, args.doc_words)
+        model = FakeModel(args.tokenize_latency_us, args.embed_latency_ms, args.token_latency_ms)
+        personality = FakePersonality(model, root, args.ctx_size)
+        processor = processor_module.Processor(personality)
+        for key, value in {
+                    "vectorization_method":args.vectorization_method,
+                    "search_index":args.search_index,
+                    "build_keywords":args.build_keywords,
+                    "max_chunk_size":args.chunk_size,
+                    "ingest_workers":args.ingest_workers,
+                    "query_cache_ttl":0,
+                    "save_db":False,
+                    "batch_mode_questions_file":str(root/"questions.txt"),
+                    "batch_mode_report_file":str(root/"report.md"),
+                }.items():
+            setattr(processor.personality_config, key, value)
+        processor.query_cache = processor_module.QueryCache(0)
+        # The processor talks to the UI through callbacks and to the model through generate/fast_gen,
+        # both are routed to the stand-ins
+        processor.callback = lambda *args, **kwargs: True
+        processor.generate = lambda prompt, max_size=128, *a, **k: model.generate(prompt, max_size)
+        processor.fast_gen = lambda prompt, max_generation_size=128, *a, **k: model.generate(prompt, max_generation_size)
+        processor.text_files = list(files)
+
+        start_time = time.perf_counter()
+        processor.build_db()
+        processor.vector_store.wait_for_compaction()
+        ingest_time = time.perf_counter()-start_time
+
+        query_latencies = []
+        for question in questions[:args.queries]:
+            start_time = time.perf_counter()
+            processor.chat_with_doc(question, f"!@>user: {question}")
+            query_latencies.append(time.perf_counter()-start_time)
+
+        (root/"questions.txt").write_text("\n".join(questions[:args.batch_questions]), encoding="utf-8")
+        start_time = time.perf_counter()
+        processor.process_batch("", "")
+        batch_time = time.perf_counter()-start_time
+
+        return {
+            "docs":nb_docs,
+            "chunks":len(processor.vector_store.chunks),
+            "ingest_docs_per_s":nb_docs/ingest_time,
+            "ingest_chunks_per_s":len(processor.vector_store.chunks)/ingest_time,
+            "query_p50_ms":percentile_ms(query_latencies, 50),
+            "query_p99_ms":percentile_ms(query_latencies, 99),
+            "batch_questions_per_min":60*args.batch_questions/batch_time,
+            "peak_rss_mb":peak_rss_mb(),
+            "model_calls":dict(model.calls),
+        }
+
+
+# Metrics where a higher value is better, the others are better when lower
+HIGHER_IS_BETTER = {"ingest_docs_per_s", "ingest_chunks_per_s", "batch_questions_per_min"}
+COMPARED_METRICS = ["ingest_docs_per_s", "query_p50_ms", "query_p99_ms", "batch_questions_per_min", "peak_rss_mb"]
+
+
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    baseline_by_size = {entry["docs"]:entry for entry in baseline}
+    for entry in results:
+        reference = baseline_by_size.get(entry["docs"])
+        if reference is None:
+            continue
+        for metric in COMPARED_METRICS:
+            if reference[metric]<=0:
+                continue
+            change = entry[metric]/reference[metric]-1
+            if (metric in HIGHER_IS_BETTER and change<-tolerance) or (metric not in HIGHER_IS_BETTER and change>tolerance):
+                regressions.append(f"{entry['docs']} docs: {metric} {reference[metric]:.2f} -> {entry[metric]:.2f} ({100*change:+.0f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="chat_with_docs ingest and query benchmark with a fake model binding")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000], help="Corpus sizes in documents")
+    parser.add_argument("--doc-words", type=int, default=1500)
+    parser.add_argument("--chunk-size", type=int, default=512)
+    parser.add_argument("--ctx-size", type=int, default=4096)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--batch-questions", type=int, default=20)
+    parser.add_argument("--build-keywords", action="store_true")
+    parser.add_argument("--vectorization-method", default="model_embedding", choices=["model_embedding", "tfidf_vectorizer"])
+    parser.add_argument("--search-index", default="exact", choices=["exact", "ivf"])
+    parser.add_argument("--ingest-workers", type=int, default=0)
+    parser.add_argument("--tokenize-latency-us", type=float, default=20)
+    parser.add_argument("--embed-latency-ms", type=float, default=1)
+    parser.add_argument("--token-latency-ms", type=float, default=0.5)
+    parser.add_argument("--save", type=str, default="", help="Writes the results to this json file")
+    parser.add_argument("--baseline", type=str, default="", help="json results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative change above which a metric counts as a regression")
+    parser.add_argument("--single-size", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single_size>0:
+        print(json.dumps(run_size(args, args.single_size)))
+        return
+
+    results = []
+    for nb_docs in args.sizes:
+        command = [sys.executable, __file__]+sys.argv[1:]+["--single-size", str(nb_docs)]
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().split("\n")[-1]))
+
+    print(f"{'docs':>6} {'chunks':>7} {'ingest docs/s':>14} {'chunks/s':>9} {'query p50 ms':>13} {'p99 ms':>8} {'batch q/min':>12} {'peak RSS MB':>12}")
+    for entry in results:
+        print(f"{entry['docs']:>6} {entry['chunks']:>7} {entry['ingest_docs_per_s']:>14.1f} {entry['ingest_chunks_per_s']:>9.1f} {entry['query_p50_ms']:>13.2f} {entry['query_p99_ms']:>8.2f} {entry['batch_questions_per_min']:>12.1f} {entry['peak_rss_mb']:>12.1f}")
+
+    if args.save!="":
+        Path(args.save).write_text(json.dumps(results, indent=2), encoding="utf-8")
+    if args.baseline!="":
+        regressions = find_regressions(results, json.loads(Path(args.baseline).read_text(encoding="utf-8")), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if len(regressions)>0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
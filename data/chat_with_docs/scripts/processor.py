@@ -7,6 +7,8 @@ from typing import Callable
 
 from ascii_colors import ASCIIColors, trace_exception
 from safe_store import TextVectorizer, VectorizationMethod, GenericDataLoader
+from safe_store.tfidf_loader import TFIDFLoader
+from safe_store.utils import NumpyEncoderDecoder
 
 import numpy as np
 import json
@@ -14,7 +16,1363 @@ from pathlib import Path
 import numpy as np
 import json
 import subprocess
+import hashlib
+import os
+import threading
+import queue
+import time
+import re
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from urllib.parse import quote
+import site
+
+
+# Modules shared by the personalities of the zoo live in its shared folder
+site.addsitedir(str(Path(__file__).resolve().parents[3]/"shared"))
+import text_chunking
+from embedding_tools import ProjectionCache, normalize_rows, top_k_indices
+
+
+def locate_chunks(text, chunk_texts, probe_size=64):
+    """
+    Returns the (start, end, page) of each chunk in text. Offsets are character offsets, -1 when
+    the chunk can't be found (the detokenized chunk text differs from the source). Pages are
+    counted from form feed characters, page is 0 when the text has none.
+    """
+    page_breaks = np.array([match.start() for match in re.finditer("\f", text)], dtype=np.int64)
+    sources = []
+    cursor = 0
+    for chunk_text in chunk_texts:
+        chunk_text = chunk_text.strip()
+        start = text.find(chunk_text[:probe_size], cursor) if chunk_text!="" else -1
+        if start<0 and chunk_text!="":
+            # Tokenizers may normalize the text, retry on a shorter probe
+            start = text.find(chunk_text[:min(probe_size//4, max(4, len(chunk_text)//2))], cursor)
+        if start<0:
+            sources.append((-1, -1, 0))
+            continue
+        tail = chunk_text[-probe_size:]
+        end = text.find(tail, start+max(0, len(chunk_text)-len(tail))//2)
+        end = end+len(tail) if end>=0 else min(len(text), start+len(chunk_text))
+        page = int(np.searchsorted(page_breaks, start, side="right"))+1 if len(page_breaks)>0 else 0
+        sources.append((start, end, page))
+        # Chunks may overlap, the next one starts after this start
+        cursor = start+1
+    return sources
+
+
+def text_overlap(previous, following, min_size=8):
+    """Length of the longest suffix of previous that is also a prefix of following"""
+    probe = following[:min_size]
+    if len(probe)<min_size:
+        return 0
+    position = previous.find(probe, max(0, len(previous)-len(following)))
+    while position>=0:
+        if following.startswith(previous[position:]):
+            return len(previous)-position
+        position = previous.find(probe, position+1)
+    return 0
+
+
+class IVFIndex:
+    """
+    Inverted file index for approximate nearest neighbour search on normalized embeddings.
+
+    The rows of the embedding matrix are clustered with spherical k-means; a search only scores
+    the rows of the nprobe clusters whose centroids are the closest to the query. Rows added
+    after the index was built (row >= nb_rows) are always scored, until the next build.
+    """
+    def __init__(self, nlist=None, n_iter=10, seed=0):
+        self.nlist = nlist
+        self.n_iter = n_iter
+        self.seed = seed
+        self.centroids = None
+        self.list_rows = None
+        self.list_offsets = None
+        self.nb_rows = 0
+
+    @property
+    def ready(self):
+        return self.centroids is not None
+
+    def _assign(self, matrix, block_size=65536):
+        labels = np.empty(matrix.shape[0], dtype=np.int64)
+        for start in range(0, matrix.shape[0], block_size):
+            labels[start:start+block_size] = np.argmax(matrix[start:start+block_size] @ self.centroids.T, axis=1)
+        return labels
+
+    def build(self, matrix):
+        nb_rows = matrix.shape[0]
+        nlist = self.nlist if self.nlist else max(1, int(np.sqrt(nb_rows)))
+        nlist = min(nlist, nb_rows)
+        rng = np.random.default_rng(self.seed)
+        # Train on a sample, 64 rows per list are plenty for the centroids to settle
+        sample = matrix[rng.choice(nb_rows, size=min(nb_rows, 64*nlist), replace=False)]
+        self.centroids = sample[rng.choice(sample.shape[0], size=nlist, replace=False)].copy()
+        for _ in range(self.n_iter):
+            labels = self._assign(sample)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=nlist)
+            empty = counts==0
+            # Reseed empty lists with random sample rows
+            sums[empty] = sample[rng.choice(sample.shape[0], size=int(empty.sum()))]
+            self.centroids = normalize_rows(sums)
+        labels = self._assign(matrix)
+        self.list_rows = np.argsort(labels, kind="stable")
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=nlist))])
+        self.nb_rows = nb_rows
+
+    def search(self, matrix, query_embeddings, top_k, nprobe):
+        """Returns (indices, scores) lists, one entry per query, best first"""
+        probes = top_k_indices(query_embeddings @ self.centroids.T, nprobe)
+        tail = np.arange(self.nb_rows, matrix.shape[0])
+        results = []
+        for query, query_probes in zip(query_embeddings, probes):
+            candidates = np.concatenate([self.list_rows[self.list_offsets[p]:self.list_offsets[p+1]] for p in query_probes]+[tail])
+            scores = matrix[candidates] @ query
+            best = top_k_indices(scores, top_k)
+            results.append((candidates[best], scores[best]))
+        return results
+
+    def save(self, path, ids_hash):
+        tmp_path = Path(str(path)+".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, centroids=self.centroids, list_rows=self.list_rows, list_offsets=self.list_offsets, nb_rows=self.nb_rows, ids_hash=ids_hash)
+        os.replace(tmp_path, path)
+
+    def load(self, path, ids_hash):
+        """
+        Loads the index if it was built for the same first rows, returns True on success.
+        ids_hash(nb_rows) returns the hash of the ids of the first nb_rows rows of the matrix.
+        """
+        with np.load(path) as data:
+            if int(data["nb_rows"])<=0 or str(data["ids_hash"])!=ids_hash(int(data["nb_rows"])):
+                return False
+            self.centroids = data["centroids"]
+            self.list_rows = data["list_rows"]
+            self.list_offsets = data["list_offsets"]
+            self.nb_rows = int(data["nb_rows"])
+        return True
+
+
+class BM25Index:
+    """
+    Okapi BM25 inverted index over the chunk texts, used as the first stage of the hybrid retrieval.
+
+    Each term maps to its postings (rows, term frequencies). Postings of new chunks are appended to
+    python lists and converted back to numpy arrays the first time a query needs them.
+    """
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.chunk_ids = []
+        self.rows = {}
+        self.doc_lengths = []
+        self.postings = {}
+        self._lengths = None
+
+    @staticmethod
+    def terms(text):
+        return re.findall(r"\w+", text.lower())
+
+    def __len__(self):
+        return len(self.chunk_ids)
+
+    def add(self, chunk_id, text):
+        """Indexes a new chunk, returns False if the chunk is already indexed"""
+        if chunk_id in self.rows:
+            return False
+        row = len(self.chunk_ids)
+        self.chunk_ids.append(chunk_id)
+        self.rows[chunk_id] = row
+        terms = BM25Index.terms(text)
+        self.doc_lengths.append(len(terms))
+        self._lengths = None
+        term_frequencies = {}
+        for term in terms:
+            term_frequencies[term] = term_frequencies.get(term, 0)+1
+        for term, frequency in term_frequencies.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                self.postings[term] = postings = ([], [])
+            elif isinstance(postings[0], np.ndarray):
+                self.postings[term] = postings = (postings[0].tolist(), postings[1].tolist())
+            postings[0].append(row)
+            postings[1].append(frequency)
+        return True
+
+    def _frozen_postings(self, term):
+        postings = self.postings[term]
+        if not isinstance(postings[0], np.ndarray):
+            postings = (np.array(postings[0], dtype=np.int64), np.array(postings[1], dtype=np.float32))
+            self.postings[term] = postings
+        return postings
+
+    def search(self, query, top_n):
+        """Returns the ids of the top_n chunks by BM25 score (chunks sharing no term with the query are left out)"""
+        if len(self.chunk_ids)==0:
+            return []
+        if self._lengths is None:
+            self._lengths = np.array(self.doc_lengths, dtype=np.float32)
+        lengths = self._lengths
+        average_length = max(float(lengths.mean()), 1.0)
+        scores = np.zeros(len(lengths), dtype=np.float32)
+        for term in set(BM25Index.terms(query)):
+            if term not in self.postings:
+                continue
+            rows, frequencies = self._frozen_postings(term)
+            idf = np.log(1+(len(lengths)-len(rows)+0.5)/(len(rows)+0.5))
+            scores[rows] += idf*frequencies*(self.k1+1)/(frequencies+self.k1*(1-self.b+self.b*lengths[rows]/average_length))
+        candidates = np.nonzero(scores)[0]
+        if len(candidates)>top_n:
+            candidates = candidates[np.argpartition(-scores[candidates], top_n-1)[:top_n]]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [self.chunk_ids[row] for row in candidates]
+
+    def snapshot(self):
+        """Flattened arrays of the index, ready to be saved"""
+        terms = list(self.postings.keys())
+        postings = [self._frozen_postings(term) for term in terms]
+        return {
+            "chunk_ids":np.array(self.chunk_ids, dtype=str),
+            "doc_lengths":np.array(self.doc_lengths, dtype=np.int64),
+            "terms":np.array(terms, dtype=str),
+            "offsets":np.cumsum([0]+[len(rows) for rows, _ in postings]),
+            "rows":np.concatenate([rows for rows, _ in postings]) if len(postings)>0 else np.zeros(0, dtype=np.int64),
+            "frequencies":np.concatenate([frequencies for _, frequencies in postings]) if len(postings)>0 else np.zeros(0, dtype=np.float32),
+        }
+
+    @staticmethod
+    def save(path, snapshot):
+        tmp_path = Path(str(path)+".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **snapshot)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        with np.load(path, allow_pickle=False) as data:
+            self.chunk_ids = data["chunk_ids"].tolist()
+            self.doc_lengths = data["doc_lengths"].tolist()
+            offsets = data["offsets"]
+            rows = data["rows"]
+            frequencies = data["frequencies"]
+            self.postings = {term:(rows[offsets[i]:offsets[i+1]], frequencies[offsets[i]:offsets[i+1]]) for i, term in enumerate(data["terms"].tolist())}
+        self.rows = {chunk_id:row for row, chunk_id in enumerate(self.chunk_ids)}
+        self._lengths = None
+
+
+class DocsVectorStore(TextVectorizer):
+    """
+    safe_store's TextVectorizer with incremental indexing.
+
+    - Only chunks that have no embeddings yet are embedded, so chunks restored from the
+      embedding cache are indexed without calling the model.
+    - Embeddings are mirrored in a normalized float32 matrix that new chunks are appended to,
+      searches are a single matrix product over it.
+    - New chunks are searchable right after index_chunks. The expensive whole-database work
+      (refitting the tf-idf vocabulary, rebuilding the ANN index, saving) is done by a background compaction.
+    - search_index="ivf" replaces the exhaustive search with an IVFIndex built at index time
+      and saved next to the database.
+    - hybrid=True searches a BM25Index first and only scores its candidates with the embeddings.
+    """
+    def __init__(self, *args, search_index="exact", ivf_nprobe=16, hybrid=False, bm25_candidates=200, **kwargs):
+        self.search_index = search_index
+        self.ivf_nprobe = ivf_nprobe
+        # Hybrid retrieval: BM25 preselects bm25_candidates chunks that are then scored with the
+        # embeddings. With model embeddings, chunks are only embedded once they are a candidate.
+        self.bm25 = BM25Index() if hybrid else None
+        self.bm25_candidates = bm25_candidates
+        self.ivf = None
+        self.lock = threading.RLock()
+        self._ids = []
+        self._rows = {}
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
+        self._matrix_ready = False
+        # Incremented every time the matrix rows are renumbered
+        self._matrix_generation = 0
+        self._compaction_thread = None
+        self._compaction_requested = False
+        # Uploads in a row are compacted once: compaction starts compaction_delay seconds after the last request
+        self.compaction_delay = 2.0
+        self._compaction_requested_at = 0
+        self._compaction_flush = False
+        # The IVF index is only rebuilt by a compaction once the rows added since the last build
+        # (scored exhaustively until then) exceed this fraction of the indexed rows
+        self.ivf_rebuild_ratio = 0.1
+        self._projections = {}
+        # Source table: one row of (doc id, chunk index, start, end, page) per chunk
+        self._documents = []
+        self._document_ids = {}
+        self._source_rows = {}
+        self._sources = np.zeros((0, 5), dtype=np.int64)
+        self._chunk_by_position = {}
+        # Incremented every time the searchable content changes
+        self.version = 0
+        super().__init__(*args, **kwargs)
+
+    def has_document(self, document_name):
+        return f"{document_name}_chunk_1" in self.chunks
+
+    def document_chunk_ids(self, document_name):
+        chunk_ids = []
+        while f"{document_name}_chunk_{len(chunk_ids)+1}" in self.chunks:
+            chunk_ids.append(f"{document_name}_chunk_{len(chunk_ids)+1}")
+        return chunk_ids
+
+    def document_chunks(self, document_name):
+        return [self.chunks[chunk_id] for chunk_id in self.document_chunk_ids(document_name)]
+
+    def add_document(self, document_name, text, chunk_size, overlap_size, force_vectorize=False, add_as_a_bloc=False):
+        """
+        Chunks the document with the shared text_chunking module (the base class tokenizes and
+        detokenizes sentence by sentence) and records where each chunk comes from.
+        """
+        if add_as_a_bloc or self.model is None:
+            super().add_document(document_name, text, chunk_size, overlap_size, force_vectorize, add_as_a_bloc)
+            chunk_ids = self.document_chunk_ids(document_name)
+            for chunk_id, (start, end, page) in zip(chunk_ids, locate_chunks(text, [self.chunks[chunk_id]["chunk_text"] for chunk_id in chunk_ids])):
+                self.chunks[chunk_id].update(start=start, end=end, page=page)
+            return
+        if self.has_document(document_name) and not force_vectorize:
+            print(f"Document {document_name} already exists. Skipping vectorization.")
+            return
+        chunks = text_chunking.chunk_document(text, chunk_size, self.model.tokenize, self.model.detokenize, overlap_size)
+        page_breaks = np.array([match.start() for match in re.finditer("\f", text)], dtype=np.int64)
+        pages = np.searchsorted(page_breaks, [chunk["start"] for chunk in chunks], side="right")+1 if len(page_breaks)>0 else np.zeros(len(chunks), dtype=np.int64)
+        for i, (chunk, page) in enumerate(zip(chunks, pages)):
+            self.chunks[f"{document_name}_chunk_{i + 1}"] = {
+                "document_name": str(document_name),
+                "chunk_index": i+1,
+                "chunk_text": chunk["text"],
+                "chunk_tokens": chunk["tokens"],
+                "embeddings": [],
+                "start": chunk["start"],
+                "end": chunk["end"],
+                "page": int(page)
+            }
+
+    def _register_sources(self, chunk_ids):
+        for chunk_id in chunk_ids:
+            chunk = self.chunks.get(chunk_id)
+            if chunk is None:
+                continue
+            document_name = str(chunk["document_name"])
+            doc_id = self._document_ids.get(document_name)
+            if doc_id is None:
+                doc_id = len(self._documents)
+                self._documents.append(document_name)
+                self._document_ids[document_name] = doc_id
+            row = self._source_rows.get(chunk_id)
+            if row is None:
+                row = len(self._source_rows)
+                self._source_rows[chunk_id] = row
+                if row>=self._sources.shape[0]:
+                    grown = np.zeros((max(64, 2*self._sources.shape[0]), 5), dtype=np.int64)
+                    grown[:self._sources.shape[0]] = self._sources
+                    self._sources = grown
+            self._sources[row] = (doc_id, chunk["chunk_index"], chunk.get("start", -1), chunk.get("end", -1), chunk.get("page", 0))
+            self._chunk_by_position[(doc_id, int(chunk["chunk_index"]))] = chunk_id
+
+    def _reset_sources(self):
+        self._documents = []
+        self._document_ids = {}
+        self._source_rows = {}
+        self._sources = np.zeros((0, 5), dtype=np.int64)
+        self._chunk_by_position = {}
+
+    def chunk_source(self, chunk_id):
+        """Returns (document name, chunk index, start, end, page) of an indexed chunk"""
+        with self.lock:
+            row = self._source_rows.get(chunk_id)
+            if row is None:
+                self._register_sources([chunk_id])
+                row = self._source_rows[chunk_id]
+            doc_id, chunk_index, start, end, page = self._sources[row].tolist()
+            return self._documents[doc_id], chunk_index, start, end, page
+
+    def chunk_position(self, chunk_id):
+        """(document, chunk index) of a chunk, chunks of a document with consecutive indices are contiguous"""
+        return tuple(self.chunk_source(chunk_id)[:2])
+
+    @property
+    def embeds_with_model(self):
+        """True when a search calls the model binding (only tf-idf stores are searched without it)"""
+        return self.vectorization_method!=VectorizationMethod.TFIDF_VECTORIZER
+
+    def adjacent_chunk_id(self, chunk_id, offset):
+        """Id of the chunk offset positions away from chunk_id in its document, None if there is none"""
+        with self.lock:
+            if chunk_id not in self._source_rows:
+                self._register_sources([chunk_id])
+            doc_id, chunk_index = self._sources[self._source_rows[chunk_id], :2].tolist()
+            return self._chunk_by_position.get((doc_id, chunk_index+offset))
+
+    def neighbour_chunk_ids(self, chunk_id, before=1, after=1):
+        """Ids of the chunks around chunk_id in its document, in document order (chunk_id included)"""
+        with self.lock:
+            if chunk_id not in self._source_rows:
+                self._register_sources([chunk_id])
+            doc_id, chunk_index = self._sources[self._source_rows[chunk_id], :2].tolist()
+            return [self._chunk_by_position[(doc_id, i)] for i in range(chunk_index-before, chunk_index+after+1) if (doc_id, i) in self._chunk_by_position]
+
+    def _embed_chunks(self, chunk_ids):
+        if len(chunk_ids)==0:
+            return
+        self._register_sources(chunk_ids)
+        for chunk_id in chunk_ids:
+            if chunk_id in self.chunks:
+                self.chunks[chunk_id]["nb_tokens"] = len(self.chunks[chunk_id]["chunk_tokens"])
+                if self.bm25 is not None:
+                    self.bm25.add(chunk_id, self.chunks[chunk_id]["chunk_text"])
+        if self.vectorization_method==VectorizationMethod.TFIDF_VECTORIZER:
+            if not hasattr(self.vectorizer, "vocabulary_"):
+                # First documents: fit the vocabulary on what we have, compaction refits it later
+                self.vectorizer.fit([chunk["chunk_text"] for chunk in self.chunks.values()])
+                self.infos["tfidf_fit_key"] = self.tfidf_fit_key()
+            chunk_ids = [chunk_id for chunk_id in chunk_ids if chunk_id in self.chunks]
+            vectors = self.vectorizer.transform([self.chunks[chunk_id]["chunk_text"] for chunk_id in chunk_ids])
+            for i, chunk_id in enumerate(chunk_ids):
+                self.chunks[chunk_id]["embeddings"] = vectors[i].toarray()
+        elif self.bm25 is None:
+            self._embed_with_model(chunk_ids)
+
+    def _embed_with_model(self, chunk_ids):
+        """Embeds the chunks that have no embeddings yet, returns the ids of the embedded chunks"""
+        embedded_ids = []
+        for chunk_id in chunk_ids:
+            chunk = self.chunks[chunk_id]
+            if len(chunk["embeddings"])==0:
+                try:
+                    chunk["embeddings"] = self.model.embed(chunk["chunk_text"])
+                    embedded_ids.append(chunk_id)
+                except Exception as ex:
+                    ASCIIColors.error(f"Couldn't embed chunk {chunk_id}: {ex}")
+        return embedded_ids
+
+    def _embed_missing(self, chunk_ids):
+        """
+        Embeds the chunks of chunk_ids that have no embeddings yet and appends them to the search
+        matrix. The model is called without holding the lock so searches and the compaction are
+        not blocked, the embeddings are stored afterwards if the chunks are still there.
+        """
+        with self.lock:
+            missing = [(chunk_id, self.chunks[chunk_id]["chunk_text"]) for chunk_id in chunk_ids if chunk_id in self.chunks and len(self.chunks[chunk_id]["embeddings"])==0]
+        vectors = {}
+        for chunk_id, chunk_text in missing:
+            try:
+                vectors[chunk_id] = self.model.embed(chunk_text)
+            except Exception as ex:
+                ASCIIColors.error(f"Couldn't embed chunk {chunk_id}: {ex}")
+        if len(vectors)==0:
+            return
+        with self.lock:
+            embedded_ids = []
+            for chunk_id, chunk_text in missing:
+                chunk = self.chunks.get(chunk_id)
+                if chunk_id in vectors and chunk is not None and chunk["chunk_text"]==chunk_text and len(chunk["embeddings"])==0:
+                    chunk["embeddings"] = vectors[chunk_id]
+                    embedded_ids.append(chunk_id)
+            if len(embedded_ids)>0 and self._matrix_ready:
+                self._append_rows(embedded_ids)
+
+    def _rebuild_bm25(self):
+        self.bm25 = BM25Index()
+        for chunk_id, chunk in self.chunks.items():
+            self.bm25.add(chunk_id, chunk["chunk_text"])
+
+    def tfidf_fit_key(self):
+        """
+        Identifies the set of chunks a tf-idf vocabulary is fitted on. It is saved in infos with the
+        fitted vectorizer so an unchanged database is never refitted, even after a restart.
+        """
+        return hashlib.sha256("\n".join(sorted(self.chunks.keys())).encode("utf-8")).hexdigest()
+
+    def index(self):
+        if self.vectorization_method not in [VectorizationMethod.MODEL_EMBEDDING, VectorizationMethod.TFIDF_VECTORIZER]:
+            return super().index()
+        with self.lock:
+            if self.bm25 is not None:
+                # Only the chunks without embeddings go through _embed_chunks, index every text here
+                self._rebuild_bm25()
+            if self.vectorization_method==VectorizationMethod.TFIDF_VECTORIZER:
+                fit_key = self.tfidf_fit_key()
+                if self.infos.get("tfidf_fit_key")==fit_key and hasattr(self.vectorizer, "vocabulary_"):
+                    self._embed_chunks([chunk_id for chunk_id, chunk in self.chunks.items() if len(chunk["embeddings"])==0])
+                else:
+                    self.vectorizer.fit([chunk["chunk_text"] for chunk in self.chunks.values()])
+                    self.infos["tfidf_fit_key"] = fit_key
+                    self._embed_chunks(list(self.chunks.keys()))
+            else:
+                self._embed_chunks(list(self.chunks.keys()))
+            self._matrix_ready = False
+            self.ready = True
+            self.version += 1
+        self.build_ann_index()
+        if self.save_db:
+            self.save_to_json()
+
+    def index_chunks(self, chunk_ids, compact=True):
+        """
+        Embeds the given chunks and appends them to the search matrix without touching the rest
+        of the database, then schedules a background compaction unless compact is False.
+        """
+        if self.vectorization_method not in [VectorizationMethod.MODEL_EMBEDDING, VectorizationMethod.TFIDF_VECTORIZER]:
+            return self.index()
+        with self.lock:
+            self._embed_chunks(chunk_ids)
+            if self._matrix_ready:
+                self._append_rows(chunk_ids)
+            self.ready = True
+            self.version += 1
+        if compact:
+            self.schedule_compaction()
+
+    def chunk_token_counts(self, chunk_ids):
+        """Number of tokens of each chunk, as counted when the chunk was indexed"""
+        counts = []
+        for chunk_id in chunk_ids:
+            chunk = self.chunks[chunk_id]
+            if "nb_tokens" not in chunk:
+                chunk["nb_tokens"] = len(chunk["chunk_tokens"])
+            counts.append(chunk["nb_tokens"])
+        return counts
+
+    def _append_rows(self, chunk_ids):
+        chunk_ids = [chunk_id for chunk_id in chunk_ids if chunk_id in self.chunks and len(self.chunks[chunk_id]["embeddings"])>0]
+        if len(chunk_ids)==0:
+            return
+        vectors = normalize_rows(np.vstack([np.asarray(self.chunks[chunk_id]["embeddings"], dtype=np.float32).reshape(1, -1) for chunk_id in chunk_ids]))
+        if len(self._ids)==0:
+            self._matrix = np.zeros((max(16, len(chunk_ids)), vectors.shape[1]), dtype=np.float32)
+        elif vectors.shape[1]!=self._matrix.shape[1]:
+            # Embedding size changed (new vocabulary or new model), start over
+            self._matrix_ready = False
+            return
+        rows = []
+        for chunk_id in chunk_ids:
+            row = self._rows.get(chunk_id)
+            if row is None:
+                row = len(self._ids)
+                self._ids.append(chunk_id)
+                self._rows[chunk_id] = row
+            rows.append(row)
+        if len(self._ids)>self._matrix.shape[0]:
+            grown = np.zeros((max(2*self._matrix.shape[0], len(self._ids)), self._matrix.shape[1]), dtype=np.float32)
+            grown[:self._matrix.shape[0]] = self._matrix
+            self._matrix = grown
+        self._matrix[rows] = vectors
+
+    def _ensure_matrix(self):
+        if not self._matrix_ready:
+            self._ids = []
+            self._rows = {}
+            self._matrix = np.zeros((0, 0), dtype=np.float32)
+            self._matrix_ready = True
+            self._matrix_generation += 1
+            self.ivf = None
+            self._append_rows(list(self.chunks.keys()))
+            if self.search_index=="ivf" and len(self._ids)>0 and self.database_file is not None and self.ann_index_path().exists():
+                ivf = IVFIndex()
+                try:
+                    if ivf.load(self.ann_index_path(), self._ids_hash):
+                        self.ivf = ivf
+                except Exception as ex:
+                    ASCIIColors.warning(f"Couldn't load the ANN index: {ex}")
+
+    def _ids_hash(self, nb_rows=None):
+        return hashlib.sha256("\n".join(self._ids[:nb_rows]).encode("utf-8")).hexdigest()
+
+    def ann_index_path(self):
+        return Path(str(self.database_file)+".ivf.npz")
+
+    def build_ann_index(self, only_if_stale=False):
+        """
+        (Re)builds the IVF index over the current matrix and saves it next to the database.
+        With only_if_stale, an index that still covers most of the rows is kept.
+        """
+        if self.search_index!="ivf":
+            return
+        with self.lock:
+            self._ensure_matrix()
+            if only_if_stale and self.ivf is not None and self.ivf.ready and len(self._ids)-self.ivf.nb_rows<=self.ivf_rebuild_ratio*self.ivf.nb_rows:
+                return
+            ids = list(self._ids)
+            matrix = self._matrix[:len(ids)]
+            generation = self._matrix_generation
+        if len(ids)==0:
+            return
+        start_time = time.perf_counter()
+        ivf = IVFIndex()
+        ivf.build(matrix)
+        with self.lock:
+            if self._matrix_generation!=generation or not self._matrix_ready:
+                # The matrix was rebuilt in the meantime, the rows don't match anymore
+                return
+            self.ivf = ivf
+        ASCIIColors.info(f"ANN index built over {len(ids)} chunks in {time.perf_counter()-start_time:.2f}s")
+        if self.save_db and self.database_file is not None:
+            ivf.save(self.ann_index_path(), hashlib.sha256("\n".join(ids).encode("utf-8")).hexdigest())
+
+    def projection_basis(self):
+        """Identifies the embedding space, tf-idf coordinates change with every vocabulary refit"""
+        if self.vectorization_method==VectorizationMethod.TFIDF_VECTORIZER:
+            vocabulary = sorted(getattr(self.vectorizer, "vocabulary_", {}).items(), key=lambda entry:entry[1])
+            return "tfidf:"+hashlib.sha256("\n".join(word for word, _ in vocabulary).encode("utf-8")).hexdigest()
+        return self.vectorization_method.value
+
+    def projection_2d(self, method="PCA"):
+        """Returns (chunk_ids, 2-D points) from the projection cache, see ProjectionCache"""
+        with self.lock:
+            chunk_ids, matrix = self.search_matrix()
+            basis = self.projection_basis()
+            if method not in self._projections:
+                self._projections[method] = ProjectionCache(Path(f"{self.database_file}.{method.lower()}.npz") if self.save_db and self.database_file is not None else None)
+        if len(chunk_ids)<2:
+            return chunk_ids, np.zeros((len(chunk_ids), 2), dtype=np.float32)
+        return chunk_ids, self._projections[method].project(method, basis, chunk_ids, matrix)
+
+    def show_document(self, query_text=None, save_fig_path=None, show_interactive_form=False, add_hover_detection=False, add_click_detection=False, method="PCA"):
+        """
+        Plots the chunks, one color per document, using the cached 2-D projection.
+        The click handler opens tk windows and is left to the base implementation.
+        """
+        if add_click_detection or self.vectorization_method not in [VectorizationMethod.MODEL_EMBEDDING, VectorizationMethod.TFIDF_VECTORIZER]:
+            return super().show_document(query_text, save_fig_path, show_interactive_form, add_hover_detection, add_click_detection)
+        import matplotlib.pyplot as plt
+        if save_fig_path is None and show_interactive_form==False:
+            raise Exception("[show_document] parameters error. Either select a save_fig_path to save the graph or set show_interactive_form to True")
+        start_time = time.perf_counter()
+        chunk_ids, points = self.projection_2d(method)
+        if len(chunk_ids)<2:
+            return
+        ASCIIColors.info(f"2D projection ({method}) of {len(chunk_ids)} chunks ready in {time.perf_counter()-start_time:.2f}s")
+        documents = [self.chunks[chunk_id]["document_name"] for chunk_id in chunk_ids]
+        plt.figure()
+        for document in dict.fromkeys(documents):
+            rows = [i for i, name in enumerate(documents) if name==document]
+            plt.scatter(points[rows, 0], points[rows, 1], label=Path(document).stem, marker="o")
+        if len(chunk_ids)<=500:
+            # Point labels are unreadable and slow to draw on large databases
+            for chunk_id, (x, y) in zip(chunk_ids, points):
+                plt.text(x, y, chunk_id.split("_")[-1], fontsize=8)
+        if query_text is not None:
+            query_point = self._projections[method].project_query(self.embed_queries([query_text])[0])
+            if query_point is not None:
+                plt.scatter([query_point[0]], [query_point[1]], color="red", marker="x", label="Query")
+        plt.legend(title='Document Name', loc='upper right')
+        plt.xlabel('Dimension 1')
+        plt.ylabel('Dimension 2')
+        plt.title('Embeddings Scatter Plot based on PCA' if method=="PCA" else 'Embeddings Scatter Plot based on t-SNE')
+        if add_hover_detection:
+            import mplcursors
+            import textwrap
+            cursor = mplcursors.cursor(hover=True)
+            @cursor.connect("add")
+            def on_hover(sel):
+                distances = np.sum((points-np.asarray(sel.target))**2, axis=1)
+                chunk_id = chunk_ids[int(np.argmin(distances))]
+                sel.annotation.set_text(f"{chunk_id}\nText:\n{textwrap.fill(self.chunks[chunk_id]['chunk_text'], width=50)}")
+        if save_fig_path:
+            try:
+                plt.savefig(save_fig_path)
+            except Exception as ex:
+                trace_exception(ex)
+        if show_interactive_form:
+            plt.show()
+        else:
+            plt.close()
+
+    def search_matrix(self):
+        """Returns (chunk_ids, normalized embeddings matrix) for the indexed chunks"""
+        with self.lock:
+            self._ensure_matrix()
+            return list(self._ids), self._matrix[:len(self._ids)]
+
+    def embed_queries(self, queries):
+        if self.vectorization_method==VectorizationMethod.TFIDF_VECTORIZER:
+            return normalize_rows(self.vectorizer.transform(queries).toarray())
+        return normalize_rows(np.vstack([np.asarray(self.embed_query(query), dtype=np.float32).reshape(1, -1) for query in queries]))
+
+    def recover_text(self, query, top_k=3):
+        if self.vectorization_method not in [VectorizationMethod.MODEL_EMBEDDING, VectorizationMethod.TFIDF_VECTORIZER]:
+            return super().recover_text(query, top_k)
+        return self.recover_texts([query], top_k)[0]
+
+    def recover_texts(self, queries, top_k=3, query_embeddings=None):
+        """
+        Batch version of recover_text: a single similarity pass (one matrix product) for all the queries.
+        query_embeddings can be given when the queries were already embedded with the same model
+        (tf-idf queries are always embedded here, the vocabulary belongs to the database).
+
+        Returns a list of (texts, sorted_similarities), one per query.
+        """
+        if self.vectorization_method not in [VectorizationMethod.MODEL_EMBEDDING, VectorizationMethod.TFIDF_VECTORIZER]:
+            return [super(DocsVectorStore, self).recover_text(query, top_k) for query in queries]
+        if query_embeddings is not None and self.vectorization_method==VectorizationMethod.MODEL_EMBEDDING:
+            with self.lock:
+                chunk_ids, matrix = self.search_matrix()
+                ivf = self.ivf
+        elif self.vectorization_method==VectorizationMethod.TFIDF_VECTORIZER:
+            # The vocabulary may be swapped by a compaction, embed the queries with the matching one
+            with self.lock:
+                query_embeddings = self.embed_queries(queries)
+                chunk_ids, matrix = self.search_matrix()
+                ivf = self.ivf
+        else:
+            query_embeddings = self.embed_queries(queries)
+            with self.lock:
+                chunk_ids, matrix = self.search_matrix()
+                ivf = self.ivf
+        if self.bm25 is not None:
+            return self._hybrid_search(queries, query_embeddings, top_k)
+        if len(chunk_ids)==0:
+            return [([], []) for _ in queries]
+        if ivf is not None and ivf.ready:
+            hits = ivf.search(matrix, query_embeddings, top_k, self.ivf_nprobe)
+        else:
+            scores = query_embeddings @ matrix.T
+            hits = [(indices, query_scores[indices]) for query_scores, indices in zip(scores, top_k_indices(scores, top_k))]
+        results = []
+        for indices, scores in hits:
+            sorted_similarities = [(chunk_ids[i], float(score)) for i, score in zip(indices, scores)]
+            results.append(([self.chunks[chunk_id]["chunk_text"] for chunk_id, _ in sorted_similarities], sorted_similarities))
+        return results
+
+    def _hybrid_search(self, queries, query_embeddings, top_k):
+        """
+        Ranks the BM25 candidates of each query with the embeddings. When BM25 returns fewer than
+        top_k candidates (few or no terms in common with the query) every chunk is scored instead,
+        with model embeddings this embeds the chunks that were never a candidate.
+        """
+        results = []
+        for query, query_embedding in zip(queries, query_embeddings):
+            with self.lock:
+                candidates = self.bm25.search(query, max(self.bm25_candidates, top_k))
+                nb_chunks = len(self.chunks)
+            if self.vectorization_method==VectorizationMethod.MODEL_EMBEDDING:
+                self._embed_missing(candidates)
+            with self.lock:
+                chunk_ids, matrix = self.search_matrix()
+                rows = np.array([self._rows[chunk_id] for chunk_id in candidates if chunk_id in self._rows], dtype=np.int64)
+            if len(rows)<min(top_k, nb_chunks):
+                if self.vectorization_method==VectorizationMethod.MODEL_EMBEDDING:
+                    with self.lock:
+                        all_ids = list(self.chunks.keys())
+                    self._embed_missing(all_ids)
+                with self.lock:
+                    chunk_ids, matrix = self.search_matrix()
+                    rows = np.arange(len(chunk_ids))
+            if len(rows)==0:
+                results.append(([], []))
+                continue
+            scores = matrix[rows] @ query_embedding
+            best = top_k_indices(scores[None, :], top_k)[0]
+            with self.lock:
+                sorted_similarities = [(chunk_ids[rows[i]], float(scores[i])) for i in best if chunk_ids[rows[i]] in self.chunks]
+                results.append(([self.chunks[chunk_id]["chunk_text"] for chunk_id, _ in sorted_similarities], sorted_similarities))
+        return results
+
+    def bm25_index_path(self):
+        return Path(str(self.database_file)+".bm25.npz")
+
+    def memory_size(self):
+        """Estimated memory used by the database in bytes: texts, embeddings and search structures"""
+        with self.lock:
+            size = self._matrix.nbytes + self._sources.nbytes
+            for chunk in self.chunks.values():
+                size += len(chunk["chunk_text"])
+                embeddings = chunk.get("embeddings")
+                if embeddings is not None:
+                    # Embeddings loaded from json are lists of python floats (~32 bytes per value)
+                    size += embeddings.nbytes if isinstance(embeddings, np.ndarray) else 32*np.size(embeddings)
+            if self.ivf is not None and self.ivf.ready:
+                size += self.ivf.centroids.nbytes + self.ivf.list_rows.nbytes
+            if self.bm25 is not None:
+                size += sum(64+16*len(rows) for rows, _ in self.bm25.postings.values())
+        return size
+
+    def schedule_compaction(self):
+        with self.lock:
+            self._compaction_requested = True
+            self._compaction_requested_at = time.monotonic()
+            if self._compaction_thread is None:
+                self._compaction_thread = threading.Thread(target=self._compaction_loop, daemon=True)
+                self._compaction_thread.start()
+
+    def wait_for_compaction(self):
+        """Runs the pending compaction now (without waiting for compaction_delay) and waits for it"""
+        with self.lock:
+            thread = self._compaction_thread
+            if thread is not None:
+                self._compaction_flush = True
+        if thread is not None:
+            thread.join()
+
+    def _compaction_loop(self):
+        while True:
+            with self.lock:
+                if not self._compaction_requested:
+                    self._compaction_thread = None
+                    self._compaction_flush = False
+                    return
+                delay = 0 if self._compaction_flush else self._compaction_requested_at+self.compaction_delay-time.monotonic()
+                if delay<=0:
+                    self._compaction_requested = False
+            if delay>0:
+                time.sleep(min(delay, 0.1))
+                continue
+            try:
+                self.compact()
+            except Exception as ex:
+                ASCIIColors.error(f"Database compaction failed: {ex}")
+                trace_exception(ex)
+
+    def compact(self):
+        """
+        Refits the tf-idf vocabulary on the whole database (new chunks were transformed with the
+        previous one) unless it was already fitted on these chunks, and saves the database.
+        Runs outside the lock except for the final swap.
+        """
+        if self.vectorization_method==VectorizationMethod.TFIDF_VECTORIZER:
+            from sklearn.feature_extraction.text import TfidfVectorizer
+            with self.lock:
+                chunk_ids = list(self.chunks.keys())
+                texts = [self.chunks[chunk_id]["chunk_text"] for chunk_id in chunk_ids]
+                fit_key = self.tfidf_fit_key()
+                already_fitted = self.infos.get("tfidf_fit_key")==fit_key and hasattr(self.vectorizer, "vocabulary_")
+            if len(texts)>0 and not already_fitted:
+                vectorizer = TfidfVectorizer()
+                vectors = vectorizer.fit_transform(texts)
+                with self.lock:
+                    self.vectorizer = vectorizer
+                    self.infos["tfidf_fit_key"] = fit_key
+                    for i, chunk_id in enumerate(chunk_ids):
+                        if chunk_id in self.chunks:
+                            self.chunks[chunk_id]["embeddings"] = vectors[i].toarray()
+                    # Chunks added while we were fitting still use the previous vocabulary
+                    fitted_ids = set(chunk_ids)
+                    late_ids = [chunk_id for chunk_id in self.chunks if chunk_id not in fitted_ids]
+                    self._embed_chunks(late_ids)
+                    self._matrix_ready = False
+                    self.version += 1
+        self.build_ann_index(only_if_stale=True)
+        if self.save_db:
+            self.save_to_json()
+
+    def save_to_json(self):
+        with self.lock:
+            # Indexing adds keys to the chunk dicts and replaces their embeddings, so each chunk
+            # is copied: json.dump runs outside the lock
+            state = {
+                "chunks": {chunk_id:dict(chunk) for chunk_id, chunk in self.chunks.items()},
+                "infos": dict(self.infos),
+                "vectorizer": TFIDFLoader.create_dict_from_vectorizer(self.vectorizer) if self.vectorization_method==VectorizationMethod.TFIDF_VECTORIZER else None
+            }
+            bm25_snapshot = self.bm25.snapshot() if self.bm25 is not None else None
+        if bm25_snapshot is not None:
+            BM25Index.save(self.bm25_index_path(), bm25_snapshot)
+        tmp_file = Path(str(self.database_file)+".tmp")
+        with open(tmp_file, "w") as f:
+            json.dump(state, f, cls=NumpyEncoderDecoder)
+        os.replace(tmp_file, self.database_file)
+
+    def load_from_json(self):
+        with self.lock:
+            super().load_from_json()
+            self._reset_sources()
+            self._register_sources(list(self.chunks.keys()))
+            if self.bm25 is not None:
+                self.bm25 = BM25Index()
+                if self.bm25_index_path().exists():
+                    try:
+                        self.bm25.load(self.bm25_index_path())
+                    except Exception as ex:
+                        ASCIIColors.warning(f"Couldn't load the BM25 index: {ex}")
+                        self.bm25 = BM25Index()
+                if set(self.bm25.chunk_ids)!=set(self.chunks.keys()):
+                    # Stale or missing index, rebuilding it only reads the chunk texts
+                    self._rebuild_bm25()
+            self._matrix_ready = False
+            self.version += 1
+
+    def clear_database(self):
+        self.wait_for_compaction()
+        with self.lock:
+            super().clear_database()
+            self._reset_sources()
+            if self.bm25 is not None:
+                self.bm25 = BM25Index()
+            if self.vectorization_method==VectorizationMethod.TFIDF_VECTORIZER:
+                from sklearn.feature_extraction.text import TfidfVectorizer
+                self.vectorizer = TfidfVectorizer()
+            self._matrix_ready = False
+            self.version += 1
+
+
+class CollectionManager:
+    """
+    Named collections of documents, each one a DocsVectorStore with its own files in
+    <root_folder>/<name>/db.json.
+
+    Collections are opened on demand. When the open collections use more than memory_budget
+    bytes (see DocsVectorStore.memory_size), the least recently used ones are closed, except the
+    active collection that documents are added to.
+    """
+    NAME_PATTERN = re.compile(r"^[\w\- ]+$")
+
+    def __init__(self, root_folder:Path, open_store:Callable[[Path], DocsVectorStore], memory_budget:int):
+        self.root_folder = Path(root_folder)
+        self.open_store = open_store
+        self.memory_budget = memory_budget
+        self.active = None
+        self.lock = threading.Lock()
+        self._stores = OrderedDict()
+        self._sizes = {}
+        # Version of each store when it was opened, unchanged stores are not saved again on close
+        self._opened_versions = {}
+
+    def names(self):
+        """Names of the collections on disk and of the open ones"""
+        names = set(self._stores.keys())
+        if self.root_folder.exists():
+            names.update(folder.name for folder in self.root_folder.iterdir() if folder.is_dir())
+        return sorted(names)
+
+    def get(self, name):
+        """Returns the store of a collection, opening (or creating) it if needed"""
+        name = name.strip()
+        if not CollectionManager.NAME_PATTERN.match(name):
+            raise ValueError(f"Invalid collection name: {name!r} (use letters, digits, spaces, - and _)")
+        with self.lock:
+            store = self._stores.get(name)
+            if store is not None:
+                self._stores.move_to_end(name)
+                return store
+        folder = self.root_folder/name
+        folder.mkdir(parents=True, exist_ok=True)
+        # Loading a large collection takes a while, don't block the other collections meanwhile
+        store = self.open_store(folder/"db.json")
+        with self.lock:
+            if name in self._stores:
+                store = self._stores[name]
+            else:
+                self._stores[name] = store
+                self._opened_versions[name] = store.version
+            self._stores.move_to_end(name)
+            self._sizes[name] = store.memory_size()
+            closed = self._evict(keep=name)
+        for closed in closed:
+            self._close_store(*closed)
+        return store
+
+    def update_size(self, name):
+        """Updates the memory estimate of a collection after documents were added to it"""
+        with self.lock:
+            store = self._stores.get(name)
+            if store is None:
+                return
+            self._sizes[name] = store.memory_size()
+            closed = self._evict(keep=name)
+        for closed in closed:
+            self._close_store(*closed)
+
+    def _evict(self, keep):
+        closed = []
+        total = sum(self._sizes.values())
+        for name in list(self._stores.keys()):
+            if total<=self.memory_budget:
+                break
+            if name==keep or name==self.active:
+                continue
+            closed.append((name, self._stores.pop(name), self._opened_versions.pop(name)))
+            total -= self._sizes.pop(name)
+        return closed
+
+    def _close_store(self, name, store, opened_version):
+        store.wait_for_compaction()
+        if store.save_db and store.version!=opened_version:
+            store.save_to_json()
+        ASCIIColors.info(f"Closed collection {name} ({self.memory_usage()/1024/1024:.0f}MB used by the open collections)")
+
+    def close(self, name):
+        with self.lock:
+            store = self._stores.pop(name, None)
+            self._sizes.pop(name, None)
+            opened_version = self._opened_versions.pop(name, None)
+        if store is not None:
+            self._close_store(name, store, opened_version)
+
+    def open_names(self):
+        with self.lock:
+            return list(self._stores.keys())
+
+    def memory_usage(self):
+        with self.lock:
+            return sum(self._sizes.values())
+
+
+class CollectionsView:
+    """
+    Read only view over several collections with the part of the DocsVectorStore interface used
+    to answer questions. Chunk ids are qualified with the collection: <collection>::<chunk id>.
+
+    recover_texts searches the collections in parallel threads (the similarity products release
+    the GIL) and merges their results into a global top k by score. With model embeddings the
+    queries are embedded once and shared by all the collections.
+
+    A view is made for one question or one batch: it keeps the stores it used so they stay
+    usable until it is dropped, even if the manager closed them in the meantime.
+    """
+    SEPARATOR = "::"
+
+    def __init__(self, manager:CollectionManager, names, max_workers=4):
+        self.manager = manager
+        self.names = list(names)
+        self.max_workers = max_workers
+        self.chunks = CollectionsView.Chunks(self)
+        self._stores = {}
+
+    def store(self, name):
+        store = self._stores.get(name)
+        if store is None:
+            store = self._stores[name] = self.manager.get(name)
+        return store
+
+    class Chunks:
+        """chunks mapping of the view, the values are read from the collections"""
+        def __init__(self, view):
+            self.view = view
+
+        def __getitem__(self, chunk_id):
+            store, local_id = self.view.resolve(chunk_id)
+            return store.chunks[local_id]
+
+        def __contains__(self, chunk_id):
+            name, _, local_id = chunk_id.partition(CollectionsView.SEPARATOR)
+            return name in self.view.names and local_id in self.view.store(name).chunks
+
+        def __len__(self):
+            return sum(len(self.view.store(name).chunks) for name in self.view.names)
+
+    def qualify(self, name, chunk_id):
+        return f"{name}{CollectionsView.SEPARATOR}{chunk_id}"
+
+    def resolve(self, chunk_id):
+        """Returns (store, chunk id in the store) of a qualified chunk id"""
+        name, _, local_id = chunk_id.partition(CollectionsView.SEPARATOR)
+        return self.store(name), local_id
+
+    @property
+    def ready(self):
+        return any(self.store(name).ready for name in self.names)
+
+    @property
+    def version(self):
+        return tuple((name, self.store(name).version) for name in self.names)
+
+    @property
+    def embeds_with_model(self):
+        return any(self.store(name).embeds_with_model for name in self.names)
+
+    def chunk_token_counts(self, chunk_ids):
+        counts = []
+        for chunk_id in chunk_ids:
+            store, local_id = self.resolve(chunk_id)
+            counts += store.chunk_token_counts([local_id])
+        return counts
+
+    def chunk_source(self, chunk_id):
+        store, local_id = self.resolve(chunk_id)
+        return store.chunk_source(local_id)
+
+    def chunk_position(self, chunk_id):
+        # Documents of the same name in two collections are different documents
+        name, _, local_id = chunk_id.partition(CollectionsView.SEPARATOR)
+        document_name, chunk_index = self.store(name).chunk_position(local_id)
+        return (name, document_name), chunk_index
+
+    def adjacent_chunk_id(self, chunk_id, offset):
+        name, _, local_id = chunk_id.partition(CollectionsView.SEPARATOR)
+        adjacent_id = self.store(name).adjacent_chunk_id(local_id, offset)
+        return None if adjacent_id is None else self.qualify(name, adjacent_id)
+
+    def recover_text(self, query, top_k=3):
+        return self.recover_texts([query], top_k)[0]
+
+    def recover_texts(self, queries, top_k=3):
+        stores = {name:self.store(name) for name in self.names}
+        stores = {name:store for name, store in stores.items() if len(store.chunks)>0}
+        if len(stores)==0:
+            return [([], []) for _ in queries]
+        query_embeddings = None
+        model_stores = [store for store in stores.values() if store.vectorization_method==VectorizationMethod.MODEL_EMBEDDING]
+        if len(model_stores)>1:
+            query_embeddings = model_stores[0].embed_queries(queries)
+
+        def search(name):
+            store = stores[name]
+            if store.vectorization_method==VectorizationMethod.MODEL_EMBEDDING:
+                return name, store.recover_texts(queries, top_k, query_embeddings=query_embeddings)
+            return name, store.recover_texts(queries, top_k)
+
+        merged = [[] for _ in queries]
+        # Hybrid stores embed their candidates during the search, the model binding must not be
+        # called from several threads
+        max_workers = 1 if any(store.bm25 is not None for store in model_stores) else self.max_workers
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(stores)))) as executor:
+            for name, results in executor.map(search, list(stores.keys())):
+                for candidates, (texts, sorted_similarities) in zip(merged, results):
+                    candidates += [(score, self.qualify(name, chunk_id), text) for text, (chunk_id, score) in zip(texts, sorted_similarities)]
+        results = []
+        for candidates in merged:
+            candidates.sort(key=lambda candidate:candidate[0], reverse=True)
+            candidates = candidates[:top_k]
+            results.append(([text for _, _, text in candidates], [(chunk_id, score) for score, chunk_id, _ in candidates]))
+        return results
+
+
+class BatchReportWriter:
+    """
+    Append only writer for the batch mode report.
+
+    Every answer is appended to the markdown report as soon as it is generated, then recorded in
+    a journal (<report>.checkpoint.jsonl: a header line identifying the questions file, then one
+    line per search query built and one per answered question with the report size after it).
+    On restart the report is cut back to the last journaled answer and the batch resumes from
+    there, reusing the queries that were already built. Only the answered question indices and
+    the pending queries are kept in memory.
+    """
+    def __init__(self, report_path:Path, questions_hash:str):
+        self.report_path = report_path
+        self.journal_path = Path(str(report_path)+".checkpoint.jsonl") if report_path is not None else None
+        self.questions_hash = questions_hash
+        self.report = None
+        self.journal = None
+        # Search queries journaled by a previous run, by question index
+        self.queries = {}
+
+    def _read_journal(self):
+        """Returns (answered indices, report size, journal size) of the valid part of the journal"""
+        answered = set()
+        report_size = 0
+        journal_size = 0
+        self.queries = {}
+        with open(self.journal_path, "rb") as f:
+            for n, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn last line
+                    break
+                if n==0:
+                    if record.get("questions_hash")!=self.questions_hash:
+                        ASCIIColors.warning("The questions file changed since the last checkpoint, starting over")
+                        return set(), 0, 0
+                elif "query" in record:
+                    self.queries[record["index"]] = record["query"]
+                else:
+                    answered.add(record["index"])
+                    self.queries.pop(record["index"], None)
+                    report_size = record["report_size"]
+                journal_size += len(line)
+        return answered, report_size, journal_size
+
+    def open(self):
+        """Opens the report and the journal and returns the set of already answered question indices"""
+        if self.report_path is None:
+            return set()
+        answered, report_size, journal_size = set(), 0, 0
+        if self.journal_path.exists() and self.report_path.exists():
+            try:
+                answered, report_size, journal_size = self._read_journal()
+            except Exception as ex:
+                ASCIIColors.warning(f"Couldn't read the batch checkpoint: {ex}")
+                answered, report_size, journal_size = set(), 0, 0
+            if report_size>self.report_path.stat().st_size:
+                ASCIIColors.warning("The report is shorter than its checkpoint, starting over")
+                answered, report_size, journal_size = set(), 0, 0
+                self.queries = {}
+        self.report = open(self.report_path, "r+b" if journal_size>0 else "wb")
+        self.report.truncate(report_size)
+        self.report.seek(report_size)
+        self.journal = open(self.journal_path, "r+b" if journal_size>0 else "wb")
+        self.journal.truncate(journal_size)
+        self.journal.seek(journal_size)
+        if journal_size==0:
+            self._write_line(self.journal, {"questions_hash":self.questions_hash})
+        return answered
+
+    @staticmethod
+    def _write_line(f, record):
+        f.write((json.dumps(record)+"\n").encode("utf-8"))
+        f.flush()
+
+    def append_query(self, index, query):
+        if self.journal is None:
+            return
+        self._write_line(self.journal, {"index":index, "query":query})
+
+    def append(self, index, text):
+        if self.report is None:
+            return
+        self.report.write(text.encode("utf-8"))
+        self.report.flush()
+        os.fsync(self.report.fileno())
+        self._write_line(self.journal, {"index":index, "report_size":self.report.tell()})
+
+    def close(self):
+        for f in [self.report, self.journal]:
+            if f is not None:
+                f.close()
+        self.report = None
+        self.journal = None
+
+
+class QueryCache:
+    """
+    In memory cache with a time to live and a bounded number of entries (least recently used
+    entries go first). Used to remember the keywords extracted from a prompt and the chunks
+    retrieved for a query.
+    """
+    def __init__(self, ttl:float, max_entries:int=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text:str):
+        return re.sub(r"\s+", " ", text.lower()).strip(" ?!.,;:")
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or self.ttl<=0 or time.time()-entry[0]>self.ttl:
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        if self.ttl<=0:
+            return
+        self.entries[key] = (time.time(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries)>self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self, kind=None):
+        """Drops every entry, or only those whose key starts with kind"""
+        if kind is None:
+            self.entries.clear()
+        else:
+            for key in [key for key in self.entries if key[0]==kind]:
+                del self.entries[key]
+
+
+class EmbeddingCache:
+    """
+    Persistent content addressed cache of document chunks and their embeddings.
+
+    Entries are keyed by the hash of the file content, the chunking parameters, the vectorization
+    method and the model, and stored as one npz file each. The least recently used entries
+    (by file modification time, refreshed on every hit) are evicted once the cache exceeds max_size.
+    """
+    # Part of the keys, change it when the chunks of a document change for the same parameters
+    CHUNKER = "text_chunking-1"
+
+    def __init__(self, cache_folder:Path, max_size:int):
+        self.cache_folder = Path(cache_folder)
+        self.cache_folder.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def file_hash(path):
+        hasher = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1<<20), b""):
+                hasher.update(block)
+        return hasher.hexdigest()
+
+    def key(self, path, chunk_size, overlap_size, vectorization_method, model_name):
+        description = f"{EmbeddingCache.file_hash(path)}|{chunk_size}|{overlap_size}|{vectorization_method}|{model_name}|{EmbeddingCache.CHUNKER}"
+        return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Returns the cached chunk dictionaries (without document name and index) or None"""
+        entry_path = self.cache_folder/f"{key}.npz"
+        if not entry_path.exists():
+            self.misses += 1
+            return None
+        try:
+            with np.load(entry_path) as entry:
+                texts = entry["texts"]
+                token_offsets = entry["token_offsets"]
+                tokens = entry["tokens"].tolist()
+                embeddings = entry["embeddings"] if entry["has_embeddings"] else None
+                # Entries written before the source offsets were cached have no location
+                sources = entry["sources"] if "sources" in entry else np.tile([-1, -1, 0], (len(texts), 1))
+        except Exception as ex:
+            ASCIIColors.warning(f"Dropping unreadable cache entry {entry_path.name}: {ex}")
+            entry_path.unlink(missing_ok=True)
+            self.misses += 1
+            return None
+        os.utime(entry_path)
+        self.hits += 1
+        return [
+            {
+                "chunk_text":str(texts[i]),
+                "chunk_tokens":tokens[token_offsets[i]:token_offsets[i+1]],
+                "embeddings":embeddings[i] if embeddings is not None else [],
+                "start":int(sources[i][0]),
+                "end":int(sources[i][1]),
+                "page":int(sources[i][2])
+            }
+            for i in range(len(texts))
+        ]
+
+    def put(self, key, chunks):
+        """Stores the chunk dictionaries of a document (embeddings are only kept if every chunk has one)"""
+        if self.max_size<=0 or len(chunks)==0:
+            return
+        has_embeddings = all(len(chunk["embeddings"])>0 for chunk in chunks)
+        token_offsets = np.cumsum([0]+[len(chunk["chunk_tokens"]) for chunk in chunks])
+        tmp_path = self.cache_folder/f"{key}.tmp.npz"
+        np.savez(
+            tmp_path,
+            texts=np.array([chunk["chunk_text"] for chunk in chunks]),
+            tokens=np.array([t for chunk in chunks for t in chunk["chunk_tokens"]], dtype=np.int64),
+            token_offsets=token_offsets,
+            embeddings=np.stack([np.asarray(chunk["embeddings"], dtype=np.float32) for chunk in chunks]) if has_embeddings else np.zeros(0),
+            has_embeddings=has_embeddings,
+            sources=np.array([[chunk.get("start", -1), chunk.get("end", -1), chunk.get("page", 0)] for chunk in chunks], dtype=np.int64)
+        )
+        os.replace(tmp_path, self.cache_folder/f"{key}.npz")
+        self.evict()
+
+    def evict(self):
+        entries = sorted(self.cache_folder.glob("*.npz"), key=lambda p: p.stat().st_mtime)
+        total_size = sum(p.stat().st_size for p in entries)
+        while total_size>self.max_size and len(entries)>0:
+            oldest = entries.pop(0)
+            total_size -= oldest.stat().st_size
+            oldest.unlink(missing_ok=True)
+            self.evictions += 1
+
+    def size(self):
+        return sum(p.stat().st_size for p in self.cache_folder.glob("*.npz"))
+
+    def stats(self):
+        return f"Embedding cache: {self.hits} hit(s), {self.misses} miss(es), {self.evictions} eviction(s), {self.size()/(1<<20):.1f} MB"
+
 
 class Processor(APScript):
     """
@@ -37,13 +1395,26 @@ class Processor(APScript):
                 {"name":"batch_mode_questions_file","type":"str","value":"", "help":"A path to a text file containing the list of questions"},
                 {"name":"batch_mode_report_file","type":"str","value":"", "help":"A path to a markdown file to be created."},
                 {"name":"custom_db_path","type":"str","value":"", "help":"if not empty, you can change this to the path of the database you want to create or use"},
+                {"name":"collection","type":"str","value":"", "help":"If not empty, documents are added to this named collection (each collection has its own database, custom_db_path is then ignored)"},
+                {"name":"query_collections","type":"str","value":"", "help":"Comma separated list of the collections searched when answering (* for all of them). If empty, only the current database is searched"},
+                {"name":"collections_memory_mb","type":"int","value":2048, "min":64, "help":"Memory budget of the open collections, the least recently used ones are closed when it is exceeded"},
                 {"name":"build_keywords","type":"bool","value":True, "help":"If true, the model will first generate keywords before searching"},
                 {"name":"load_db","type":"bool","value":False, "help":"If true, the vectorized database will be loaded at startup"},
                 {"name":"save_db","type":"bool","value":False, "help":"If true, the vectorized database will be saved for future use"},
                 {"name":"vectorization_method","type":"str","value":f"model_embedding", "options":["model_embedding", "tfidf_vectorizer"], "help":"Vectoriazation method to be used (changing this should reset database)"},
                 {"name":"show_interactive_form","type":"bool","value":False, "help":"If true, a window wil be shown with the data plot in an interactive form"},
+                {"name":"hybrid_retrieval","type":"bool","value":False, "help":"If true, a BM25 keyword index preselects bm25_candidates chunks that are then ranked with the embeddings. With model_embedding, chunks are only embedded when they first become a candidate (or when a query has too few words in common with the database and every chunk is scored), which makes adding documents much faster (changing this should reset database)"},
+                {"name":"bm25_candidates","type":"int","value":200, "min":1, "max":10000, "help":"Number of chunks preselected by BM25 in hybrid retrieval"},
+                {"name":"search_index","type":"str","value":"exact", "options":["exact", "ivf"], "help":"exact scores every chunk, ivf only scores the chunks of the clusters closest to the query (faster on very large databases, slightly less accurate)"},
+                {"name":"ivf_nprobe","type":"int","value":16, "min":1, "max":1024, "help":"Number of clusters scored by the ivf search index (higher is more accurate and slower). Recall depends on the database size: on benchmarks/ann_recall.py, 16 gives a recall@10 of about 0.99 on 100k chunks but only about 0.87 on 20k chunks, where the exact search is fast enough and should be preferred"},
+                {"name":"query_cache_ttl","type":"int","value":600, "min":0, "help":"Number of seconds during which the keywords and the retrieved chunks of a question are reused when the same question is asked again (0 disables the cache)"},
+                {"name":"ingest_workers","type":"int","value":0, "min":0, "max":64, "help":"Number of processes used to extract the text of the documents when several files are added (0: automatic, 1: no worker process)"},
+                {"name":"embedding_cache_size_mb","type":"int","value":512, "min":0, "help":"Maximum size of the embedding cache that lets unchanged documents be reloaded without vectorizing them again (0 disables the cache)"},
                 
                 {"name":"nb_chunks","type":"int","value":2, "min":1, "max":50,"help":"Number of data chunks to use for its vector (at most nb_chunks*max_chunk_size must not exeed two thirds the context size)"},
+                {"name":"context_packing","type":"bool","value":True, "help":"If true, the context is filled with as many of the most relevant chunks as fit in ctx_size minus max_answer_size instead of always using nb_chunks chunks"},
+                {"name":"expand_neighbours","type":"int","value":0, "min":0, "max":16,"help":"Number of chunks before and after each retrieved chunk that are added to the context when there is room left"},
+                {"name":"max_packed_chunks","type":"int","value":32, "min":1, "max":1024,"help":"Maximum number of candidate chunks retrieved when context_packing is on"},
                 {"name":"database_path","type":"str","value":f"{personality.name}_db.json", "help":"Path to the database"},
                 {"name":"max_chunk_size","type":"int","value":512, "min":10, "max":personality.config["ctx_size"],"help":"Maximum size of text chunks to vectorize"},
                 {"name":"chunk_overlap_sentences","type":"int","value":1, "min":0, "max":personality.config["ctx_size"],"help":"Overlap between chunks"},
@@ -75,6 +1446,7 @@ class Processor(APScript):
                                         "set_database": self.set_database,
                                         "clear_database": self.clear_database,
                                         "show_files":self.show_files,
+                                        "show_collections":self.show_collections,
                                         "process_batch":self.process_batch,
                                     },
                                     "default": self.chat_with_doc
@@ -86,8 +1458,32 @@ class Processor(APScript):
         self.ready = False
         self.personality = personality
         self.callback = None
-        self.vector_store = None
+        # Opened on first use, see the vector_store property
+        self._vector_store = None
+        self.collections = None
+        self._opened_collection = None
+        self.embedding_cache = None
+        self.query_cache = QueryCache(personality_config.query_cache_ttl)
+
+
+    @property
+    def vector_store(self):
+        if self._vector_store is None:
+            self.prepare()
+        return self._vector_store
 
+    @vector_store.setter
+    def vector_store(self, vector_store):
+        self._vector_store = vector_store
+
+    def settings_updated(self):
+        # Cached keywords and retrievals may come from other settings (nb_chunks, collections...)
+        self.query_cache.ttl = self.personality_config.query_cache_ttl
+        self.query_cache.clear()
+        # Switching to another collection reopens the store on next use
+        if self._vector_store is not None and self.personality_config.collection.strip()!=(self._opened_collection or ""):
+            self._vector_store = None
+            self.ready = False
 
     def install(self):
         super().install()
@@ -103,74 +1499,281 @@ class Processor(APScript):
     def help(self, prompt, full_context):
         self.full(self.personality.help, callback=self.callback)
         
+    def extract_keywords(self, prompt):
+        """Asks the model for the search keywords of a prompt, reusing the answer given to the same prompt"""
+        key = ("keywords", QueryCache.normalize(prompt), self.personality.config.model_name)
+        keywords = self.query_cache.get(key)
+        if keywords is None:
+            full_text =f"""!@>instructor:Extract keywords from this prompt. The keywords output format is comma separated values.
+!@>prompt: {prompt}
+!@>assistant: The keywords are """
+            keywords = self.generate(full_text, int(self.personality_config["max_answer_size"])).strip()
+            self.query_cache.put(key, keywords)
+        return keywords
+
+    def query_collection_names(self):
+        """Collections listed in query_collections, * stands for all the collections"""
+        names = [name.strip() for name in self.personality_config.query_collections.split(",") if name.strip()!=""]
+        if "*" in names:
+            return self.collections.names()
+        return names
+
+    def search_store(self):
+        """The database searched to answer: the current one, or a view over the query_collections"""
+        store = self.vector_store
+        names = self.query_collection_names()
+        if len(names)==0:
+            return store
+        return CollectionsView(self.collections, names)
+
+    def retrieve(self, query, top_k, store=None):
+        """recover_text with a cache keyed by the normalized query and the database version"""
+        store = self.vector_store if store is None else store
+        key = ("retrieval", QueryCache.normalize(query), top_k, store.version)
+        sorted_similarities = self.query_cache.get(key)
+        if sorted_similarities is not None and all(chunk_id in store.chunks for chunk_id, _ in sorted_similarities):
+            return [store.chunks[chunk_id]["chunk_text"] for chunk_id, _ in sorted_similarities], sorted_similarities
+        docs, sorted_similarities = store.recover_text(query, top_k=top_k)
+        self.query_cache.put(key, sorted_similarities)
+        return docs, sorted_similarities
+
+    def retrieval_size(self):
+        if self.personality_config.context_packing:
+            return max(self.personality_config.nb_chunks, self.personality_config.max_packed_chunks)
+        return self.personality_config.nb_chunks
+
+    def pack_context(self, docs, sorted_similarities, fixed_text, header="!@>document chunk {}:\n", store=None):
+        """
+        Greedily fills the token budget (ctx_size - max_answer_size) with the retrieved chunks, best
+        first, skipping those that don't fit. With expand_neighbours>0 the chunks around each hit are
+        then added while there is room. Contiguous chunks of a document are sent as one passage without
+        their overlap. Chunk sizes come from the counts stored at index time so only fixed_text (the
+        rest of the prompt) is tokenized.
+        Returns (documentation text, used similarities, estimated prompt size in tokens).
+        """
+        vector_store = self.vector_store if store is None else store
+        nb_tokens = len(self.personality.model.tokenize(fixed_text))
+        budget = self.personality.config.ctx_size - self.personality_config.max_answer_size
+        selected = {}
+
+        def cost(chunk_id):
+            chunk_text = vector_store.chunks[chunk_id]["chunk_text"]
+            count = vector_store.chunk_token_counts([chunk_id])[0]
+            previous_id = vector_store.adjacent_chunk_id(chunk_id, -1)
+            following_id = vector_store.adjacent_chunk_id(chunk_id, 1)
+            if previous_id in selected or following_id in selected:
+                # Joins an existing passage: no header, only the part that doesn't overlap
+                overlap = 0
+                if previous_id in selected:
+                    overlap += text_overlap(vector_store.chunks[previous_id]["chunk_text"], chunk_text.lstrip())
+                if following_id in selected:
+                    overlap += text_overlap(chunk_text, vector_store.chunks[following_id]["chunk_text"].lstrip())
+                return count-(count*overlap)//max(1, len(chunk_text)) + (len(chunk_id)+4)//2 + 1
+            # Headers are not tokenized, two characters per token is a safe upper bound for them
+            return count + len(header.format(chunk_id))//2 + 1
+
+        def add(chunk_id, score):
+            nonlocal nb_tokens
+            chunk_cost = cost(chunk_id)
+            if self.personality_config.context_packing and nb_tokens+chunk_cost>budget:
+                return False
+            selected[chunk_id] = score
+            nb_tokens += chunk_cost
+            return True
+
+        for chunk_id, score in sorted_similarities:
+            if chunk_id not in selected:
+                add(chunk_id, score)
+        for chunk_id, score in list(selected.items()):
+            for direction in [-1, 1]:
+                neighbour_id = chunk_id
+                for _ in range(int(self.personality_config.expand_neighbours)):
+                    neighbour_id = vector_store.adjacent_chunk_id(neighbour_id, direction)
+                    if neighbour_id is None or (neighbour_id not in selected and not add(neighbour_id, score)):
+                        break
+
+        # Merge the runs of contiguous chunks into passages, best passage first
+        positions = {chunk_id:vector_store.chunk_position(chunk_id) for chunk_id in selected}
+        passages = []
+        for chunk_id in sorted(selected, key=lambda chunk_id:positions[chunk_id]):
+            document_name, chunk_index = positions[chunk_id]
+            if len(passages)>0 and passages[-1]["position"]==(document_name, chunk_index-1):
+                passage = passages[-1]
+                following = vector_store.chunks[chunk_id]["chunk_text"].lstrip()
+                overlap = text_overlap(passage["text"], following)
+                passage["text"] += following[overlap:] if overlap>0 else " "+following
+            else:
+                passage = {"text":vector_store.chunks[chunk_id]["chunk_text"], "chunk_ids":[], "score":selected[chunk_id]}
+                passages.append(passage)
+            passage["position"] = (document_name, chunk_index)
+            passage["chunk_ids"].append(chunk_id)
+            passage["score"] = max(passage["score"], selected[chunk_id])
+        passages.sort(key=lambda passage:passage["score"], reverse=True)
+
+        used_docs = []
+        used_similarities = []
+        for passage in passages:
+            label = passage["chunk_ids"][0] if len(passage["chunk_ids"])==1 else f"{passage['chunk_ids'][0]} to {passage['chunk_ids'][-1]}"
+            used_docs.append(header.format(label)+passage["text"])
+            used_similarities += [(chunk_id, selected[chunk_id]) for chunk_id in passage["chunk_ids"]]
+        if len(used_docs)==0 and len(docs)>0:
+            ASCIIColors.warning("No document chunk fits in the context, try reducing max_answer_size or max_chunk_size")
+        return "\n".join(used_docs), used_similarities, nb_tokens
+
+    def build_references(self, sorted_similarities, store=None):
+        store = self.vector_store if store is None else store
+        docs_sources=[]
+        for chunk_id, _ in sorted_similarities:
+            document_name, chunk_index, _, _, page = store.chunk_source(chunk_id)
+            e = document_name.replace("\\","/").split("/")[-1]
+            name = "/uploads/" + self.personality.personality_folder_name + "/" + e
+            path = e + f" chunk id : chunk_{chunk_index}" + (f" page {page}" if page>0 else "")
+            docs_sources.append([path, name])
+        return docs_sources
+
+    def send_chunk(self, text):
+        """Appends text to the current message on the UI side"""
+        if self.callback is not None:
+            self.callback(text, MSG_TYPE.MSG_TYPE_CHUNK)
+
+    def format_batch_entry(self, entry):
+        output = "## Question:\n"+entry["question"]+"\n"
+        if self.personality_config.build_keywords:
+            output += "### Query:\n"+entry["query"]+"\n"
+        output += "## Answer:\n"+entry["answer"]+"\n"
+        output += "\n### Used References:\n" + "\n".join([f'[{v[0]}]({quote(v[1])})\n' for v in entry["references"]])
+        return output
+
     def process_batch(self, prompt, full_context):
-        output = ""
+        """
+        Answers every question of the questions file: the search queries are built first, then
+        a prefetch thread retrieves the documents by blocks of questions (one similarity pass
+        per block) while this thread packs the contexts and generates the answers of the blocks
+        already retrieved. Each search query is journaled as soon as it is built and each answer
+        is appended to the report and sent to the UI as soon as it is generated, so an
+        interrupted batch resumes where it stopped (see BatchReportWriter).
+
+        The model binding is only ever called from this thread, local bindings are not safe to
+        use from several threads. When the searched stores embed the queries with the binding,
+        the retrieval is done here in a single pass before the generation, without overlap.
+        """
         if self.personality_config.batch_mode_questions_file=="":
             self.new_message("Please set a questions list file to my configuration to start batch qna")
             return
         self.new_message("")
-        questions = GenericDataLoader.read_file(self.personality_config.batch_mode_questions_file)
-        questions = questions.split("\n")
-        for i, question in enumerate(questions):
-            if len(question)>5:
-                output += "## Question:\n"+question+"\n"
-                self.full(output)
-                self.step_start(f"Analyzing request {i+1}/{len(questions)}")
-                if self.personality_config.build_keywords:
-                    query = self.personality.fast_gen("!@>prompt:"+question+"\n!@>instruction: Convert the prompt to a web search query."+"\nDo not answer the prompt. Do not add explanations. Use comma separated syntax to make a list of keywords in the same line.\nThe keywords should reflect the ideas written in the prompt so that a seach engine can process them efficiently.\n!@>query: ", max_generation_size=256, show_progress=True)
-                    preprocessed_prompt = self.fast_gen(query, int(self.personality_config["max_answer_size"]),show_progress=True).strip()
-                    output += "### Query:\n"+preprocessed_prompt+"\n"
-                    self.full(output)
+        start_time = time.perf_counter()
+        questions_text = GenericDataLoader.read_file(Path(self.personality_config.batch_mode_questions_file))
+        questions_hash = hashlib.sha256(questions_text.encode("utf-8")).hexdigest()
+        questions = [question for question in questions_text.split("\n") if len(question)>5]
+        report_path = Path(self.personality_config.batch_mode_report_file) if self.personality_config.batch_mode_report_file!="" else None
+        writer = BatchReportWriter(report_path, questions_hash)
+        answered = writer.open()
+        pending = [i for i in range(len(questions)) if i not in answered]
+        if len(answered)>0:
+            ASCIIColors.info(f"Resuming batch: {len(answered)}/{len(questions)} questions already answered")
+            self.send_chunk(f"*Resuming batch: {len(answered)}/{len(questions)} questions already answered in {report_path}*\n\n")
+
+        latencies = []
+        queries_time = 0
+        retrieval_times = []
+        prefetch = None
+        stop_prefetch = threading.Event()
+        try:
+            # Stage 1: queries, journaled one by one
+            self.step_start(f"Building queries for {len(pending)} questions")
+            queries = {}
+            for i in pending:
+                if not self.personality_config.build_keywords:
+                    queries[i] = questions[i]
+                elif i in writer.queries:
+                    queries[i] = writer.queries[i]
                 else:
-                    preprocessed_prompt = question
-                if preprocessed_prompt=="":
-                    preprocessed_prompt = prompt
-                docs, sorted_similarities = self.vector_store.recover_text(preprocessed_prompt, top_k=self.personality_config.nb_chunks)
-                docs = '\n'.join([f"!@>document {s[0]}:\n{v}" for i,(v,s) in enumerate(zip(docs,sorted_similarities))])
+                    query = self.personality.fast_gen("!@>prompt:"+questions[i]+"\n!@>instruction: Convert the prompt to a web search query."+"\nDo not answer the prompt. Do not add explanations. Use comma separated syntax to make a list of keywords in the same line.\nThe keywords should reflect the ideas written in the prompt so that a seach engine can process them efficiently.\n!@>query: ", max_generation_size=256, show_progress=True).strip()
+                    queries[i] = query if query!="" else questions[i]
+                    writer.append_query(i, queries[i])
+            self.step_end(f"Building queries for {len(pending)} questions")
+            queries_time = time.perf_counter()-start_time
+
+            # Stage 2: retrieval, overlapped with the generation when it doesn't need the binding
+            store = self.search_store()
+            top_k = self.retrieval_size()
+            overlap = not store.embeds_with_model
+            block_size = 32 if overlap else max(1, len(pending))
+            retrieved = queue.Queue()
+
+            def retrieve_blocks():
+                try:
+                    for start in range(0, len(pending), block_size):
+                        if stop_prefetch.is_set():
+                            return
+                        block = pending[start:start+block_size]
+                        block_start = time.perf_counter()
+                        results = store.recover_texts([queries[i] for i in block], top_k=top_k)
+                        retrieval_times.append(time.perf_counter()-block_start)
+                        for result in results:
+                            retrieved.put(result)
+                except Exception as ex:
+                    retrieved.put(ex)
+
+            if overlap:
+                prefetch = threading.Thread(target=retrieve_blocks, daemon=True)
+                prefetch.start()
+            else:
+                self.step_start("Retrieving documents")
+                retrieve_blocks()
+                self.step_end("Retrieving documents")
+
+            # Stage 3: generation, in the questions order
+            for i in pending:
+                result = retrieved.get()
+                if isinstance(result, Exception):
+                    raise result
+                docs, sorted_similarities = result
+                question_text = f"""!@>question: {questions[i]}
+!@>answer:"""
+                docs, sorted_similarities, nb_tokens = self.pack_context(docs, sorted_similarities, question_text, "!@>document {}:\n", store)
                 full_text =f"""{docs}
-{full_context}"""
-
-                tk = self.personality.model.tokenize(full_text)
-                # print(f"total: {len(tk)}")           
-                ASCIIColors.blue("-------------- Documentation -----------------------")
-                ASCIIColors.blue(full_text)
-                ASCIIColors.blue(f"Number of tokens :{len(tk)}")
-                ASCIIColors.blue("----------------------------------------------------")
-                tk = self.personality.model.tokenize(full_text)
-                ASCIIColors.info(f"Documentation size in tokens : {len(tk)}")
+{question_text}"""
+                self.step_start(f"Answering question {i+1}/{len(questions)}")
+                ASCIIColors.info(f"Documentation size in tokens : {nb_tokens}")
                 if self.personality.config.debug:
                     ASCIIColors.yellow(full_text)
+                question_start = time.perf_counter()
                 answer = self.fast_gen(full_text, self.personality_config["max_answer_size"],show_progress=True).strip()
-                output += "## Answer:\n"+answer+"\n"
-                self.full(output)
-                docs_sources=[]
-                for entry in sorted_similarities:
-                    e = "_".join(entry[0].replace("\\","/").split("/")[-1].split('_')[:-2])
-                    ci = "_".join(entry[0].replace("\\","/").split("/")[-1].split('_')[-2:])
-                    name = "/uploads/" + self.personality.personality_folder_name + "/" + e
-                    path = e + f" chunk id : {ci}"
-                    docs_sources.append([path, name])
-
-                output += "\n### Used References:\n" + "\n".join([f'[{v[0]}]({quote(v[1])})\n' for v in docs_sources])
-                ASCIIColors.yellow(output)
-
-                self.step_end(f"Analyzing request {i+1}/{len(questions)}")
-                self.full(output)                
-        self.step_start("Saving report")
-        if self.personality_config.batch_mode_report_file!="":
-            with open(self.personality_config.batch_mode_report_file, "w") as f:
-                f.write(output)
-        self.step_end("Saving report")
+                latencies.append(time.perf_counter()-question_start)
+                entry_text = self.format_batch_entry({
+                    "question":questions[i],
+                    "query":queries[i],
+                    "answer":answer,
+                    "references":self.build_references(sorted_similarities, store)
+                })+"\n"
+                writer.append(i, entry_text)
+                self.step_end(f"Answering question {i+1}/{len(questions)}")
+                self.send_chunk(entry_text)
+        finally:
+            stop_prefetch.set()
+            if prefetch is not None:
+                prefetch.join()
+            writer.close()
+
+        total_time = time.perf_counter()-start_time
+        stats = f"Answered {len(pending)} question(s) in {total_time:.1f}s (queries {queries_time:.1f}s, retrieval {sum(retrieval_times):.2f}s{' overlapped with the generation' if prefetch is not None else ''})"
+        if len(latencies)>0:
+            stats += f", {60*len(latencies)/total_time:.1f} questions/min, answer latency p50 {np.percentile(latencies, 50):.1f}s p95 {np.percentile(latencies, 95):.1f}s"
+        ASCIIColors.info(stats)
+        self.step_start(stats)
+        self.step_end(stats)
+        self.send_chunk(f"\n*{stats}*\n")
 
     def show_database(self, prompt, full_context):
         import random
-        if self.ready:
+        if self.vector_store.ready:
             out_pth = self.personality.lollms_paths.personal_uploads_path/f"{self.personality.personality_folder_name}/"
             out_pth.mkdir(parents=True, exist_ok=True)
             out_path = f"/uploads/{self.personality.personality_folder_name}/"
             end = random.randint(0,99999)
             out_path+=f"db{end}.png"
-            self.vector_store.show_document(save_fig_path=out_pth/"db.png",show_interactive_form=self.personality_config.show_interactive_form)
+            self.vector_store.show_document(save_fig_path=out_pth/"db.png",show_interactive_form=self.personality_config.show_interactive_form, method="PCA" if self.personality_config.data_visualization_method=="PCA" else "TSNE")
             if self.personality_config.data_visualization_method=="PCA":
                 self.full(f"Database representation (PCA):\n![{out_path}]({out_path})", callback=self.callback)
             else:
@@ -181,6 +1784,7 @@ class Processor(APScript):
 
     def clear_database(self,prompt, full_context):
         self.vector_store.clear_database()
+        self.query_cache.clear()
         self.full("Starting fresh")
         
     def show_files(self,prompt, full_context):
@@ -188,16 +1792,26 @@ class Processor(APScript):
         self.full(files)
         
 
+    def show_collections(self, prompt, full_context):
+        self.prepare()
+        open_names = self.collections.open_names()
+        lines = []
+        for name in self.collections.names():
+            status = f"open, {len(self.collections.get(name).chunks)} chunks" if name in open_names else "closed"
+            lines.append(f"- {name} ({status})" + (" *current*" if name==self._opened_collection else ""))
+        if len(lines)==0:
+            lines.append("No collection yet, set the collection option to create one")
+        lines.append(f"\nOpen collections use about {self.collections.memory_usage()/1024/1024:.0f}MB out of {self.personality_config.collections_memory_mb}MB")
+        self.full("\n".join(lines))
+
     def chat_with_doc(self, prompt, full_context):
-        if self.vector_store.ready:
+        store = self.search_store()
+        if store.ready:
             if prompt == "":
                 self.exception("Please send a prompt to process")
             self.step_start("Analyzing request", callback=self.callback)
             if self.personality_config.build_keywords:
-                full_text =f"""!@>instructor:Extract keywords from this prompt. The keywords output format is comma separated values.
-!@>prompt: {prompt}
-!@>assistant: The keywords are """
-                preprocessed_prompt = self.generate(full_text, int(self.personality_config["max_answer_size"])).strip()
+                preprocessed_prompt = self.extract_keywords(prompt)
             else:
                 preprocessed_prompt = prompt
             self.step_end("Analyzing request", callback=self.callback)
@@ -205,34 +1819,22 @@ class Processor(APScript):
                 preprocessed_prompt = prompt
             self.full(f"Query : {preprocessed_prompt}")
 
-            docs, sorted_similarities = self.vector_store.recover_text(preprocessed_prompt, top_k=self.personality_config.nb_chunks)
-            # for doc in docs:
-            #     tk = self.personality.model.tokenize(doc)
-            #     print(len(tk))
-            docs = '\n'.join([f"!@>document chunk {s[0]}:\n{v}" for i,(v,s) in enumerate(zip(docs,sorted_similarities))])
-            full_text =f"""{docs}
-{full_context}
+            docs, sorted_similarities = self.retrieve(preprocessed_prompt, self.retrieval_size(), store)
+            discussion_text = f"""{full_context}
 !@>chat_with_docs:"""
+            docs, sorted_similarities, nb_tokens = self.pack_context(docs, sorted_similarities, discussion_text, store=store)
+            full_text =f"""{docs}
+{discussion_text}"""
 
-            tk = self.personality.model.tokenize(full_text)
-            # print(f"total: {len(tk)}")           
             ASCIIColors.blue("-------------- Documentation -----------------------")
             ASCIIColors.blue(full_text)
-            ASCIIColors.blue(f"Number of tokens :{len(tk)}")
+            ASCIIColors.blue(f"Number of tokens :{nb_tokens} ({len(sorted_similarities)} chunks)")
             ASCIIColors.blue("----------------------------------------------------")
             ASCIIColors.blue("Thinking")
-            tk = self.personality.model.tokenize(full_text)
-            ASCIIColors.info(f"Documentation size in tokens : {len(tk)}")
             if self.personality.config.debug:
                 ASCIIColors.yellow(full_text)
             output = self.generate(full_text, self.personality_config["max_answer_size"]).strip()
-            docs_sources=[]
-            for entry in sorted_similarities:
-                e = "_".join(entry[0].replace("\\","/").split("/")[-1].split('_')[:-2])
-                ci = "_".join(entry[0].replace("\\","/").split("/")[-1].split('_')[-2:])
-                name = "/uploads/" + self.personality.personality_folder_name + "/" + e
-                path = e + f" chunk id : {ci}"
-                docs_sources.append([path, name])
+            docs_sources = self.build_references(sorted_similarities, store)
 
             output += "\n## Used References:\n" + "\n".join([f'[{v[0]}]({quote(v[1])})\n' for v in docs_sources])
 
@@ -243,63 +1845,118 @@ class Processor(APScript):
         else:
             self.full("Vector store is not ready. Please send me a document to use. Use Send file command form your chatbox menu to trigger this.", callback=self.callback)
 
-    def build_db(self):
-        if self.vector_store is None:
-            root_db_folder = self.personality.lollms_paths.self.personal_databases_path/self.personality.personality_folder_name
-            root_db_folder.mkdir(exist_ok=True, parents=True)
-            self.vector_store = TextVectorizer(                     
-                    self.personality_config.vectorization_method, # supported "model_embedding" or "tfidf_vectorizer"
-                    model=self.personality.model, #needed in case of using model_embedding
-                    database_path=root_db_folder/"db.json" if self.personality_config.custom_db_path=="" else self.personality_config.custom_db_path,
-                    save_db=self.personality_config.save_db,
-                    visualize_data_at_startup=self.personality_config.visualize_data_at_startup,
-                    visualize_data_at_add_file=self.personality_config.visualize_data_at_add_file,
-                    visualize_data_at_generate=self.personality_config.visualize_data_at_generate
-                    )        
+    def build_db(self, files=None):
+        """
+        Chunks and embeds the files (all the text files by default) that are not in the database
+        yet. Only the new chunks are embedded, the rest of the database is left untouched.
+        """
         if len(self.vector_store.chunks)>0:
             self.ready = True
 
+        try:
+            chunk_size=int(self.personality_config["max_chunk_size"])
+        except:
+            ASCIIColors.warning(f"Couldn't read chunk size. Verify your configuration file")
+            chunk_size=512
+        try:
+            overlap_size=int(self.personality_config["chunk_overlap_sentences"])
+        except:
+            ASCIIColors.warning(f"Couldn't read chunk size. Verify your configuration file")
+            overlap_size=50
+
         ASCIIColors.info("-> Vectorizing the database"+ASCIIColors.color_orange)
-        for file in self.text_files:
+        files_to_read = {}
+        failures = []
+        for file in (self.text_files if files is None else files):
+            if self.vector_store.has_document(file):
+                continue
             try:
-                text =  GenericDataLoader.read_file(file)
-                try:
-                    chunk_size=int(self.personality_config["max_chunk_size"])
-                except:
-                    ASCIIColors.warning(f"Couldn't read chunk size. Verify your configuration file")
-                    chunk_size=512
-                try:
-                    overlap_size=int(self.personality_config["chunk_overlap_sentences"])
-                except:
-                    ASCIIColors.warning(f"Couldn't read chunk size. Verify your configuration file")
-                    overlap_size=50
+                cache_key = self.embedding_cache.key(file, chunk_size, overlap_size, self.vector_store.vectorization_method.value, self.personality.config.model_name)
+                cached_chunks = self.embedding_cache.get(cache_key)
+                if cached_chunks is not None:
+                    for i, chunk in enumerate(cached_chunks):
+                        self.vector_store.chunks[f"{file}_chunk_{i + 1}"] = dict(chunk, document_name=str(file), chunk_index=i+1)
+                    self.vector_store.index_chunks(self.vector_store.document_chunk_ids(file), compact=False)
+                    ASCIIColors.success(f"File {file} loaded from the embedding cache")
+                    continue
+                files_to_read[file] = cache_key
+            except Exception as ex:
+                ASCIIColors.error(f"Couldn't add {file}: {ex}")
+                trace_exception(ex)
+                failures.append(file)
 
+        # Text extraction runs in worker processes, chunking and embedding need the model so they
+        # are done here, file by file, as soon as each extraction completes
+        for file, text, error, extraction_time in self.read_files(list(files_to_read.keys())):
+            try:
+                if error is not None:
+                    raise error
+                start_time = time.perf_counter()
                 self.vector_store.add_document(file, text, chunk_size=chunk_size, overlap_size=overlap_size)
-                
-                ASCIIColors.success(f"File {file} added successfully")
+                chunk_ids = self.vector_store.document_chunk_ids(file)
+                self.vector_store.index_chunks(chunk_ids, compact=False)
+                ASCIIColors.success(f"File {file} added successfully: {len(chunk_ids)} chunks, extracted after {extraction_time:.2f}s, chunked and embedded in {time.perf_counter()-start_time:.2f}s")
             except Exception as ex:
                 ASCIIColors.error(f"Couldn't add {file}: The vectorizer threw this exception:{ex}")
                 trace_exception(ex)
-                return False
-        try:
-            self.vector_store.index()
+                failures.append(file)
+                continue
+            try:
+                self.embedding_cache.put(files_to_read[file], self.vector_store.document_chunks(file))
+            except Exception as ex:
+                ASCIIColors.warning(f"Couldn't cache the embeddings of {file}: {ex}")
+
+        self.vector_store.schedule_compaction()
+        if self._opened_collection is not None:
+            self.collections.update_size(self._opened_collection)
+        if len(self.vector_store.chunks)>0:
             self.ready = True
             ASCIIColors.success(f"Database indexed successfully")
-            return True
-        except Exception as ex:
-            ASCIIColors.error(f"Couldn't vectorize database The vectorizer threw this exception:{ex}")
-            trace_exception(ex)
-            return False
+        for file in failures:
+            self.step_start(f"Couldn't add {Path(file).name}")
+            self.step_end(f"Couldn't add {Path(file).name}", status=False)
+        cache_stats = self.embedding_cache.stats()
+        ASCIIColors.info(cache_stats)
+        self.step_start(cache_stats)
+        self.step_end(cache_stats)
+        return len(failures)==0
+
+    def read_files(self, files):
+        """
+        Extracts the text of the files, using a pool of ingest_workers processes when there is
+        more than one file. Yields (file, text, exception, seconds since the start) in completion
+        order so a file that fails only fails itself.
+        """
+        start_time = time.perf_counter()
+        workers = int(self.personality_config.ingest_workers)
+        if workers<=0:
+            workers = min(4, os.cpu_count() or 1)
+        if workers==1 or len(files)<=1:
+            for file in files:
+                try:
+                    yield file, GenericDataLoader.read_file(Path(file)), None, time.perf_counter()-start_time
+                except Exception as ex:
+                    yield file, None, ex, time.perf_counter()-start_time
+            return
+        with ProcessPoolExecutor(max_workers=min(workers, len(files))) as executor:
+            futures = {executor.submit(GenericDataLoader.read_file, Path(file)): file for file in files}
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result(), None, time.perf_counter()-start_time
+                except Exception as ex:
+                    yield futures[future], None, ex, time.perf_counter()-start_time
             
     def add_file(self, path, callback=None):
         if callback is None and self.callback is not None:
             callback = self.callback
         super().add_file(path)
         self.prepare()
+        # Keywords only depend on the prompt, retrieved chunks depend on the database content
+        self.query_cache.clear("retrieval")
         try:
             self.new_message("",MSG_TYPE.MSG_TYPE_FULL_INVISIBLE_TO_AI)
             self.step_start("Vectorizing database", callback = callback)
-            if not self.build_db():
+            if not self.build_db([path]):
                 self.step_end("Vectorizing database",status=False, callback = callback)
             else:
                 self.step_end("Vectorizing database",status=True, callback = callback)
@@ -312,25 +1969,38 @@ class Processor(APScript):
             self.finished_message("Error importing message")
             return False        
 
+    def open_store(self, database_path, save_db):
+        return DocsVectorStore(                     
+                self.personality_config.vectorization_method, # supported "model_embedding" or "tfidf_vectorizer"
+                model=self.personality.model, #needed in case of using model_embedding
+                database_path=database_path,
+                save_db=save_db,
+                search_index=self.personality_config.search_index,
+                ivf_nprobe=self.personality_config.ivf_nprobe,
+                hybrid=self.personality_config.hybrid_retrieval,
+                bm25_candidates=self.personality_config.bm25_candidates
+        )
+
     def prepare(self):
-        if self.vector_store is None:
-            root_db_folder = self.personality.lollms_paths.personal_databases_path/self.personality.personality_folder_name
+        root_db_folder = self.personality.lollms_paths.personal_databases_path/self.personality.personality_folder_name
+        if self.collections is None:
+            # Collections live on disk whatever save_db says, closing one must not lose it
+            self.collections = CollectionManager(root_db_folder/"collections", lambda database_path:self.open_store(database_path, True), int(self.personality_config.collections_memory_mb)*1024*1024)
+        if self._vector_store is None:
             root_db_folder.mkdir(exist_ok=True, parents=True)
-            self.vector_store = TextVectorizer(                     
-                    self.personality_config.vectorization_method, # supported "model_embedding" or "tfidf_vectorizer"
-                    model=self.personality.model, #needed in case of using model_embedding
-                    database_path=root_db_folder/"db.json" if self.personality_config.custom_db_path=="" else self.personality_config.custom_db_path,
-                    save_db=self.personality_config.save_db
-            )        
-
-
-        if self.vector_store and self.personality_config.vectorization_method==VectorizationMethod.TFIDF_VECTORIZER:
-            from sklearn.feature_extraction.text import TfidfVectorizer
-            data = list(self.vector_store.texts.values())
-            if len(data)>0:
-                self.vectorizer = TfidfVectorizer()
-                self.vectorizer.fit(data)
-
+            collection = self.personality_config.collection.strip()
+            if collection!="":
+                self.collections.active = collection
+                self.vector_store = self.collections.get(collection)
+                self._opened_collection = collection
+            else:
+                self.vector_store = self.open_store(root_db_folder/"db.json" if self.personality_config.custom_db_path=="" else self.personality_config.custom_db_path, self.personality_config.save_db)
+                self._opened_collection = None
+        if self.embedding_cache is None:
+            self.embedding_cache = EmbeddingCache(
+                    self.personality.lollms_paths.personal_databases_path/self.personality.personality_folder_name/"embedding_cache",
+                    int(self.personality_config.embedding_cache_size_mb)*1024*1024
+            )
         if len(self.vector_store.chunks)>0:
             self.ready = True
 
@@ -359,11 +2029,10 @@ class Processor(APScript):
         Returns:
             None
         """
-        # State machine
+        # State machine, the vector store is opened by the first command that needs it
         self.callback = callback
-        self.prepare()
 
-        self.process_state(prompt, full_context, callback)
+        self.process_state(prompt, previous_discussion_text, callback)
 
         return ""
 
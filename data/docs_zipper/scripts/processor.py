@@ -5,11 +5,242 @@ from lollms.types import MSG_TYPE
 from typing import Callable
 
 from safe_store.generic_data_loader import GenericDataLoader
-from safe_store.document_decomposer import DocumentDecomposer
 import subprocess
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import site
+import time
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+# Modules shared by the personalities of the zoo live in its shared folder
+site.addsitedir(str(Path(__file__).resolve().parents[3]/"shared"))
+import text_chunking
 
 # Helper functions
+class TokenCounter:
+    """
+    Exact token counts cached by text hash (least recently used entries go first), so a text
+    is never tokenized twice. The size of a document made of measured parts is the sum of their
+    counts. calls counts the tokenizer calls, saved the counts found in the cache (tokenizer
+    calls actually avoided).
+    """
+    def __init__(self, tokenize, max_entries=65536):
+        self.tokenize = tokenize
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.counts = OrderedDict()
+        self.calls = 0
+        self.saved = 0
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha1(text.encode("utf-8")).digest()
+
+    def count(self, text):
+        key = TokenCounter.key(text)
+        with self.lock:
+            nb_tokens = self.counts.get(key)
+            if nb_tokens is not None:
+                self.counts.move_to_end(key)
+                self.saved += 1
+                return nb_tokens
+        nb_tokens = len(self.tokenize(text))
+        with self.lock:
+            self.calls += 1
+            self._put(key, nb_tokens)
+        return nb_tokens
+
+    def _put(self, key, nb_tokens):
+        self.counts[key] = nb_tokens
+        self.counts.move_to_end(key)
+        while len(self.counts)>self.max_entries:
+            self.counts.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return f"Token counts: {self.calls} tokenizer call(s), {self.saved} saved"
+
+
+class SummaryCache:
+    """
+    Persistent cache of the generated summaries, keyed by the hash of the summarized text, the
+    hash of the prompt frame (instruction, chunk name and summary size) and the model name.
+
+    Entries are appended to a jsonl file and loaded in memory when the cache is opened, so a
+    crash never loses more than the summary being written. At most max_entries summaries are
+    kept, the least recently used ones are evicted first. The file is rewritten with the kept
+    entries once the lines of evicted or superseded entries outnumber them, or when it has a
+    torn line. Safe to use from the worker threads.
+    """
+    def __init__(self, path:Path, max_entries=20000):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # Lines of the file, stale ones included
+        self.file_lines = 0
+        self.hits = 0
+        self.misses = 0
+        if self.path.exists():
+            torn = False
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    self.file_lines += 1
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry["key"]] = entry["summary"]
+                        self.entries.move_to_end(entry["key"])
+                    except (ValueError, KeyError):
+                        # Torn line of an interrupted write
+                        torn = True
+            with self.lock:
+                self._evict(compact=torn)
+
+    @staticmethod
+    def key(text, prompt_frame, model_name):
+        text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        frame_hash = hashlib.sha256(prompt_frame.encode("utf-8")).hexdigest()
+        return hashlib.sha256(f"{text_hash}|{frame_hash}|{model_name}".encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            summary = self.entries.get(key)
+            if summary is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return summary
+
+    def put(self, key, summary):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            self.entries[key] = summary
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"key":key, "summary":summary})+"\n")
+            self.file_lines += 1
+            self._evict()
+
+    def resize(self, max_entries):
+        with self.lock:
+            self.max_entries = max_entries
+            self._evict()
+
+    def _evict(self, compact=False):
+        while len(self.entries)>self.max_entries:
+            self.entries.popitem(last=False)
+        if compact or self.file_lines-len(self.entries)>len(self.entries):
+            self._compact()
+
+    def _compact(self):
+        """Rewrites the file with the kept entries, least recently used first"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = Path(str(self.path)+".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for key, summary in self.entries.items():
+                f.write(json.dumps({"key":key, "summary":summary})+"\n")
+        os.replace(tmp_path, self.path)
+        self.file_lines = len(self.entries)
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.file_lines = 0
+            if self.path.exists():
+                self.path.unlink()
+
+    def stats(self):
+        with self.lock:
+            total = self.hits+self.misses
+            return f"Summary cache: {self.hits} hit(s), {self.misses} miss(es)" + (f", {100*self.hits/total:.0f}% hit rate" if total>0 else "")
+
+
+class ZipJobManifest:
+    """
+    On disk state of a folder zipping job, rewritten atomically after every summarization level.
+
+    files maps each document (path relative to the folder) to its state: status (pending,
+    running, done, skipped when no text could be extracted, or failed), a fingerprint of the file, the depth reached with the summaries
+    of that level (nodes), and the path of the summary once done. A restarted job skips the done
+    files and resumes the others after their last completed level. A file whose fingerprint
+    changed, or a job whose settings changed, starts over.
+    """
+    VERSION = 1
+
+    def __init__(self, path:Path, settings_hash:str):
+        self.path = Path(path)
+        self.settings_hash = settings_hash
+        self.lock = threading.Lock()
+        self.files = {}
+        if self.path.exists():
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+                if manifest.get("version")==ZipJobManifest.VERSION and manifest.get("settings_hash")==settings_hash:
+                    self.files = manifest["files"]
+                else:
+                    ASCIIColors.warning("The zipping settings changed since the last run, starting the folder over")
+            except (ValueError, KeyError) as ex:
+                ASCIIColors.warning(f"Couldn't read the job manifest {self.path}: {ex}")
+
+    @staticmethod
+    def fingerprint(path:Path):
+        stat = path.stat()
+        return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    def sync(self, names_and_paths):
+        """Adds the new files and resets the ones that changed. Returns the names left to zip"""
+        with self.lock:
+            for name, path in names_and_paths:
+                fingerprint = ZipJobManifest.fingerprint(path)
+                state = self.files.get(name)
+                if state is None or state["fingerprint"]!=fingerprint:
+                    self.files[name] = {"status":"pending", "fingerprint":fingerprint, "depth":-1, "nodes":[], "nb_chunks":0, "summary_path":"", "error":""}
+            self._save()
+            return [name for name, _ in names_and_paths if self.files[name]["status"] not in ["done", "skipped"]]
+
+    def resume_state(self, name):
+        with self.lock:
+            state = self.files[name]
+            if state["depth"]<0:
+                return None
+            return {"depth":state["depth"], "nodes":list(state["nodes"]), "nb_chunks":state["nb_chunks"]}
+
+    def update(self, name, **fields):
+        with self.lock:
+            self.files[name].update(fields)
+            self._save()
+
+    def counts(self, names):
+        with self.lock:
+            counts = {}
+            for state in [self.files[name] for name in names]:
+                counts[state["status"]] = counts.get(state["status"], 0)+1
+            return counts
+
+    def _save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = Path(str(self.path)+".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version":ZipJobManifest.VERSION, "settings_hash":self.settings_hash, "files":self.files}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
 class Processor(APScript):
     """
     A class that processes model inputs and outputs.
@@ -32,6 +263,13 @@ class Processor(APScript):
             [
                 {"name":"zip_mode","type":"str","value":"hierarchical","options":["hierarchical","one_shot"], "help":"algorithm"},
                 {"name":"zip_size","type":"int","value":512, "help":"the maximum size of the summary in tokens"},
+                {"name":"batch_folder","type":"str","value":"", "help":"Folder zipped by the zip_folder command (subfolders included)"},
+                {"name":"batch_output_folder","type":"str","value":"", "help":"Where zip_folder writes the summaries and its job manifest. If empty, a summaries subfolder of batch_folder is used"},
+                {"name":"batch_file_types","type":"str","value":".txt,.md,.pdf,.docx,.html,.pptx", "help":"Comma separated extensions of the files zipped by zip_folder"},
+                {"name":"file_workers","type":"int","value":1, "min":1, "max":64, "help":"Number of files zipped at the same time by zip_folder. The files share the max_workers generation slots, so this overlaps the extraction and the tokenization of the files but never runs more than max_workers generations at once"},
+                {"name":"use_summary_cache","type":"bool","value":True, "help":"If true, the summaries are saved and reused when the same text is summarized again with the same instructions and model, so only the chunks that changed are regenerated"},
+                {"name":"summary_cache_max_entries","type":"int","value":20000, "min":1, "max":10000000, "help":"Maximum number of summaries kept by the summary cache, the least recently used ones are evicted first"},
+                {"name":"max_workers","type":"int","value":1, "min":1, "max":64, "help":"Number of chunk summaries generated at the same time. Only raise it if the binding serves parallel requests (remote or server bindings)"},
                 {"name":"contextual_zipping_text","type":"str","value":"", "help":"Here you can specify elements of the document that you want the AI to keep or to search for. This garantees that if found, those elements will not be filtered out which results in a more intelligent contextual based summary."},
                 {"name":"keep_same_language","type":"bool","value":True, "help":"Force the algorithm to keep the same language and not translate the document to english"},
                 {"name":"translate_to","type":"str","value":"", "help":"Force the algorithm to summarize the document in a specific language. If none is provided then it won't do any translation"},
@@ -55,7 +293,9 @@ class Processor(APScript):
                                     "name": "idle",
                                     "commands": { # list of commands
                                         "help":self.help,
-                                        "start_zipping":self.start_zipping
+                                        "start_zipping":self.start_zipping,
+                                        "zip_folder":self.zip_folder,
+                                        "clear_summary_cache":self.clear_summary_cache
                                     },
                                     "default": None
                                 },                           
@@ -64,6 +304,9 @@ class Processor(APScript):
                         )
         self.cv = None
         self.position = None
+        self.summary_cache = None
+        self.token_counter = None
+        self.generation_slots = None
 
     def install(self):
         super().install()
@@ -86,51 +329,212 @@ class Processor(APScript):
         with open(path,"w", encoding="utf8") as f:
             f.write(text)
             
-    def zip_document(self, document_path:Path,  output_path:Path=None, output =""):
-        document_text = GenericDataLoader.read_file(document_path)
-        tk = self.personality.model.tokenize(document_text)
-        self.step_start(f"summerizing {document_path.stem}")
-        if len(tk)<int(self.personality_config.zip_size):
-                document_text = self.summerize([document_text],"Summerize this document chunk and do not add any comments after the summary.\nOnly extract the information from the provided chunk.\nDo not invent anything outside the provided text.","document chunk")
+    def guidelines(self):
+        """The instructions coming from the configuration, shared by the chunk and composition prompts"""
+        return [
+            f"{'Keep the same language.' if self.personality_config.keep_same_language else ''}",
+            f"{'Preserve the title of this document if provided.' if self.personality_config.preserve_document_title else ''}",
+            f"{'Preserve author names of this document if provided.' if self.personality_config.preserve_authors_name else ''}",
+            f"{'Preserve results if presented in the chunk and provide the numerical values if present.' if self.personality_config.preserve_results else ''}",
+            f"{'Eliminate any useless information and make the summary as short as possible.' if self.personality_config.maximum_compression else ''}",
+            f"{self.personality_config.contextual_zipping_text if self.personality_config.contextual_zipping_text!='' else ''}",
+            f"{'The summary should be written in '+self.personality_config.translate_to if self.personality_config.translate_to!='' else ''}"
+        ]
+
+    def chunk_instruction(self):
+        return "\n".join([line for line in [
+                f"Summerize the document chunk and do not add any comments after the summary.",
+                "The summary should contain exclusively information from the document chunk.",
+                "Do not provide opinions nor extra information that is not in the document chunk",
+            ]+self.guidelines() if line!=""])
+
+    def composition_instruction(self):
+        return "\n".join([line for line in [
+                f"Rewrite this document in a better way while respecting the following guidelines:",
+            ]+self.guidelines() if line!=""])
+
+    def get_token_counter(self):
+        if self.token_counter is None or self.token_counter.tokenize!=self.personality.model.tokenize:
+            self.token_counter = TokenCounter(self.personality.model.tokenize)
+        return self.token_counter
+
+    def group_nodes(self, nodes, counts, arity, budget):
+        """
+        Groups consecutive summaries for the next reduce level: at most arity summaries and,
+        using their cached token counts, at most budget tokens per group (a summary can
+        overflow zip_size when the binding ignores the generation limit)
+        """
+        groups = []
+        for node, nb_tokens in zip(nodes, counts):
+            # Two tokens for the blank line between two summaries
+            if len(groups)>0 and len(groups[-1][0])<arity and groups[-1][1]+nb_tokens+2<=budget:
+                groups[-1][0].append(node)
+                groups[-1][1] += nb_tokens+2
+            else:
+                groups.append([[node], nb_tokens])
+        return [("\n\n".join(group), nb_tokens) for group, nb_tokens in groups]
+
+    def truncate_nodes(self, nodes, counts, max_tokens):
+        """Cuts the summaries longer than max_tokens, returns the nodes and their new counts"""
+        truncated = []
+        for node, nb_tokens in zip(nodes, counts):
+            if nb_tokens>max_tokens:
+                node = self.personality.model.detokenize(self.personality.model.tokenize(node)[:max_tokens])
+            truncated.append(node)
+        return truncated, [min(nb_tokens, max_tokens) for nb_tokens in counts]
+
+    def get_generation_slots(self):
+        """Semaphore bounding the generations running at the same time to max_workers, whatever the number of files zipped at once"""
+        max_workers = max(1, int(self.personality_config.max_workers))
+        if self.generation_slots is None or self.generation_slots[0]!=max_workers:
+            self.generation_slots = (max_workers, threading.BoundedSemaphore(max_workers))
+        return self.generation_slots[1]
+
+    def get_summary_cache(self):
+        max_entries = max(1, int(self.personality_config.summary_cache_max_entries))
+        if self.summary_cache is None:
+            self.summary_cache = SummaryCache(self.personality.lollms_paths.personal_databases_path/self.personality.personality_folder_name/"summary_cache.jsonl", max_entries)
+        elif self.summary_cache.max_entries!=max_entries:
+            self.summary_cache.resize(max_entries)
+        return self.summary_cache
+
+    def clear_summary_cache(self, prompt="", full_context=""):
+        self.get_summary_cache().clear()
+        self.full("Summary cache cleared")
+
+    def summarize_chunk(self, chunk, instruction, chunk_name="Document chunk"):
+        """One generation: the summary of chunk following instruction, at most zip_size tokens"""
+        prompt_frame = "\n".join([
+                    f"!@>{chunk_name}:",
+                    "{chunk}",
+                    f"!@>instruction: {instruction}",
+                    "Answer directly with the summary with no extra comments.",
+                    "!@>summary:"
+                ])
+        cache = self.get_summary_cache() if self.personality_config.use_summary_cache else None
+        if cache is not None:
+            key = SummaryCache.key(chunk, f"{prompt_frame}|{self.zip_size()}", self.personality.config.model_name)
+            summary = cache.get(key)
+            if summary is not None:
+                return summary
+        with self.get_generation_slots():
+            summary = self.fast_gen(prompt_frame.replace("{chunk}", chunk, 1), max_generation_size=self.zip_size()).strip()
+        if cache is not None:
+            cache.put(key, summary)
+        return summary
+
+    def chunk_size(self):
+        """Size of the chunks and of the groups of summaries, 60% of the context"""
+        return int(self.personality.config.ctx_size*0.6)
+
+    def zip_size(self):
+        """zip_size clamped so that two summaries and the blank line between them fit in a chunk"""
+        return max(1, min(int(self.personality_config.zip_size), self.chunk_size()//2-2))
+
+    def fan_in(self, chunk_size):
+        """Number of summaries merged by one reduce step: as many zip_size summaries as fit in a chunk"""
+        return max(2, chunk_size//self.zip_size())
+
+    def summarize_all(self, executor, chunks, instruction, chunk_name):
+        """Summarizes the chunks on the worker pool, summaries are returned in the chunks order"""
+        return list(executor.map(lambda chunk: self.summarize_chunk(chunk, instruction, chunk_name), chunks))
+
+    def zip_text(self, document_name, document_text, resume=None, checkpoint=None, verbose=True, output=""):
+        """
+        Map-reduce summarization: the document is cut into chunks of 60% of the context, each
+        chunk is summarized (map), then the summaries are merged fan_in at a time, level after
+        level, until one summary is left (reduce), and that summary is rewritten following the
+        guidelines. The generations of a level are independent and run on a pool of max_workers
+        threads.
+
+        Every text is measured once by the TokenCounter: chunk sizes come from the chunker,
+        each summary is counted when it is generated, and the size of a level is the sum of
+        its parts instead of a tokenization of the whole level.
+
+        checkpoint(state) is called after every level with {"depth", "nodes", "nb_chunks"}, and
+        resume takes such a state to restart after the last completed level. verbose=False
+        keeps the progress out of the UI (folder mode zips several documents at once).
+
+        A document with no text gives an empty summary. When the summaries of a level are too
+        long to share a chunk (bindings that ignore the generation limit), they are truncated
+        and merged by pairs so that every level at least halves the number of summaries.
+        """
+        chunk_size = self.chunk_size()
+        arity = self.fan_in(chunk_size)
+        counter = self.get_token_counter()
+        calls, saved = counter.calls, counter.saved
+        if resume is None:
+            chunks = text_chunking.chunk_document(document_text, chunk_size, self.personality.model.tokenize, self.personality.model.detokenize)
+            nodes = [chunk["text"] for chunk in chunks]
+            nb_chunks = len(nodes)
+            depth = 0
+            ASCIIColors.info(f"{document_name}: {sum(len(chunk['tokens']) for chunk in chunks)} tokens")
         else:
-            depth=0
-            while len(tk)>int(self.personality_config.zip_size):
-                self.step_start(f"Comprerssing.. [depth {depth}]")
-                chunk_size = int(self.personality.config.ctx_size*0.6)
-                document_chunks = DocumentDecomposer.decompose_document(document_text, chunk_size, 0, self.personality.model.tokenize, self.personality.model.detokenize, True)
-                document_text = self.summerize(document_chunks,"\n".join([
-                        f"Summerize the document chunk and do not add any comments after the summary.",
-                        "The summary should contain exclusively information from the document chunk.",
-                        "Do not provide opinions nor extra information that is not in the document chunk",
-                        f"{'Keep the same language.' if self.personality_config.keep_same_language else ''}",
-                        f"{'Preserve the title of this document if provided.' if self.personality_config.preserve_document_title else ''}",
-                        f"{'Preserve author names of this document if provided.' if self.personality_config.preserve_authors_name else ''}",
-                        f"{'Preserve results if presented in the chunk and provide the numerical values if present.' if self.personality_config.preserve_results else ''}",
-                        f"{'Eliminate any useless information and make the summary as short as possible.' if self.personality_config.maximum_compression else ''}",
-                        f"{self.personality_config.contextual_zipping_text if self.personality_config.contextual_zipping_text!='' else ''}",
-                        f"{'The summary should be written in '+self.personality_config.translate_to if self.personality_config.translate_to!='' else ''}"
-                    ]),
-                    "!@>Document chunk"
-                    )
-                tk = self.personality.model.tokenize(document_text)
-                self.step_end(f"Comprerssing.. [depth {depth}]")
-                self.full(output+f"\n\n## Summerized chunk text:\n{document_text}")
+            nodes = resume["nodes"]
+            counts = [counter.count(node) for node in nodes]
+            nb_chunks = resume["nb_chunks"]
+            depth = resume["depth"]+1
+        if len(nodes)==0:
+            ASCIIColors.warning(f"{document_name}: no text to zip")
+            return "", output
+        depths = 0
+        while -(-nb_chunks//arity**depths)>1:
+            depths += 1
+        ASCIIColors.info(f"{document_name}: {nb_chunks} chunks of up to {chunk_size} tokens, fan in {arity}, {depths} reduce level(s)" + (f", resuming at depth {depth}" if resume is not None else ""))
+        timings = []
+        with ThreadPoolExecutor(max_workers=max(1, int(self.personality_config.max_workers))) as executor:
+            instruction = self.chunk_instruction()
+            while resume is None or len(nodes)>1:
+                if verbose:
+                    self.step_start(f"Comprerssing.. [depth {depth}]")
+                start_time = time.perf_counter()
+                if depth==0:
+                    nodes = self.summarize_all(executor, nodes, instruction, "Document chunk")
+                else:
+                    groups = self.group_nodes(nodes, counts, arity, chunk_size)
+                    if len(groups)==len(nodes):
+                        ASCIIColors.warning(f"{document_name}: the summaries of depth {depth-1} don't fit {arity} per chunk, truncating them")
+                        nodes, counts = self.truncate_nodes(nodes, counts, (chunk_size-2)//2)
+                        groups = self.group_nodes(nodes, counts, 2, chunk_size)
+                    nodes = self.summarize_all(executor, [group for group, _ in groups], instruction, "Summaries of consecutive document chunks")
+                counts = [counter.count(node) for node in nodes]
+                level_size = sum(counts)
+                timings.append(time.perf_counter()-start_time)
+                if checkpoint is not None:
+                    checkpoint({"depth":depth, "nodes":nodes, "nb_chunks":nb_chunks})
+                if verbose:
+                    self.step_end(f"Comprerssing.. [depth {depth}]")
+                    if self.personality_config.use_summary_cache:
+                        cache_stats = self.get_summary_cache().stats()
+                        self.step_start(cache_stats)
+                        self.step_end(cache_stats)
+                    output += f"\n- depth {depth}: {len(nodes)} summar{'y' if len(nodes)==1 else 'ies'}, {level_size} tokens in {timings[-1]:.1f}s"
+                    self.full(output)
+                if len(nodes)<=1:
+                    break
                 depth += 1
-        self.step_start(f"Last composition")
-        document_text = self.summerize(document_chunks,"\n".join([
-                f"Rewrite this document in a better way while respecting the following guidelines:",
-                f"{'Keep the same language.' if self.personality_config.keep_same_language else ''}",
-                f"{'Preserve the title of this document if provided.' if self.personality_config.preserve_document_title else ''}",
-                f"{'Preserve author names of this document if provided.' if self.personality_config.preserve_authors_name else ''}",
-                f"{'Preserve results if presented in the chunk and provide the numerical values if present.' if self.personality_config.preserve_results else ''}",
-                f"{'Eliminate any useless information and make the summary as short as possible.' if self.personality_config.maximum_compression else ''}",
-                f"{self.personality_config.contextual_zipping_text if self.personality_config.contextual_zipping_text!='' else ''}",
-                f"{'The summary should be written in '+self.personality_config.translate_to if self.personality_config.translate_to!='' else ''}"
-            ]),
-            "!@>Document chunk"
-            )
+        document_text = nodes[0] if len(nodes)>0 else ""
+        if nb_chunks>1:
+            if verbose:
+                self.step_start(f"Last composition")
+            start_time = time.perf_counter()
+            document_text = self.summarize_chunk(document_text, self.composition_instruction())
+            timings.append(time.perf_counter()-start_time)
+            if verbose:
+                self.step_end(f"Last composition")
+        token_stats = f"{document_name}: {counter.calls-calls} tokenizer call(s), {counter.saved-saved} saved by the token count cache"
+        ASCIIColors.info(token_stats)
+        if verbose:
+            self.step_start(token_stats)
+            self.step_end(token_stats)
+        level_timings = timings[:-1] if nb_chunks>1 else timings
+        ASCIIColors.info(f"{document_name} zipped in {sum(timings):.1f}s (" + ", ".join([f"depth {depth-len(level_timings)+1+i}: {t:.1f}s" for i, t in enumerate(level_timings)]) + (f", composition: {timings[-1]:.1f}s)" if nb_chunks>1 else ")"))
+        return document_text, output
 
-        self.step_end(f"Last composition")
+    def zip_document(self, document_path:Path,  output_path:Path=None, output =""):
+        document_text = GenericDataLoader.read_file(document_path)
+        self.step_start(f"summerizing {document_path.stem}")
+        document_text, output = self.zip_text(document_path.name, document_text, output=output)
         self.step_end(f"summerizing {document_path.stem}")
         if output_path:
             self.save_text(document_text, output_path/(document_path.stem+"_summary.txt"))
@@ -140,6 +544,10 @@ class Processor(APScript):
 
     def start_zipping(self, prompt="", full_context=""):
         self.new_message("")
+        if self.personality_config.use_summary_cache:
+            # The hit rate shown in the step log is the one of this job
+            self.get_summary_cache().reset_stats()
+        self.get_generation_slots()
         for file in self.text_files:
             output=""
             file = Path(file)
@@ -148,6 +556,81 @@ class Processor(APScript):
             self.full(output)
 
 
+    def zip_folder(self, prompt="", full_context=""):
+        """
+        Zips every document of batch_folder, file_workers files at a time. Progress is kept in a
+        job manifest next to the summaries so an interrupted job resumes where it stopped
+        (running the command again continues the job). Summaries already generated inside an
+        unfinished level come back from the summary cache. Files with no extractable text (empty
+        or scanned documents) are skipped with a warning and are not retried until they change.
+        """
+        self.new_message("")
+        if self.personality_config.batch_folder=="":
+            self.full("Please set the batch_folder option to the folder to zip")
+            return
+        folder = Path(self.personality_config.batch_folder)
+        output_folder = Path(self.personality_config.batch_output_folder) if self.personality_config.batch_output_folder!="" else folder/"summaries"
+        extensions = {extension.strip().lower() for extension in self.personality_config.batch_file_types.split(",") if extension.strip()!=""}
+        files = sorted(path for path in folder.rglob("*") if path.is_file() and path.suffix.lower() in extensions and output_folder not in path.parents)
+        settings = "|".join([self.chunk_instruction(), self.composition_instruction(), str(self.personality_config.zip_size), str(self.personality.config.ctx_size), self.personality.config.model_name])
+        manifest = ZipJobManifest(output_folder/"zip_manifest.json", hashlib.sha256(settings.encode("utf-8")).hexdigest())
+        names = {path.relative_to(folder).as_posix():path for path in files}
+        pending = manifest.sync(list(names.items()))
+        if self.personality_config.use_summary_cache:
+            self.get_summary_cache().reset_stats()
+        counts = manifest.counts(names)
+        self.step_start(f"Zipping {len(pending)} of {len(files)} file(s) from {folder}")
+        ASCIIColors.info(f"Folder job: {counts.get('done', 0)} done, {len(pending)} to zip ({sum(1 for name in pending if manifest.files[name]['depth']>=0)} resumed)")
+        start_time = time.perf_counter()
+        # Created before the file workers start so that they all share it
+        self.get_generation_slots()
+
+        def zip_file(name):
+            path = names[name]
+            manifest.update(name, status="running")
+            try:
+                text = GenericDataLoader.read_file(path)
+                if text.strip()=="":
+                    ASCIIColors.warning(f"No text could be extracted from {name}, skipping it")
+                    manifest.update(name, status="skipped", nodes=[], error="no text could be extracted")
+                    return name
+                summary, _ = self.zip_text(
+                                        name,
+                                        text,
+                                        resume=manifest.resume_state(name),
+                                        checkpoint=lambda state: manifest.update(name, **state),
+                                        verbose=False
+                                    )
+                summary_path = output_folder/(name+"_summary.txt")
+                summary_path.parent.mkdir(parents=True, exist_ok=True)
+                self.save_text(summary, summary_path)
+                # The partial summaries are not needed anymore
+                manifest.update(name, status="done", nodes=[], summary_path=str(summary_path))
+            except Exception as ex:
+                ASCIIColors.error(f"Couldn't zip {name}: {ex}")
+                manifest.update(name, status="failed", error=str(ex))
+            return name
+
+        done = 0
+        with ThreadPoolExecutor(max_workers=max(1, int(self.personality_config.file_workers))) as executor:
+            for future in as_completed([executor.submit(zip_file, name) for name in pending]):
+                done += 1
+                name = future.result()
+                status = manifest.files[name]["status"]
+                self.step_start(f"[{done}/{len(pending)}] {name}")
+                self.step_end(f"[{done}/{len(pending)}] {name}", status=status in ["done", "skipped"])
+        self.step_end(f"Zipping {len(pending)} of {len(files)} file(s) from {folder}")
+
+        counts = manifest.counts(names)
+        report = f"Zipped {counts.get('done', 0)}/{len(files)} file(s) of {folder} into {output_folder} in {time.perf_counter()-start_time:.1f}s"
+        if counts.get("skipped", 0)>0:
+            report += f"\n{counts['skipped']} file(s) skipped, no text could be extracted:\n" + "\n".join([f"- {name}" for name, state in manifest.files.items() if state["status"]=="skipped"])
+        if counts.get("failed", 0)>0:
+            report += f"\n{counts['failed']} file(s) failed, run zip_folder again to retry them:\n" + "\n".join([f"- {name}: {state['error']}" for name, state in manifest.files.items() if state["status"]=="failed"])
+        if self.personality_config.use_summary_cache:
+            report += "\n"+self.get_summary_cache().stats()
+        self.full(report)
+
     def run_workflow(self, prompt:str, previous_discussion_text:str="", callback: Callable[[str, MSG_TYPE, dict, list], bool]=None, context_details:dict=None):
         """
         This function generates code based on the given parameters.
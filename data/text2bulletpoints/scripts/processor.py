@@ -3,51 +3,131 @@ from lollms.types import MSG_TYPE
 from lollms.personality import APScript, AIPersonality
 from lollms.helpers import ASCIIColors
 
+import io
 import json
+import os
+import time
 from pathlib import Path
 
 
 class Text2Paragraphs:
-    def __init__(self, database_path=None, max_chunk_size=2000):
-        self.paragraphs = []
+    """
+    Paragraph store of the personality.
+
+    Paragraphs are appended to a jsonl file (one {"paragraph": ...} record per line) as soon as
+    they are built, so adding a document never rewrites the store, and text files are read line
+    by line instead of being loaded whole. Stores saved as a single json file by older versions
+    are converted on first load.
+    """
+    def __init__(self, database_path=None, max_chunk_size=2000, progress_interval=0.5):
+        self._paragraphs = None
         self.database_path = database_path
+        self.store_path = Path(database_path).with_suffix(".jsonl") if database_path is not None else None
         self.max_chunk_size = max_chunk_size
-        if database_path is not None:
-            if Path(database_path).exists():
-                self.load_from_json()
+        self.progress_interval = progress_interval
+        if self.store_path is None:
+            self._paragraphs = []
+        elif not self.store_path.exists() and Path(database_path).exists():
+            self.load_from_json()
+            self.rewrite(self._paragraphs)
 
-    def chunk_text(self, text):
-        paragraphs = text.split("\n")  # Split text by double newlines to separate paragraphs
-        if self.max_chunk_size is not None:
-            current_chunk = []
-            current_chunk_size = 0
-            for i,paragraph in enumerate(paragraphs):
-                ASCIIColors.yellow(f"Processing paragraph:{i}/{len(paragraphs)}",end="\r")
-                if current_chunk_size + len(paragraph) <= self.max_chunk_size:
-                    current_chunk.append(paragraph)
-                    current_chunk_size += len(paragraph)
-                else:
-                    self.paragraphs.append("\n".join(current_chunk))
-                    current_chunk = [paragraph]
-                    current_chunk_size = len(paragraph)
+    @property
+    def paragraphs(self):
+        """All the paragraphs, loaded from the store on first access"""
+        if self._paragraphs is None:
+            self._paragraphs = list(self.iter_paragraphs())
+        return self._paragraphs
+
+    def iter_paragraphs(self):
+        """Yields the paragraphs one at a time without loading the whole store"""
+        if self._paragraphs is not None:
+            yield from self._paragraphs
+        elif self.store_path.exists():
+            with open(self.store_path, "r", encoding="utf-8") as file:
+                for line in file:
+                    if line.strip()!="":
+                        yield json.loads(line)["paragraph"]
+
+    def exists(self):
+        return self.store_path is not None and (self.store_path.exists() or Path(self.database_path).exists())
+
+    def clear(self):
+        if self.store_path is not None:
+            for path in [self.store_path, Path(self.database_path)]:
+                if path.exists():
+                    path.unlink()
+        self._paragraphs = [] if self.store_path is None else None
+
+    def chunk_lines(self, lines, total_size=None):
+        """
+        Packs lines into paragraphs of at most max_chunk_size characters and appends them to the
+        store. lines can be any iterable of lines, an open file is read incrementally and only the
+        paragraph being built is kept in memory. Returns the number of added paragraphs.
+        """
+        file = open(self.store_path, "a", encoding="utf-8") if self.store_path is not None else None
+        nb_added = 0
+        read_size = 0
+        last_report = time.perf_counter()
+        current_chunk = []
+        current_chunk_size = 0
+
+        def append(paragraph):
+            if file is not None:
+                file.write(json.dumps({"paragraph":paragraph})+"\n")
+            if self._paragraphs is not None:
+                self._paragraphs.append(paragraph)
+
+        try:
+            for line in lines:
+                read_size += len(line)
+                if line.endswith("\n"):
+                    line = line[:-1]
+                if self.max_chunk_size is None:
+                    append(line)
+                    nb_added += 1
+                elif current_chunk and current_chunk_size + len(line) > self.max_chunk_size:
+                    append("\n".join(current_chunk))
+                    nb_added += 1
+                    current_chunk = []
+                    current_chunk_size = 0
+                if self.max_chunk_size is not None:
+                    current_chunk.append(line)
+                    current_chunk_size += len(line)
+                if time.perf_counter()-last_report>=self.progress_interval:
+                    last_report = time.perf_counter()
+                    progress = f" ({100*min(1, read_size/total_size):.0f}%)" if total_size else ""
+                    ASCIIColors.yellow(f"Processing: {read_size/1e6:.1f} MB read{progress}, {nb_added} paragraphs", end="\r")
             if current_chunk:
-                self.paragraphs.append("\n".join(current_chunk))
-        else:
-            self.paragraphs.extend(paragraphs)  # Add new paragraphs to the existing ones
+                append("\n".join(current_chunk))
+                nb_added += 1
+        finally:
+            if file is not None:
+                file.close()
+        ASCIIColors.yellow(f"Processed {read_size/1e6:.1f} MB into {nb_added} paragraphs")
+        return nb_added
+
+    def chunk_text(self, text):
+        return self.chunk_lines(io.StringIO(text), len(text))
+
+    def chunk_file(self, file_path):
+        """Chunks a text file without reading it whole"""
+        with open(file_path, "r", encoding="utf-8") as file:
+            return self.chunk_lines(file, Path(file_path).stat().st_size)
+
+    def rewrite(self, paragraphs):
+        """Replaces the content of the store, the new file is moved in place once fully written"""
+        temporary_path = self.store_path.with_suffix(".jsonl.tmp")
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            for paragraph in paragraphs:
+                file.write(json.dumps({"paragraph":paragraph})+"\n")
+        os.replace(temporary_path, self.store_path)
 
     def load_from_json(self, filename=None):
         if filename is None:
             filename = self.database_path
         with open(filename, "r") as file:
             data = json.load(file)
-            self.paragraphs = data["paragraphs"]
-
-    def save_to_json(self, filename=None):
-        if filename is None:
-            filename = self.database_path
-        data = {"paragraphs": self.paragraphs}
-        with open(filename, "w") as file:
-            json.dump(data, file)
+            self._paragraphs = data["paragraphs"]
 
 
 class Processor(APScript):
@@ -151,9 +231,9 @@ class Processor(APScript):
             content = file.read()
         return content
     
-    def build_db(self):
+    def build_db(self, files=None):
         ASCIIColors.info("-> Vectorizing the database"+ASCIIColors.color_orange)
-        for file in self.text_files:
+        for file in self.text_files if files is None else files:
             try:
                 if Path(file).suffix==".pdf":
                     text =  Processor.read_pdf_file(file)
@@ -168,10 +248,11 @@ class Processor(APScript):
                 elif Path(file).suffix==".html":
                     text =  Processor.read_html_file(file)
                 else:
-                    text =  Processor.read_text_file(file)
-                    
-                self.text_store.chunk_text(text)       
-                self.text_store.save_to_json()         
+                    text =  None
+                if text is None:
+                    self.text_store.chunk_file(file)
+                else:
+                    self.text_store.chunk_text(text)
                 print(ASCIIColors.color_reset)
                 ASCIIColors.success(f"File {file} vectorized successfully")
             except Exception as ex:
@@ -182,7 +263,7 @@ class Processor(APScript):
             callback = self.callback
         super().add_file(path)
         try:
-            self.build_db()
+            self.build_db([path])
             self.info("File added successfully", callback=callback)
             return True
         except Exception as ex:
@@ -223,16 +304,15 @@ class Processor(APScript):
             if callback:
                 callback("Current database\n",MSG_TYPE.MSG_TYPE_CHUNK)
                 print("Current database\n")
-            for chunk in self.text_store.paragraphs:
+            for chunk in self.text_store.iter_paragraphs():
                 if callback:
                     callback(chunk+"\n",MSG_TYPE.MSG_TYPE_CHUNK)
                     print(chunk)
             
             self.state = 0
         elif prompt.strip().lower()=="clear_database":
-            database_fill_path:Path = self.personality.lollms_paths.personal_data_path/self.personality_config["database_path"]
-            if database_fill_path.exists():
-                database_fill_path.unlink()
+            if self.text_store.exists():
+                self.text_store.clear()
                 self.personality_config.database_path = prompt
                 self.personality_config.save()
                 self.text_store = Text2Paragraphs(
@@ -258,8 +338,7 @@ class Processor(APScript):
                 if len(chunk.split())<50:
                     print(chunk)
                     continue
-                docs = |
-  !@>Instructions:\nSummarize the following paragraph in the form of bullet points.\nBe concise and only keep most important ideas.\nUse short sentences\nParagraph:'+chunk+"\nBullet points:\n-"
+                docs = '!@>Instructions:\nSummarize the following paragraph in the form of bullet points.\nBe concise and only keep most important ideas.\nUse short sentences\nParagraph:'+chunk+"\nBullet points:\n-"
                 ASCIIColors.error("\n-------------- Documentation -----------------------")
                 ASCIIColors.error(docs)
                 ASCIIColors.error("----------------------------------------------------")
@@ -270,7 +349,7 @@ class Processor(APScript):
                     callback(output, MSG_TYPE.MSG_TYPE_CHUNK)
                     
         elif prompt.strip().lower()=="clear_database":
-            (self.personality.lollms_paths.personal_data_path/self.personality_config["database_path"]).unlink()
+            self.text_store.clear()
             self.text_store = Text2Paragraphs(
                             self.personality.lollms_paths.personal_data_path/self.personality_config.database_path,
                             max_chunk_size=self.personality_config.max_chunk_size
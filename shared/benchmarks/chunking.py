@@ -0,0 +1,137 @@
+"""
+Chunking micro-benchmark for the shared text_chunking module.
+
+Compares the per sentence chunkers the personalities used (a ". " split with one tokenize call
+per sentence, and safe_store's DocumentDecomposer, both detokenizing every chunk) with
+text_chunking.chunk_document (regex sentence spans, batched token counting and offset based
+chunks) on a synthetic corpus.
+
+The tokenizer is a regex word tokenizer with a configurable per call latency that stands for
+the round trip to a model binding.
+
+Usage:
+    python shared/benchmarks/chunking.py --size-mb 10 --chunk-size 512 --call-latency-us 50
+"""
+import argparse
+import importlib.util
+import random
+import re
+import time
+from pathlib import Path
+
+
+def load_text_chunking():
+    module_path = Path(__file__).resolve().parent.parent / "text_chunking.py"
+    spec = importlib.util.spec_from_file_location("text_chunking", str(module_path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class BenchTokenizer:
+    def __init__(self, call_latency_us):
+        self.call_latency = call_latency_us/1e6
+        self.vocabulary = {}
+        self.words = []
+        self.calls = 0
+
+    def _wait(self):
+        self.calls += 1
+        if self.call_latency>0:
+            end = time.perf_counter()+self.call_latency
+            while time.perf_counter()<end:
+                pass
+
+    def tokenize(self, text):
+        self._wait()
+        tokens = []
+        for word in re.findall(r"\s*\S+", text):
+            if word not in self.vocabulary:
+                self.vocabulary[word] = len(self.words)
+                self.words.append(word)
+            tokens.append(self.vocabulary[word])
+        return tokens
+
+    def detokenize(self, tokens):
+        self._wait()
+        return "".join(self.words[t] for t in tokens)
+
+
+def build_corpus(size_mb, seed=0):
+    rng = random.Random(seed)
+    words = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 10))) for _ in range(5000)]
+    parts = []
+    size = 0
+    while size<size_mb*1024*1024:
+        sentence = " ".join(rng.choice(words) for _ in range(rng.randint(4, 40))).capitalize()+". "
+        if rng.random()<0.05:
+            sentence += "\n\n"
+        parts.append(sentence)
+        size += len(sentence)
+    return "".join(parts)
+
+
+def legacy_chunks(text, chunk_size, tokenize, detokenize):
+    sentences = [sentence for sentence in text.split('. ') if sentence.strip() != '']
+    chunks = []
+    current_chunk = []
+    for sentence in sentences:
+        sentence_tokens = tokenize(sentence)
+        if len(current_chunk) + len(sentence_tokens) <= chunk_size:
+            current_chunk.extend(sentence_tokens)
+        else:
+            if current_chunk:
+                chunks.append(current_chunk)
+            while len(sentence_tokens)>chunk_size:
+                current_chunk = sentence_tokens[0:chunk_size]
+                sentence_tokens = sentence_tokens[chunk_size:]
+                chunks.append(current_chunk)
+            current_chunk = sentence_tokens
+    if current_chunk:
+        chunks.append(current_chunk)
+    return [detokenize(chunk) for chunk in chunks]
+
+
+def decomposer_chunks(text, chunk_size, tokenize, detokenize):
+    from safe_store.document_decomposer import DocumentDecomposer
+    return [detokenize(chunk) for chunk in DocumentDecomposer.decompose_document(text, chunk_size, 0, tokenize, detokenize)]
+
+
+def run(name, chunker, text, chunk_size, call_latency_us):
+    tokenizer = BenchTokenizer(call_latency_us)
+    start = time.perf_counter()
+    chunks = chunker(text, chunk_size, tokenizer.tokenize, tokenizer.detokenize)
+    elapsed = time.perf_counter()-start
+    # Measured without latency so the check does not skew the timings
+    checker = BenchTokenizer(0)
+    largest = max(len(checker.tokenize(chunk)) for chunk in chunks)
+    print(f"{name:<11} {elapsed:8.2f}s {tokenizer.calls:>9} calls {len(chunks):>7} chunks  largest chunk {largest} tokens")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=float, default=10)
+    parser.add_argument("--chunk-size", type=int, default=512)
+    parser.add_argument("--call-latency-us", type=float, default=50)
+    parser.add_argument("--corpus", type=Path, default=None, help="Use this text file instead of a synthetic corpus")
+    args = parser.parse_args()
+
+    text_chunking = load_text_chunking()
+    text = args.corpus.read_text(encoding="utf-8") if args.corpus else build_corpus(args.size_mb)
+    print(f"Corpus: {len(text)/1024/1024:.1f} MB, chunk size {args.chunk_size} tokens, {args.call_latency_us}us per tokenizer call")
+    start = time.perf_counter()
+    spans = text_chunking.sentence_spans(text)
+    print(f"sentence_spans: {len(spans)} sentences in {1000*(time.perf_counter()-start):.1f}ms")
+    new = run("shared", text_chunking.chunk_texts, text, args.chunk_size, args.call_latency_us)
+    old = run("split", legacy_chunks, text, args.chunk_size, args.call_latency_us)
+    print(f"speedup over split: {old/new:.1f}x")
+    try:
+        old = run("decomposer", decomposer_chunks, text, args.chunk_size, args.call_latency_us)
+        print(f"speedup over decomposer: {old/new:.1f}x")
+    except ImportError:
+        print("safe_store is not installed, skipping DocumentDecomposer")
+
+
+if __name__ == "__main__":
+    main()
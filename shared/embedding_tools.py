@@ -0,0 +1,138 @@
+"""
+Embedding helpers shared by the document personalities of the zoo: top k selection,
+row normalization and the cached 2-D projection used to plot a database.
+"""
+import os
+from pathlib import Path
+
+import numpy as np
+from ascii_colors import ASCIIColors
+
+
+def top_k_indices(scores, top_k):
+    """
+    Returns the indices of the top_k highest scores along the last axis, best first.
+
+    Uses argpartition so only the selected candidates are sorted.
+    """
+    nb_scores = scores.shape[-1]
+    top_k = min(top_k, nb_scores)
+    if top_k<=0:
+        return np.zeros(scores.shape[:-1]+(0,), dtype=np.int64)
+    if top_k<nb_scores:
+        candidates = np.argpartition(-scores, top_k-1, axis=-1)[..., :top_k]
+    else:
+        candidates = np.broadcast_to(np.arange(nb_scores), scores.shape)
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=-1), axis=-1, kind="stable")
+    return np.take_along_axis(candidates, order, axis=-1)
+
+
+def normalize_rows(vectors):
+    """Returns the rows of vectors (a 1-D vector is one row) scaled to unit L2 norm as float32"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors = vectors.reshape(vectors.shape[0] if vectors.ndim>1 else 1, -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms==0] = 1
+    return vectors / norms
+
+
+class ProjectionCache:
+    """
+    2-D projection of the embeddings shown by the database plots, computed once per database
+    content and saved next to the database.
+
+    PCA projections are updated incrementally: new chunks are projected on the stored components,
+    which are only refitted when the database grew by more than refit_ratio since the last fit.
+    t-SNE has no transform for new points, so it is only recomputed when the chunks changed.
+    """
+    def __init__(self, path:Path, refit_ratio=0.5):
+        self.path = path
+        self.refit_ratio = refit_ratio
+        self.method = None
+        self.basis = None
+        self.ids = []
+        self.points = np.zeros((0, 2), dtype=np.float32)
+        self.mean = None
+        self.components = None
+        self.fitted_count = 0
+        self.loaded = False
+
+    def _load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                self.method = str(data["method"])
+                self.basis = str(data["basis"])
+                self.ids = data["ids"].tolist()
+                self.points = data["points"]
+                self.fitted_count = int(data["fitted_count"])
+                if self.method=="PCA":
+                    self.mean = data["mean"]
+                    self.components = data["components"]
+        except Exception as ex:
+            ASCIIColors.warning(f"Couldn't load the projection cache: {ex}")
+
+    def save(self):
+        if self.path is None:
+            return
+        arrays = {"method":self.method, "basis":self.basis, "ids":np.array(self.ids, dtype=str), "points":self.points, "fitted_count":self.fitted_count}
+        if self.method=="PCA":
+            arrays.update(mean=self.mean, components=self.components)
+        tmp_path = Path(str(self.path)+".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, self.path)
+
+    def lookup(self, method, basis, ids):
+        """Returns the stored points if they were computed for exactly these chunks, else None"""
+        self._load()
+        if self.method==method and self.basis==basis and self.ids==ids:
+            return self.points
+        return None
+
+    def project(self, method, basis, ids, matrix):
+        """
+        Returns the 2-D points of the rows of matrix (one row per id).
+        basis identifies the embedding space, the cache is dropped when it changes.
+        """
+        points = self.lookup(method, basis, ids)
+        if points is not None:
+            return points
+        if (method=="PCA" and self.method=="PCA" and self.basis==basis and self.components.shape[1]==matrix.shape[1]
+                and len(ids)<=(1+self.refit_ratio)*self.fitted_count):
+            known = {chunk_id:i for i, chunk_id in enumerate(self.ids)}
+            rows = np.array([known.get(chunk_id, -1) for chunk_id in ids])
+            points = np.empty((len(ids), 2), dtype=np.float32)
+            points[rows>=0] = self.points[rows[rows>=0]]
+            if np.any(rows<0):
+                points[rows<0] = (matrix[rows<0]-self.mean) @ self.components.T
+        elif method=="PCA":
+            from sklearn.decomposition import PCA
+            pca = PCA(n_components=2)
+            points = pca.fit_transform(matrix).astype(np.float32)
+            self.mean = pca.mean_.astype(np.float32)
+            self.components = pca.components_.astype(np.float32)
+            self.fitted_count = len(ids)
+        else:
+            from sklearn.manifold import TSNE
+            tsne = TSNE(n_components=2, perplexity=min(30, matrix.shape[0]-1))
+            points = tsne.fit_transform(matrix).astype(np.float32)
+            self.mean = None
+            self.components = None
+            self.fitted_count = len(ids)
+        self.method = method
+        self.basis = basis
+        self.ids = list(ids)
+        self.points = points
+        self.save()
+        return points
+
+    def project_query(self, query_embedding):
+        """Projects a query on the PCA components, None for t-SNE"""
+        if self.method!="PCA" or self.components is None:
+            return None
+        return (query_embedding-self.mean) @ self.components.T
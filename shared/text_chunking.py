@@ -0,0 +1,114 @@
+"""
+Sentence splitting and chunking shared by the personalities of the zoo.
+
+Personalities are not python packages, they add the shared folder to the import path:
+
+    site.addsitedir(str(Path(__file__).resolve().parents[3]/"shared"))
+    import text_chunking
+
+Sentences are found with a single regex scan, their token counts are estimated with one
+tokenize call per batch of sentences, and chunks are packed with cumulative token offsets.
+A chunk is a slice of the original text, so it is only tokenized once (to check its size)
+and never detokenized, except for sentences longer than a chunk that have to be cut.
+"""
+import re
+
+import numpy as np
+
+# End of sentence punctuation (with closing quotes or brackets) followed by spaces, or a paragraph break
+SENTENCE_BOUNDARY = re.compile(r"[.!?;]+[\"'\)\]]*\s+|\n[ \t\r\f\v]*\n\s*")
+
+
+def sentence_spans(text, boundary=SENTENCE_BOUNDARY):
+    """
+    Returns the (start, end) character spans of the sentences of text as an (n, 2) int64 array.
+
+    Sentences keep their delimiter and the spaces that follow it so that the spans cover the
+    text contiguously. Pieces made only of delimiters are attached to the following sentence.
+    """
+    matches = np.array([match.span() for match in boundary.finditer(text)], dtype=np.int64).reshape(-1, 2)
+    ends = matches[:, 1]
+    starts = np.concatenate([[0], ends[:-1]])
+    # A delimiter right at the start of a span closes an empty sentence
+    ends = ends[matches[:, 0]>starts]
+    if len(ends)>0 and ends[-1]==len(text):
+        ends = ends[:-1]
+    if text[ends[-1] if len(ends)>0 else 0:].strip()!="":
+        ends = np.concatenate([ends, [len(text)]])
+    elif len(ends)>0:
+        ends[-1] = len(text)
+    else:
+        return np.zeros((0, 2), dtype=np.int64)
+    return np.stack([np.concatenate([[0], ends[:-1]]), ends], axis=1).astype(np.int64)
+
+
+def estimate_token_counts(text, spans, tokenize, batch_chars=8192):
+    """
+    Estimates the number of tokens of each span with one tokenize call per batch of about
+    batch_chars characters.
+
+    Each batch is tokenized as a whole and its exact token count is shared between its spans
+    proportionally to their length, remainders going to the largest fractional parts.
+    """
+    lengths = spans[:, 1]-spans[:, 0]
+    counts = np.zeros(len(spans), dtype=np.int64)
+    if len(spans)==0:
+        return counts
+    batch_ids = (np.cumsum(lengths)-1)//batch_chars
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(batch_ids))+1, [len(spans)]])
+    for i, j in zip(bounds[:-1], bounds[1:]):
+        nb_tokens = len(tokenize(text[spans[i, 0]:spans[j-1, 1]]))
+        shares = lengths[i:j]*nb_tokens/max(1, lengths[i:j].sum())
+        batch_counts = np.floor(shares).astype(np.int64)
+        missing = nb_tokens-int(batch_counts.sum())
+        if missing>0:
+            batch_counts[np.argsort(batch_counts-shares, kind="stable")[:missing]] += 1
+        counts[i:j] = batch_counts
+    return counts
+
+
+def chunk_document(text, chunk_size, tokenize, detokenize, overlap=0, batch_chars=8192):
+    """
+    Splits text into chunks of at most chunk_size tokens made of whole sentences.
+
+    overlap is a number of tokens: each chunk starts with the last sentences of the previous
+    one that fit in it. Returns a list of dicts with the chunk "text", its "tokens" and its
+    "start" and "end" character offsets in text. Chunks cut out of a sentence longer than
+    chunk_size are detokenized, their offsets are those of the sentence.
+    """
+    spans = sentence_spans(text)
+    counts = estimate_token_counts(text, spans, tokenize, batch_chars)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    chunks = []
+    i = 0
+    while i<len(spans):
+        # Last sentence whose estimated end is still within chunk_size tokens
+        j = max(i+1, int(np.searchsorted(offsets, offsets[i]+chunk_size, side="right"))-1)
+        while True:
+            start = int(spans[i, 0])
+            chunk_text = text[start:int(spans[j-1, 1])].rstrip()
+            tokens = tokenize(chunk_text)
+            if len(tokens)<=chunk_size or j==i+1:
+                break
+            # The estimate was too optimistic, push the last sentence to the next chunk
+            j -= 1
+        if len(tokens)<=chunk_size:
+            chunks.append({"text":chunk_text, "tokens":tokens, "start":start, "end":start+len(chunk_text)})
+        else:
+            step = max(1, chunk_size-overlap)
+            for k in range(0, max(1, len(tokens)-overlap), step):
+                piece = tokens[k:k+chunk_size]
+                chunks.append({"text":detokenize(piece), "tokens":piece, "start":start, "end":start+len(chunk_text)})
+        if j>=len(spans):
+            break
+        if overlap>0 and j>i+1:
+            # First sentence of the chunk from which the end of the chunk fits in overlap tokens
+            i = min(j, max(i+1, int(np.searchsorted(offsets, offsets[j]-overlap, side="left"))))
+        else:
+            i = j
+    return chunks
+
+
+def chunk_texts(text, chunk_size, tokenize, detokenize, overlap=0, batch_chars=8192):
+    """The texts of chunk_document"""
+    return [chunk["text"] for chunk in chunk_document(text, chunk_size, tokenize, detokenize, overlap, batch_chars)]
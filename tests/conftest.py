@@ -0,0 +1,22 @@
+"""
+Personalities are not python packages: the tests load their processor.py files by path, and
+import the shared modules the same way the personalities do.
+"""
+import importlib.util
+import site
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+site.addsitedir(str(ROOT/"shared"))
+
+
+def load_processor(personality):
+    """Loads <personality>/scripts/processor.py, skipping the test if lollms is not installed"""
+    pytest.importorskip("lollms.personality")
+    path = ROOT/personality/"scripts"/"processor.py"
+    spec = importlib.util.spec_from_file_location(f"{personality.replace('/', '_')}_processor", str(path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
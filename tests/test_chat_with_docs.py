@@ -0,0 +1,113 @@
+import json
+
+import numpy as np
+import pytest
+
+from conftest import load_processor
+
+
+@pytest.fixture(scope="module")
+def processor():
+    return load_processor("data/chat_with_docs")
+
+
+def clustered_embeddings(nb_rows, dim, nb_topics, seed=0):
+    rng = np.random.default_rng(seed)
+    topics = rng.standard_normal((nb_topics, dim)).astype(np.float32)
+    vectors = topics[rng.integers(0, nb_topics, nb_rows)]+0.5*rng.standard_normal((nb_rows, dim)).astype(np.float32)
+    return vectors/np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_bm25_ranks_matching_chunks(processor):
+    index = processor.BM25Index()
+    assert index.add("a", "The cat sat on the mat")
+    assert index.add("b", "Dogs chase cats and the mailman")
+    assert index.add("c", "A cat, a cat and another cat")
+    assert not index.add("a", "Already indexed")
+    assert len(index)==3
+    assert index.search("cat", 10)==["c", "a"]
+    assert index.search("cat", 1)==["c"]
+    assert index.search("unknown", 10)==[]
+
+
+def test_bm25_save_and_load(processor, tmp_path):
+    index = processor.BM25Index()
+    for i in range(20):
+        index.add(f"chunk{i}", f"common words and topic{i%4} text{i}")
+    processor.BM25Index.save(tmp_path/"bm25.npz", index.snapshot())
+    loaded = processor.BM25Index()
+    loaded.load(tmp_path/"bm25.npz")
+    for query in ["topic1", "text7 common", "nothing"]:
+        assert loaded.search(query, 5)==index.search(query, 5)
+    # Chunks added after a load extend the frozen postings
+    loaded.add("new", "topic1 topic1 topic1")
+    assert loaded.search("topic1", 1)==["new"]
+
+
+def test_ivf_recall(processor):
+    matrix = clustered_embeddings(4000, 32, 40)
+    queries = clustered_embeddings(50, 32, 40, seed=1)
+    exact = np.argsort(-(queries@matrix.T), axis=1)[:, :10]
+    index = processor.IVFIndex()
+    index.build(matrix)
+    nlist = index.centroids.shape[0]
+    assert nlist==int(np.sqrt(4000))
+
+    def recall(nprobe):
+        hits = index.search(matrix, queries, 10, nprobe)
+        return np.mean([len(set(rows.tolist()) & set(expected.tolist()))/10 for (rows, _), expected in zip(hits, exact)])
+
+    assert recall(nlist)==1.0
+    assert recall(16)>=0.9
+
+
+def test_ivf_scores_rows_added_after_build(processor, tmp_path):
+    matrix = clustered_embeddings(1000, 16, 10)
+    index = processor.IVFIndex()
+    index.build(matrix[:900])
+    rows, scores = index.search(matrix, matrix[950:951], 1, 1)[0]
+    assert rows.tolist()==[950]
+    assert scores[0]==pytest.approx(1.0, abs=1e-5)
+    index.save(tmp_path/"ivf.npz", "hash900")
+    loaded = processor.IVFIndex()
+    assert not loaded.load(tmp_path/"ivf.npz", lambda nb_rows: "other")
+    assert loaded.load(tmp_path/"ivf.npz", lambda nb_rows: f"hash{nb_rows}")
+    assert loaded.nb_rows==900
+
+
+def test_batch_report_resumes_after_the_last_answer(processor, tmp_path):
+    report_path = tmp_path/"report.md"
+    writer = processor.BatchReportWriter(report_path, "hash")
+    assert writer.open()==set()
+    writer.append_query(0, "query 0")
+    writer.append(0, "answer 0\n")
+    writer.append_query(1, "query 1")
+    writer.append(1, "answer 1\n")
+    writer.append_query(2, "query 2")
+    writer.close()
+    # A crash while answering question 2: part of its answer and a torn journal line
+    with open(report_path, "a", encoding="utf-8") as f:
+        f.write("partial answer")
+    with open(str(report_path)+".checkpoint.jsonl", "a", encoding="utf-8") as f:
+        f.write('{"index": 2, "rep')
+
+    writer = processor.BatchReportWriter(report_path, "hash")
+    assert writer.open()=={0, 1}
+    assert writer.queries=={2:"query 2"}
+    writer.append(2, "answer 2\n")
+    writer.close()
+    assert report_path.read_text(encoding="utf-8")=="answer 0\nanswer 1\nanswer 2\n"
+    with open(str(report_path)+".checkpoint.jsonl", "r", encoding="utf-8") as f:
+        assert [json.loads(line) for line in f][-1]["index"]==2
+
+
+def test_batch_report_starts_over_when_the_questions_change(processor, tmp_path):
+    report_path = tmp_path/"report.md"
+    writer = processor.BatchReportWriter(report_path, "hash")
+    writer.open()
+    writer.append(0, "answer 0\n")
+    writer.close()
+    writer = processor.BatchReportWriter(report_path, "other hash")
+    assert writer.open()==set()
+    writer.close()
+    assert report_path.read_text(encoding="utf-8")==""
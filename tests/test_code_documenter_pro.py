@@ -0,0 +1,219 @@
+import hashlib
+
+import numpy as np
+import pytest
+
+from conftest import load_processor
+
+
+@pytest.fixture(scope="module")
+def processor():
+    return load_processor("coding/code_documenter_pro")
+
+
+class Config(dict):
+    """personality_config stand in, read both as attributes and as items"""
+    __getattr__ = dict.__getitem__
+    __setattr__ = dict.__setitem__
+
+
+class Model:
+    """Whitespace tokenizer and a deterministic bag of hashed words embedding"""
+    dim = 64
+
+    def tokenize(self, text):
+        return text.split()
+
+    def detokenize(self, tokens):
+        return " ".join(tokens)
+
+    def embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in text.lower().split():
+            vector[int(hashlib.md5(word.encode("utf-8")).hexdigest(), 16)%self.dim] += 1
+        return vector.tolist()
+
+
+def make_vectorizer(processor, tmp_path, vectorization_method="model_embedding", save_db=True):
+    class Personality:
+        model = Model()
+        personality_folder_name = "code_documenter_pro"
+
+        class lollms_paths:
+            personal_data_path = tmp_path
+            personal_uploads_path = tmp_path
+
+    class Processor:
+        personality = Personality()
+        personality_config = Config(
+                                database_path="db.json",
+                                vectorization_method=vectorization_method,
+                                save_db=save_db,
+                                data_visualization_method="PCA",
+                                visualize_data_at_startup=False,
+                                visualize_data_at_add_file=False,
+                                visualize_data_at_generate=False
+                            )
+    return processor.TextVectorizer(Processor())
+
+
+def brute_force(vectors, query, top_k):
+    vectors = np.asarray(vectors, dtype=np.float64)
+    similarities = vectors @ query / np.linalg.norm(vectors, axis=1) / np.linalg.norm(query)
+    return np.argsort(-similarities, kind="stable")[:top_k], np.sort(similarities)[::-1][:top_k]
+
+
+@pytest.mark.parametrize("vectorization_method", ["model_embedding", "ftidf_vectorizer"])
+def test_empty_store_returns_no_results(processor, tmp_path, vectorization_method):
+    vectorizer = make_vectorizer(processor, tmp_path, vectorization_method)
+    query = vectorizer.embed_query("anything")
+    assert vectorizer.recover_text(query, top_k=3)==([], [])
+    assert vectorizer.recover_texts([query, query], top_k=3)==[([], []), ([], [])]
+
+
+def test_recover_text_matches_brute_force_cosine(processor, tmp_path):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((300, 32))
+    chunk_ids = [f"doc_chunk_{i}" for i in range(300)]
+    vectorizer = make_vectorizer(processor, tmp_path, save_db=False)
+    vectorizer.texts = {chunk_id:f"text {i}" for i, chunk_id in enumerate(chunk_ids)}
+    vectorizer.add_embeddings(chunk_ids[:100], vectors[:100])
+    vectorizer.add_embeddings(chunk_ids[100:], vectors[100:])
+    queries = rng.standard_normal((5, 32))
+    results = vectorizer.recover_texts(list(queries), top_k=7)
+    for query, (texts, sorted_similarities) in zip(queries, results):
+        rows, similarities = brute_force(vectors, query, 7)
+        assert [chunk_id for chunk_id, _ in sorted_similarities]==[chunk_ids[row] for row in rows]
+        assert np.allclose([score for _, score in sorted_similarities], similarities, atol=1e-5)
+        assert texts==[f"text {row}" for row in rows]
+        single_texts, single_similarities = vectorizer.recover_text(query, top_k=7)
+        assert single_texts==texts
+        assert [score for _, score in single_similarities]==pytest.approx([score for _, score in sorted_similarities], abs=1e-6)
+
+
+def test_replaced_embeddings_are_searched(processor, tmp_path):
+    vectorizer = make_vectorizer(processor, tmp_path, save_db=False)
+    vectorizer.texts = {"a":"a", "b":"b"}
+    vectorizer.add_embeddings(["a", "b"], [[1, 0], [0, 1]])
+    vectorizer.add_embeddings(["a"], [[0, 2]])
+    assert len(vectorizer)==2
+    texts, sorted_similarities = vectorizer.recover_text(np.array([0, 1]), top_k=2)
+    assert [score for _, score in sorted_similarities]==pytest.approx([1, 1])
+
+
+def stored_vectors(vectorizer):
+    return {chunk_id:np.array(row) for chunk_id, row in zip(vectorizer.chunk_ids, vectorizer.embedding_matrix)}
+
+
+def test_store_save_load_append(processor, tmp_path):
+    rng = np.random.default_rng(1)
+    vectorizer = make_vectorizer(processor, tmp_path)
+    vectorizer.texts = {f"c{i}":f"text {i}" for i in range(40)}
+    vectorizer.add_embeddings([f"c{i}" for i in range(20)], rng.standard_normal((20, 16)))
+    vectorizer.save()
+    expected = stored_vectors(vectorizer)
+
+    loaded = make_vectorizer(processor, tmp_path)
+    assert isinstance(loaded._matrix, np.memmap)
+    assert loaded.chunk_ids==vectorizer.chunk_ids
+    assert loaded.texts=={f"c{i}":f"text {i}" for i in range(20)}
+    assert all(np.array_equal(row, expected[chunk_id]) for chunk_id, row in stored_vectors(loaded).items())
+
+    # Append new rows and replace a saved one, the save only patches the file
+    loaded.texts.update({f"c{i}":f"new text {i}" for i in range(1, 40)})
+    loaded.add_embeddings(["c3"]+[f"c{i}" for i in range(20, 40)], rng.standard_normal((21, 16)))
+    loaded.save()
+    expected = stored_vectors(loaded)
+
+    reloaded = make_vectorizer(processor, tmp_path)
+    assert len(reloaded)==40
+    assert reloaded.texts["c3"]=="new text 3"
+    assert reloaded.store_matrix_file.stat().st_size==40*16*4
+    for chunk_id, row in stored_vectors(reloaded).items():
+        assert np.array_equal(row, expected[chunk_id])
+    texts, sorted_similarities = reloaded.recover_text(expected["c25"], top_k=1)
+    assert sorted_similarities[0][0]=="c25"
+
+
+@pytest.mark.parametrize("vectorization_method", ["model_embedding", "ftidf_vectorizer"])
+def test_store_clear_and_reuse(processor, tmp_path, vectorization_method):
+    vectorizer = make_vectorizer(processor, tmp_path, vectorization_method)
+    vectorizer.index_document("first.py", "def first(): return 1. The first function.", 50, 0)
+    vectorizer.clear_database()
+    assert len(vectorizer)==0
+
+    cleared = make_vectorizer(processor, tmp_path, vectorization_method)
+    assert len(cleared)==0
+    query = cleared.embed_query("second function")
+    assert cleared.recover_text(query, top_k=2)==([], [])
+
+    cleared.index_document("second.py", "def second(): return 2. The second function.", 50, 0)
+    reloaded = make_vectorizer(processor, tmp_path, vectorization_method)
+    assert reloaded.chunk_ids==["second.py_chunk_1"]
+    texts, _ = reloaded.recover_text(reloaded.embed_query("second function"), top_k=2)
+    assert texts==["def second(): return 2. The second function."]
+
+
+def test_store_imports_and_exports_json(processor, tmp_path):
+    vectorizer = make_vectorizer(processor, tmp_path)
+    vectorizer.index_document("doc.py", "Some words. Other words here.", 3, 0)
+    vectorizer.export_to_json(tmp_path/"export.json")
+    (tmp_path/"other").mkdir()
+    imported = make_vectorizer(processor, tmp_path/"other", save_db=False)
+    imported.import_from_json(tmp_path/"export.json")
+    assert imported.chunk_ids==vectorizer.chunk_ids
+    assert np.allclose(imported.embedding_matrix, vectorizer.embedding_matrix)
+
+
+DOCUMENTS = [
+    "def load(path): reads the database file from the path",
+    "def save(path): writes the database file to the path atomically",
+    "class TextVectorizer keeps the embeddings in a matrix",
+    "the matrix rows are normalized embeddings of the chunks",
+    "tf idf weights come from the document frequencies of the terms",
+]
+
+
+def test_tfidf_matches_sklearn(processor):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    reference = TfidfVectorizer()
+    reference_rows = reference.fit_transform(DOCUMENTS)
+    index = processor.TfidfIndex()
+    # Added in two batches, the idf still covers every document
+    index.add([0, 1], DOCUMENTS[:2])
+    index.add([2, 3, 4], DOCUMENTS[2:])
+    weighted = index.weighted_matrix()
+    assert np.allclose((weighted @ weighted.T).toarray(), (reference_rows @ reference_rows.T).toarray(), atol=1e-6)
+    # Queries made of known terms score like sklearn's cosine similarity
+    queries = ["database path", "normalized matrix embeddings", "document terms weights"]
+    scores = index.scores(index.transform(queries))
+    assert np.allclose(scores, (reference.transform(queries) @ reference_rows.T).toarray(), atol=1e-6)
+
+
+def test_tfidf_rows_are_replaced_and_saved(processor, tmp_path):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    index = processor.TfidfIndex()
+    index.add(range(5), DOCUMENTS)
+    index.add([1], ["a replaced second document about the path"])
+    documents = DOCUMENTS[:1]+["a replaced second document about the path"]+DOCUMENTS[2:]
+    reference_rows = TfidfVectorizer().fit_transform(documents)
+    assert len(index)==5
+    weighted = index.weighted_matrix()
+    assert np.allclose((weighted @ weighted.T).toarray(), (reference_rows @ reference_rows.T).toarray(), atol=1e-6)
+
+    index.save(tmp_path/"tfidf.npz")
+    loaded = processor.TfidfIndex()
+    loaded.load(tmp_path/"tfidf.npz")
+    queries = index.transform(["replaced path", "matrix"])
+    assert np.allclose(loaded.scores(queries), index.scores(queries))
+    assert not (tmp_path/"tfidf.npz.tmp").exists()
+
+
+@pytest.mark.parametrize("nb_chunks", [2, 3, 10])
+def test_tfidf_projection_of_small_stores(processor, tmp_path, nb_chunks):
+    vectorizer = make_vectorizer(processor, tmp_path, "ftidf_vectorizer", save_db=False)
+    for i in range(nb_chunks):
+        vectorizer.index_document(f"doc{i}.py", DOCUMENTS[i%len(DOCUMENTS)]+f" number{i}", 100, 0)
+    assert vectorizer.projection_2d("PCA").shape==(nb_chunks, 2)
+    assert vectorizer.projection_2d("TSNE").shape==(nb_chunks, 2)
+    assert vectorizer._projections["PCA"].project_query(vectorizer.reduced_query("database path")[0]).shape==(2,)
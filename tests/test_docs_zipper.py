@@ -0,0 +1,187 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import load_processor
+
+
+@pytest.fixture(scope="module")
+def processor():
+    return load_processor("data/docs_zipper")
+
+
+@pytest.fixture
+def folder(tmp_path):
+    folder = tmp_path/"docs"
+    folder.mkdir()
+    for name in ["a.txt", "b.txt", "c.txt"]:
+        (folder/name).write_text(f"content of {name}", encoding="utf-8")
+    return folder
+
+
+def names_and_paths(folder):
+    return [(path.name, path) for path in sorted(folder.iterdir())]
+
+
+def test_manifest_resumes_an_interrupted_job(processor, folder, tmp_path):
+    manifest_path = tmp_path/"summaries"/"manifest.json"
+    manifest = processor.ZipJobManifest(manifest_path, "settings")
+    assert manifest.sync(names_and_paths(folder))==["a.txt", "b.txt", "c.txt"]
+    manifest.update("a.txt", status="done", summary_path="a.md")
+    manifest.update("b.txt", status="running", depth=1, nodes=["summary 1", "summary 2"], nb_chunks=5)
+
+    manifest = processor.ZipJobManifest(manifest_path, "settings")
+    assert manifest.sync(names_and_paths(folder))==["b.txt", "c.txt"]
+    assert manifest.resume_state("b.txt")=={"depth":1, "nodes":["summary 1", "summary 2"], "nb_chunks":5}
+    assert manifest.resume_state("c.txt") is None
+    assert manifest.counts(["a.txt", "b.txt", "c.txt"])=={"done":1, "running":1, "pending":1}
+    assert not (tmp_path/"summaries"/"manifest.json.tmp").exists()
+
+
+def test_manifest_restarts_changed_files(processor, folder, tmp_path):
+    manifest_path = tmp_path/"manifest.json"
+    manifest = processor.ZipJobManifest(manifest_path, "settings")
+    manifest.sync(names_and_paths(folder))
+    for name in ["a.txt", "b.txt", "c.txt"]:
+        manifest.update(name, status="done", depth=2, nodes=["summary"])
+    (folder/"b.txt").write_text("new and longer content of b.txt", encoding="utf-8")
+
+    manifest = processor.ZipJobManifest(manifest_path, "settings")
+    assert manifest.sync(names_and_paths(folder))==["b.txt"]
+    assert manifest.resume_state("b.txt") is None
+
+
+def test_manifest_does_not_retry_skipped_files(processor, folder, tmp_path):
+    manifest = processor.ZipJobManifest(tmp_path/"manifest.json", "settings")
+    manifest.sync(names_and_paths(folder))
+    manifest.update("a.txt", status="skipped", error="no text could be extracted")
+
+    manifest = processor.ZipJobManifest(tmp_path/"manifest.json", "settings")
+    assert manifest.sync(names_and_paths(folder))==["b.txt", "c.txt"]
+    (folder/"a.txt").write_text("now with some text in it", encoding="utf-8")
+    assert manifest.sync(names_and_paths(folder))==["a.txt", "b.txt", "c.txt"]
+
+
+def test_manifest_starts_over_when_the_settings_change(processor, folder, tmp_path):
+    manifest_path = tmp_path/"manifest.json"
+    manifest = processor.ZipJobManifest(manifest_path, "settings")
+    manifest.sync(names_and_paths(folder))
+    manifest.update("a.txt", status="done")
+
+    manifest = processor.ZipJobManifest(manifest_path, "other settings")
+    assert manifest.sync(names_and_paths(folder))==["a.txt", "b.txt", "c.txt"]
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        assert json.load(f)["settings_hash"]=="other settings"
+
+
+def make_zipper(processor, ctx_size, zip_size, summary):
+    """A Processor without a lollms app: whitespace tokens and a binding returning summary(prompt)"""
+    zipper = processor.Processor.__new__(processor.Processor)
+    zipper.personality = SimpleNamespace(
+                            config=SimpleNamespace(ctx_size=ctx_size, model_name="test"),
+                            model=SimpleNamespace(tokenize=lambda text: text.split(), detokenize=lambda tokens: " ".join(tokens))
+                        )
+    zipper.personality_config = SimpleNamespace(zip_size=zip_size, max_workers=1, use_summary_cache=False, keep_same_language=True, preserve_document_title=False, preserve_authors_name=False, preserve_results=True, maximum_compression=False, contextual_zipping_text="", translate_to="")
+    zipper.token_counter = None
+    zipper.summary_cache = None
+    zipper.generation_slots = None
+    zipper.prompts = []
+
+    def fast_gen(prompt, max_generation_size=None, **kwargs):
+        zipper.prompts.append(prompt)
+        return summary(prompt)
+    zipper.fast_gen = fast_gen
+    return zipper
+
+
+@pytest.mark.parametrize("text", ["", "   \n\n  "])
+def test_empty_documents_give_an_empty_summary(processor, text):
+    zipper = make_zipper(processor, 2048, 512, lambda prompt: "summary")
+    assert zipper.zip_text("empty.txt", text, verbose=False)==("", "")
+    assert zipper.prompts==[]
+
+
+def test_levels_shrink_when_summaries_overflow_zip_size(processor):
+    # The binding ignores the generation limit: every summary is 700 tokens
+    zipper = make_zipper(processor, 2048, 1024, lambda prompt: " ".join(["word"]*700))
+    assert zipper.fan_in(zipper.chunk_size())==2
+    text = ". ".join(" ".join(["text"]*100) for _ in range(120))
+    summary, _ = zipper.zip_text("long.txt", text, verbose=False)
+    assert summary==" ".join(["word"]*700)
+    # 10 chunk summaries, then 5, 3, 2 and 1 merged summaries, then the composition
+    assert len(zipper.prompts)==10+5+3+2+1+1
+
+
+def test_generations_are_bounded_by_max_workers(processor):
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def summary(prompt):
+        with lock:
+            running.append(prompt)
+            peak.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(prompt)
+        return "summary"
+    zipper = make_zipper(processor, 2048, 512, summary)
+    # Several files zipped at once share the max_workers slots
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(lambda i: zipper.summarize_chunk(f"chunk {i}", "instruction"), range(8)))
+    assert max(peak)==1
+
+
+def test_token_counter_only_reports_avoided_calls(processor):
+    tokenized = []
+    counter = processor.TokenCounter(lambda text: tokenized.append(text) or text.split())
+    assert counter.count("a b c")==3
+    assert counter.count("d e")==2
+    assert counter.count("a b c")==3
+    assert tokenized==["a b c", "d e"]
+    assert (counter.calls, counter.saved)==(2, 1)
+
+
+def read_cache_keys(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line)["key"] for line in f]
+
+
+def test_summary_cache_evicts_and_compacts(processor, tmp_path):
+    cache_path = tmp_path/"summary_cache.jsonl"
+    cache = processor.SummaryCache(cache_path, max_entries=3)
+    for i in range(3):
+        cache.put(f"key{i}", f"summary {i}")
+    assert cache.get("key0")=="summary 0"
+    cache.put("key3", "summary 3")
+    # key1 was the least recently used
+    assert cache.get("key1") is None
+    assert list(cache.entries)==["key2", "key0", "key3"]
+    for i in range(4, 8):
+        cache.put(f"key{i}", f"summary {i}")
+    assert list(cache.entries)==["key5", "key6", "key7"]
+    # The file never holds more stale lines than kept entries
+    assert len(read_cache_keys(cache_path))<=2*3
+    assert set(read_cache_keys(cache_path))>=set(cache.entries)
+
+    cache = processor.SummaryCache(cache_path, max_entries=2)
+    assert list(cache.entries)==["key6", "key7"]
+    assert len(read_cache_keys(cache_path))<=2*2
+    cache.put("key8", "summary 8")
+    assert read_cache_keys(cache_path)==["key7", "key8"]
+
+
+def test_summary_cache_drops_torn_lines(processor, tmp_path):
+    cache_path = tmp_path/"summary_cache.jsonl"
+    cache = processor.SummaryCache(cache_path)
+    cache.put("key0", "summary 0")
+    with open(cache_path, "a", encoding="utf-8") as f:
+        f.write('{"key": "key1", "summ')
+    cache = processor.SummaryCache(cache_path)
+    assert read_cache_keys(cache_path)==["key0"]
+    cache.put("key1", "summary 1")
+    assert processor.SummaryCache(cache_path).entries=={"key0":"summary 0", "key1":"summary 1"}
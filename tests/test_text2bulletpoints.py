@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from conftest import load_processor
+
+
+@pytest.fixture(scope="module")
+def processor():
+    return load_processor("data/text2bulletpoints")
+
+
+def read_store(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line)["paragraph"] for line in f]
+
+
+def test_legacy_json_store_is_migrated(processor, tmp_path):
+    database_path = tmp_path/"db.json"
+    database_path.write_text(json.dumps({"paragraphs":["first", "second"]}), encoding="utf-8")
+    store = processor.Text2Paragraphs(database_path, 50)
+    assert read_store(tmp_path/"db.jsonl")==["first", "second"]
+    assert store.paragraphs==["first", "second"]
+    assert store.exists()
+
+    store.chunk_text("x"*30+"\n"+"y"*30+"\n"+"z"*10)
+    assert store.paragraphs==["first", "second", "x"*30, "y"*30+"\n"+"z"*10]
+    # The migrated store is used from now on, the legacy file is not read again
+    database_path.write_text(json.dumps({"paragraphs":["stale"]}), encoding="utf-8")
+    assert list(processor.Text2Paragraphs(database_path, 50).iter_paragraphs())==store.paragraphs
+
+
+def test_files_are_appended_to_the_store(processor, tmp_path):
+    text_path = tmp_path/"doc.txt"
+    text_path.write_text("".join(f"line {i}\n" for i in range(100)), encoding="utf-8")
+    store = processor.Text2Paragraphs(tmp_path/"db.json", 100)
+    assert not store.exists()
+    nb_paragraphs = store.chunk_file(text_path)
+    assert nb_paragraphs==len(read_store(tmp_path/"db.jsonl"))>1
+    assert all(len(paragraph.replace("\n", ""))<=100 for paragraph in store.paragraphs)
+    assert "\n".join(store.paragraphs)=="\n".join(f"line {i}" for i in range(100))
+    store.clear()
+    assert not store.exists()
+    assert store.paragraphs==[]
@@ -0,0 +1,73 @@
+import numpy as np
+
+import text_chunking
+
+
+def tokenize(text):
+    return text.split()
+
+
+def detokenize(tokens):
+    return " ".join(tokens)
+
+
+TEXT = (
+    "The first sentence is short. The second one asks a question? "
+    "Then an exclamation! \"A quoted sentence.\" (A bracketed one.)\n\n"
+    "A new paragraph starts here; it goes on with a clause. "
+)*20
+
+
+def test_sentence_spans_cover_the_text():
+    spans = text_chunking.sentence_spans(TEXT)
+    assert spans.dtype==np.int64
+    assert spans[0, 0]==0
+    assert spans[-1, 1]==len(TEXT)
+    assert np.array_equal(spans[1:, 0], spans[:-1, 1])
+    assert text_chunking.SENTENCE_BOUNDARY.search(TEXT[spans[0, 0]:spans[0, 1]]).end()==spans[0, 1]
+
+
+def test_sentence_spans_of_blank_text():
+    assert text_chunking.sentence_spans("").shape==(0, 2)
+    assert text_chunking.sentence_spans("   \n\n  ").shape==(0, 2)
+
+
+def test_sentence_spans_attach_leading_delimiters():
+    spans = text_chunking.sentence_spans("... Hello there. Bye")
+    assert [("... Hello there. Bye")[start:end] for start, end in spans]==["... Hello there. ", "Bye"]
+
+
+def test_estimate_token_counts_match_each_batch():
+    spans = text_chunking.sentence_spans(TEXT)
+    counts = text_chunking.estimate_token_counts(TEXT, spans, tokenize, batch_chars=10**9)
+    assert counts.sum()==len(tokenize(TEXT))
+    calls = []
+    counts = text_chunking.estimate_token_counts(TEXT, spans, lambda text: calls.append(text) or tokenize(text), batch_chars=256)
+    assert counts.sum()==sum(len(tokenize(text)) for text in calls)
+    assert 1<len(calls)<len(spans)
+
+
+def test_chunks_are_slices_within_the_size():
+    chunks = text_chunking.chunk_document(TEXT, 40, tokenize, detokenize)
+    assert len(chunks)>1
+    for chunk in chunks:
+        assert len(chunk["tokens"])<=40
+        assert chunk["tokens"]==tokenize(chunk["text"])
+        assert TEXT[chunk["start"]:chunk["end"]]==chunk["text"]
+    assert [token for chunk in chunks for token in chunk["tokens"]]==tokenize(TEXT)
+
+
+def test_chunks_overlap():
+    chunks = text_chunking.chunk_document(TEXT, 40, tokenize, detokenize, overlap=10)
+    for previous, chunk in zip(chunks[:-1], chunks[1:]):
+        assert len(chunk["tokens"])<=40
+        assert previous["start"]<chunk["start"]<previous["end"]
+    assert chunks[-1]["end"]==len(TEXT.rstrip())
+
+
+def test_long_sentences_are_cut():
+    text = " ".join(f"word{i}" for i in range(100))+". Short end."
+    chunks = text_chunking.chunk_document(text, 30, tokenize, detokenize)
+    assert [len(chunk["tokens"]) for chunk in chunks]==[30, 30, 30, 10, 2]
+    assert chunks[0]["text"]==detokenize([f"word{i}" for i in range(30)])
+    assert text_chunking.chunk_texts(text, 30, tokenize, detokenize)==[chunk["text"] for chunk in chunks]